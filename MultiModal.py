@@ -1,9 +1,12 @@
 # MultiModal.py
 # 多模态图片理解与OCR文本提取工具
 import uuid
+import json
 import requests
 import os
 from auth_util import gen_sign_headers
+from http_client import get_async_client, request_timeout
+from concurrency import gather_limited
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -19,9 +22,25 @@ URI = os.getenv('MULTIMODAL_URI')
 DOMAIN = os.getenv('MULTIMODAL_DOMAIN')
 METHOD = 'POST'
 
-def extract_text(image_base64, temperature=0.1, max_tokens=1024, timeout=15):
+# 单个请求内同时进行的多模态调用上限
+IMAGE_MAX_CONCURRENCY = int(os.getenv('IMAGE_MAX_CONCURRENCY', '4'))
+
+OCR_PROMPT = "请提取图片中的所有文字内容，按原格式返回。忽略图片描述，只返回原始文本。"
+
+DEFAULT_INTERPRET_PROMPT = (
+    "不能超过800字.请描述这张图片的全部内容，着重关注和购物有关的内容,要求覆盖以下方面：\n"
+    "1. 主要物体/人物：列出图片中出现的主要物体或人物，并简要说明其特征、动作、姿态、表情等；\n"
+    "2. 场景和环境：描述图片的背景、地点、时间、氛围、色彩等环境信息；\n"
+    "3. 关系与互动：如有多个元素，说明它们之间的关系或互动情况；\n"
+    "4. 其他显著特征：如特殊标志、符号、颜色、光影效果等；\n"
+    "5. 图片整体风格或用途：如是插画、照片、截图、广告等，请说明类型和可能用途。\n"
+    "请按照上述结构分条详细描述，内容尽量全面、具体。\n"
+)
+
+
+def _build_image_request(image_base64, prompt_text, extra):
     """
-    使用多模态大模型对图片进行OCR文字提取，仅返回原始文本内容。
+    构造多模态请求所需的 (url, params, headers, payload)，同步与异步调用共用。
     """
     # 处理 base64 字符串格式
     if not image_base64.startswith('data:image'):
@@ -30,8 +49,7 @@ def extract_text(image_base64, temperature=0.1, max_tokens=1024, timeout=15):
     else:
         # 如果已经有前缀，保持原样
         clean_base64 = image_base64.strip()
-    
-    prompt_text = "请提取图片中的所有文字内容，按原格式返回。忽略图片描述，只返回原始文本。"
+
     request_id = str(uuid.uuid4())
     params = {'requestId': request_id}
     payload = {
@@ -50,25 +68,70 @@ def extract_text(image_base64, temperature=0.1, max_tokens=1024, timeout=15):
                 "contentType": "text"
             }
         ],
-        'extra': {
-            "temperature": temperature,
-            "max_tokens": max_tokens
-        }
+        'extra': extra
     }
     headers = gen_sign_headers(APP_ID, APP_KEY, METHOD, URI, params)
     headers['Content-Type'] = 'application/json'
     url = f'https://{DOMAIN}{URI}'
+    return url, params, headers, payload
+
+
+def _parse_image_response(status_code, response_body_text):
+    """解析多模态接口响应，返回 (content, error)。"""
+    if status_code != 200:
+        return None, f'HTTP error: {status_code} - {response_body_text}'
+    res_obj = json.loads(response_body_text)
+    if res_obj.get('code') != 0:
+        return None, f'API error: {res_obj.get("msg")}'
+    return res_obj['data'].get('content', ''), None
+
+
+def _interpret_extra(temperature, top_p, top_k, max_tokens, repetition_penalty, stop, ignore_eos, skip_special_tokens):
+    """图片理解请求的 extra 参数。"""
+    if stop is None:
+        stop = ["</end>"]
+    return {
+        "temperature": temperature,
+        "top_p": top_p,
+        "top_k": top_k,
+        "max_tokens": max_tokens,
+        "repetition_penalty": repetition_penalty,
+        "stop": stop,
+        "ignore_eos": ignore_eos,
+        "skip_special_tokens": skip_special_tokens
+    }
+
+
+def extract_text(image_base64, temperature=0.1, max_tokens=1024, timeout=15):
+    """
+    使用多模态大模型对图片进行OCR文字提取，仅返回原始文本内容。
+    """
+    url, params, headers, payload = _build_image_request(
+        image_base64, OCR_PROMPT, {"temperature": temperature, "max_tokens": max_tokens}
+    )
     try:
         resp = requests.post(url, json=payload, headers=headers, params=params, timeout=timeout)
-        if resp.status_code != 200:
-            return None, f'HTTP error: {resp.status_code} - {resp.text}'
-        res_obj = resp.json()
-        if res_obj.get('code') != 0:
-            return None, f'API error: {res_obj.get("msg")}'
-        return res_obj['data'].get('content', ''), None
+        return _parse_image_response(resp.status_code, resp.text)
     except Exception as e:
         return None, f'Request exception: {str(e)}'
 
+
+async def extract_text_async(image_base64, temperature=0.1, max_tokens=1024, timeout=15):
+    """
+    extract_text 的异步版本，使用共享连接池。
+    """
+    url, params, headers, payload = _build_image_request(
+        image_base64, OCR_PROMPT, {"temperature": temperature, "max_tokens": max_tokens}
+    )
+    try:
+        resp = await get_async_client().post(
+            url, json=payload, headers=headers, params=params, timeout=request_timeout(timeout)
+        )
+        return _parse_image_response(resp.status_code, resp.text)
+    except Exception as e:
+        return None, f'Request exception: {str(e)}'
+
+
 def interpret_image(
     image_base64,
     prompt_text=None,
@@ -85,66 +148,67 @@ def interpret_image(
     """
     使用多模态大模型对图片进行内容理解，返回详细描述。
     """
-    # 处理 base64 字符串格式
-    if not image_base64.startswith('data:image'):
-        # 如果是纯base64，添加前缀
-        clean_base64 = f"data:image/JPEG;base64,{image_base64.strip()}"
-    else:
-        # 如果已经有前缀，保持原样
-        clean_base64 = image_base64.strip()
-    
-    if prompt_text is None:
-        prompt_text = (
-            "不能超过800字.请描述这张图片的全部内容，着重关注和购物有关的内容,要求覆盖以下方面：\n"
-            "1. 主要物体/人物：列出图片中出现的主要物体或人物，并简要说明其特征、动作、姿态、表情等；\n"
-            "2. 场景和环境：描述图片的背景、地点、时间、氛围、色彩等环境信息；\n"
-            "3. 关系与互动：如有多个元素，说明它们之间的关系或互动情况；\n"
-            "4. 其他显著特征：如特殊标志、符号、颜色、光影效果等；\n"
-            "5. 图片整体风格或用途：如是插画、照片、截图、广告等，请说明类型和可能用途。\n"
-            "请按照上述结构分条详细描述，内容尽量全面、具体。\n"
-        )
-    if stop is None:
-        stop = ["</end>"]
-
-    request_id = str(uuid.uuid4())
-    params = {'requestId': request_id}
-    payload = {
-        'requestId': request_id,
-        'sessionId': str(uuid.uuid4()),
-        'model': 'vivo-BlueLM-V-2.0',
-        'messages': [
-            {
-                "role": "user",
-                "content": clean_base64,  # 使用完整的data:image格式
-                "contentType": "image"
-            },
-            {
-                "role": "user",
-                "content": prompt_text,
-                "contentType": "text"
-            }
-        ],
-        'extra': {
-            "temperature": temperature,
-            "top_p": top_p,
-            "top_k": top_k,
-            "max_tokens": max_tokens,
-            "repetition_penalty": repetition_penalty,
-            "stop": stop,
-            "ignore_eos": ignore_eos,
-            "skip_special_tokens": skip_special_tokens
-        }
-    }
-    headers = gen_sign_headers(APP_ID, APP_KEY, METHOD, URI, params)
-    headers['Content-Type'] = 'application/json'
-    url = f'https://{DOMAIN}{URI}'
+    extra = _interpret_extra(temperature, top_p, top_k, max_tokens, repetition_penalty, stop, ignore_eos, skip_special_tokens)
+    url, params, headers, payload = _build_image_request(
+        image_base64, prompt_text if prompt_text is not None else DEFAULT_INTERPRET_PROMPT, extra
+    )
     try:
         resp = requests.post(url, json=payload, headers=headers, params=params, timeout=timeout)
-        if resp.status_code != 200:
-            return None, f'HTTP error: {resp.status_code} - {resp.text}'
-        res_obj = resp.json()
-        if res_obj.get('code') != 0:
-            return None, f'API error: {res_obj.get("msg")}'
-        return res_obj['data'].get('content', ''), None
+        return _parse_image_response(resp.status_code, resp.text)
+    except Exception as e:
+        return None, f'Request exception: {str(e)}'
+
+
+async def interpret_image_async(
+    image_base64,
+    prompt_text=None,
+    temperature=0.9,
+    top_p=0.7,
+    top_k=50,
+    max_tokens=1024,
+    repetition_penalty=1.02,
+    stop=None,
+    ignore_eos=False,
+    skip_special_tokens=True,
+    timeout=200
+):
+    """
+    interpret_image 的异步版本，使用共享连接池。
+    """
+    extra = _interpret_extra(temperature, top_p, top_k, max_tokens, repetition_penalty, stop, ignore_eos, skip_special_tokens)
+    url, params, headers, payload = _build_image_request(
+        image_base64, prompt_text if prompt_text is not None else DEFAULT_INTERPRET_PROMPT, extra
+    )
+    try:
+        resp = await get_async_client().post(
+            url, json=payload, headers=headers, params=params, timeout=request_timeout(timeout)
+        )
+        return _parse_image_response(resp.status_code, resp.text)
     except Exception as e:
-        return None, f'Request exception: {str(e)}'
\ No newline at end of file
+        return None, f'Request exception: {str(e)}'
+
+
+async def analyze_images_async(images, max_concurrency=IMAGE_MAX_CONCURRENCY):
+    """
+    对多张图片同时执行 OCR 与图片理解，所有调用并发发出，并发数受 max_concurrency 限制。
+    返回与 images 顺序一致的列表，每项为
+    {"ocr_text", "ocr_error", "description", "description_error"}。
+    """
+    factories = []
+    for image_base64 in images:
+        factories.append(lambda img=image_base64: extract_text_async(img, temperature=0.1))
+        factories.append(lambda img=image_base64: interpret_image_async(img, temperature=0.9))
+
+    outcomes = await gather_limited(factories, max_concurrency)
+
+    results = []
+    for i in range(len(images)):
+        ocr_text, ocr_error = outcomes[2 * i]
+        description, description_error = outcomes[2 * i + 1]
+        results.append({
+            "ocr_text": ocr_text,
+            "ocr_error": ocr_error,
+            "description": description,
+            "description_error": description_error,
+        })
+    return results
@@ -0,0 +1,285 @@
+# build_knowledge_base.py
+# 离线向量化流水线：knowledge_base/*.json -> 去重（精确 + 近重复文本） -> 并发批量调用 Embedding API
+#                   -> 向量近重复去重 -> 编译知识库
+#
+# 用法:
+#   python build_knowledge_base.py
+#   python build_knowledge_base.py --sources knowledge_base/knowledge_1.json knowledge_base/knowledge_2.json \
+#                                  --output knowledge_base_embeddings/compiled --batch-size 64 --concurrency 8
+#   # 进程中断后用同样的参数重新运行即可从检查点继续；--restart 丢弃检查点重新开始
+#
+# 需要与服务端相同的 VIVO_APP_ID / VIVO_APP_KEY / RAG_API_DOMAIN / RAG_API_URI 环境变量。
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import asyncio
+import hashlib
+import argparse
+import logging
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from rag import VivoEmbeddingClient
+from embedding_cache import normalize_text
+from compiled_index import write_compiled_index, DEFAULT_RISK_TYPE
+from compile_knowledge import make_extra_writer, add_index_arguments
+from dedup import deduplicate, deduplicate_vectors, add_dedup_arguments
+from vector_index import normalize_rows
+from concurrency import gather_limited
+from http_client import close_async_client
+
+# 加载环境变量
+load_dotenv()
+
+DEFAULT_SOURCES = "knowledge_base/*.json"
+DEFAULT_OUTPUT = "knowledge_base_embeddings/compiled"
+DEFAULT_CHECKPOINT_DIR = "knowledge_base_embeddings/build_checkpoint"
+
+logger = logging.getLogger("build_knowledge_base")
+
+
+def iter_json_array(path: str, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """按块读取顶层为数组的 JSON 文件，逐个产出数组元素，不把整个文件解析为一个列表"""
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+        started = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                if eof:
+                    raise ValueError(f"{path} 不是完整的 JSON 数组")
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"{path} 的顶层不是 JSON 数组")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise ValueError(f"{path} 在第 {pos} 个字符附近不是有效的 JSON")
+                # 当前元素跨越了块边界，读取更多数据后重试
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            yield item
+
+
+def load_sources(paths: List[str]) -> Tuple[List[str], List[str], dict]:
+    """流式读取所有源文件并按归一化文本去重，返回 (texts, risk_types, 统计信息)"""
+    texts, risk_types = [], []
+    seen = {}
+    stats = {"read": 0, "invalid": 0, "duplicates": 0, "conflicting_labels": 0}
+    for path in paths:
+        for item in iter_json_array(path):
+            stats["read"] += 1
+            if not isinstance(item, dict) or not str(item.get("text", "")).strip():
+                stats["invalid"] += 1
+                continue
+            text = str(item["text"]).strip()
+            risk_type = item.get("riskType") or DEFAULT_RISK_TYPE
+            key = hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=16).digest()
+            if key in seen:
+                stats["duplicates"] += 1
+                if risk_types[seen[key]] != risk_type:
+                    stats["conflicting_labels"] += 1
+                continue
+            seen[key] = len(texts)
+            texts.append(text)
+            risk_types.append(risk_type)
+    return texts, risk_types, stats
+
+
+class CheckpointStore:
+    """
+    按批次保存向量的检查点目录。manifest 记录输入文本的摘要与批大小，
+    输入变化时检查点自动失效；每个批次原子写入一个 .npy 文件。
+    """
+
+    def __init__(self, path: str, fingerprint: str, restart: bool = False):
+        self.path = path
+        manifest_path = os.path.join(path, "manifest.json")
+        if os.path.exists(manifest_path) and not restart:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                if json.load(f).get("fingerprint") != fingerprint:
+                    logger.info("输入或参数已变化，丢弃旧的检查点")
+                    restart = True
+        if restart:
+            shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": fingerprint}, f)
+
+    def _batch_path(self, batch_id: int) -> str:
+        return os.path.join(self.path, f"batch_{batch_id:06d}.npy")
+
+    def has(self, batch_id: int) -> bool:
+        return os.path.exists(self._batch_path(batch_id))
+
+    def save(self, batch_id: int, vectors: np.ndarray):
+        tmp_path = self._batch_path(batch_id) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, vectors)
+        os.replace(tmp_path, self._batch_path(batch_id))
+
+    def load(self, batch_id: int) -> np.ndarray:
+        return np.load(self._batch_path(batch_id))
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def fingerprint_inputs(texts: List[str], batch_size: int, model_name: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{model_name}\0{batch_size}\0{len(texts)}\0".encode("utf-8"))
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+async def embed_batch(client: VivoEmbeddingClient, sentences: List[str], retries: int, timeout: float) -> np.ndarray:
+    """调用一次 Embedding API，失败或返回数量不符时按指数退避重试"""
+    for attempt in range(retries + 1):
+        vectors = await client.get_embeddings_async(sentences, timeout=timeout)
+        if len(vectors) == len(sentences):
+            return np.asarray(vectors, dtype=np.float32)
+        if attempt < retries:
+            delay = min(30.0, 2 ** attempt)
+            logger.warning(f"批次向量化失败（第 {attempt + 1} 次），{delay:.0f} 秒后重试")
+            await asyncio.sleep(delay)
+    raise RuntimeError(f"批次向量化在重试 {retries} 次后仍然失败")
+
+
+async def embed_all(client: VivoEmbeddingClient, texts: List[str], checkpoint: CheckpointStore,
+                    batch_size: int, concurrency: int, retries: int, timeout: float) -> np.ndarray:
+    batch_count = (len(texts) + batch_size - 1) // batch_size
+    todo = [b for b in range(batch_count) if not checkpoint.has(b)]
+    if len(todo) < batch_count:
+        logger.info(f"从检查点继续: 已完成 {batch_count - len(todo)}/{batch_count} 个批次")
+
+    start_time = time.time()
+    done = 0
+
+    async def run(batch_id: int):
+        nonlocal done
+        sentences = texts[batch_id * batch_size:(batch_id + 1) * batch_size]
+        checkpoint.save(batch_id, await embed_batch(client, sentences, retries, timeout))
+        done += 1
+        if done % 20 == 0 or done == len(todo):
+            elapsed = time.time() - start_time
+            logger.info(f"向量化进度: {done}/{len(todo)} 个批次, {done * batch_size / max(elapsed, 1e-6):.0f} 条/秒")
+
+    await gather_limited([lambda b=b: run(b) for b in todo], concurrency)
+    return np.concatenate([checkpoint.load(b) for b in range(batch_count)])
+
+
+def resolve_sources(patterns: List[str]) -> List[str]:
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern))
+        if not matched:
+            raise ValueError(f"没有匹配 {pattern} 的源文件")
+        paths.extend(matched)
+    return paths
+
+
+async def build(args) -> dict:
+    app_id, app_key = os.getenv("VIVO_APP_ID"), os.getenv("VIVO_APP_KEY")
+    domain, uri = os.getenv("RAG_API_DOMAIN"), os.getenv("RAG_API_URI")
+    if not all([app_id, app_key, domain, uri]):
+        raise ValueError("缺少 VIVO_APP_ID / VIVO_APP_KEY / RAG_API_DOMAIN / RAG_API_URI 环境变量")
+
+    start_time = time.time()
+    sources = resolve_sources(args.sources)
+    texts, risk_types, stats = load_sources(sources)
+    logger.info(
+        f"读取 {len(sources)} 个源文件: {stats['read']} 条, 无效 {stats['invalid']} 条, "
+        f"重复 {stats['duplicates']} 条（其中标签冲突 {stats['conflicting_labels']} 条）, 待向量化 {len(texts)} 条"
+    )
+    if not texts:
+        raise ValueError("没有可向量化的文本")
+    duplicate_counts = None
+    if args.dedup_threshold > 0:
+        # 字面上几乎相同的文本在向量化之前合并，不再为它们调用 Embedding API
+        keep, duplicate_counts = deduplicate(texts, risk_types, args.dedup_threshold)
+        texts, risk_types = [texts[i] for i in keep], [risk_types[i] for i in keep]
+
+    client = VivoEmbeddingClient(app_id=app_id, app_key=app_key, domain=domain, uri=uri)
+    checkpoint = CheckpointStore(
+        args.checkpoint_dir, fingerprint_inputs(texts, args.batch_size, client.model_name), args.restart
+    )
+    try:
+        vectors = await embed_all(
+            client, texts, checkpoint, args.batch_size, args.concurrency, args.retries, args.timeout
+        )
+    finally:
+        await close_async_client()
+
+    if args.dedup_embedding_threshold > 0:
+        keep, duplicate_counts = deduplicate_vectors(
+            normalize_rows(vectors), risk_types, args.dedup_embedding_threshold, duplicate_counts
+        )
+        texts, risk_types, vectors = [texts[i] for i in keep], [risk_types[i] for i in keep], vectors[keep]
+
+    extra_writer = make_extra_writer(
+        len(texts), args.ivf_lists, args.ivf_nprobe, args.ivf_iterations, args.quantize, args.rerank_factor
+    )
+    meta = write_compiled_index(
+        args.output, texts, risk_types, vectors, extra_writer=extra_writer, duplicate_counts=duplicate_counts
+    )
+    if not args.keep_checkpoint:
+        checkpoint.remove()
+    logger.info(f"知识库构建完成，用时 {time.time() - start_time:.1f} 秒")
+    return meta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="向量化 knowledge_base/*.json 并直接生成编译知识库")
+    parser.add_argument("--sources", nargs="+", default=[DEFAULT_SOURCES],
+                        help=f"源 JSON 文件或通配符 (默认: {DEFAULT_SOURCES})")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help=f"编译知识库输出目录 (默认: {DEFAULT_OUTPUT})")
+    parser.add_argument("--checkpoint-dir", default=DEFAULT_CHECKPOINT_DIR,
+                        help=f"检查点目录 (默认: {DEFAULT_CHECKPOINT_DIR})")
+    parser.add_argument("--batch-size", type=int, default=64, help="每次 Embedding API 调用的句子数 (默认: 64)")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的 API 调用数 (默认: 8)")
+    parser.add_argument("--retries", type=int, default=5, help="单个批次的最大重试次数 (默认: 5)")
+    parser.add_argument("--timeout", type=float, default=60, help="单次 API 调用超时秒数 (默认: 60)")
+    parser.add_argument("--restart", action="store_true", help="丢弃已有检查点重新开始")
+    parser.add_argument("--keep-checkpoint", action="store_true", help="构建完成后保留检查点目录")
+    add_index_arguments(parser)
+    add_dedup_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    try:
+        meta = asyncio.run(build(args))
+    except (OSError, ValueError, RuntimeError) as e:
+        logger.error(f"构建失败: {e}")
+        return 1
+    print(
+        f"已构建 {meta['count']} 条知识 (去重前 {meta['source_entries']} 条, 维度 {meta['dim']}, "
+        f"风险类型 {len(meta['risk_types'])} 种) -> {args.output}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
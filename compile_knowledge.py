@@ -0,0 +1,189 @@
+# compile_knowledge.py
+# 把 all_knowledge_embeddings.json 转换为可内存映射的编译知识库（格式见 compiled_index.py）
+#
+# 用法:
+#   python compile_knowledge.py
+#   python compile_knowledge.py --input knowledge_base_embeddings/all_knowledge_embeddings.json \
+#                               --output knowledge_base_embeddings/compiled
+#   # 同时构建 IVF 近似检索索引（0 表示不构建，auto 表示按 4*sqrt(N) 个簇）
+#   python compile_knowledge.py --ivf-lists auto --ivf-nprobe 8
+#   # 同时写入量化向量（int8 或 float16），并报告相对精确检索的召回率
+#   python compile_knowledge.py --quantize int8
+#   # 近重复去重（默认开启），阈值为 0 时关闭对应阶段
+#   python compile_knowledge.py --dedup-threshold 0.8 --dedup-embedding-threshold 0.97
+import argparse
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+
+from compiled_index import write_compiled_index, DEFAULT_RISK_TYPE
+from vector_index import DenseVectorIndex, IVFIndex, QuantizedVectorIndex, measure_recall, normalize_rows
+from dedup import (
+    deduplicate, deduplicate_vectors, add_dedup_arguments,
+    KNOWLEDGE_DEDUP_THRESHOLD, KNOWLEDGE_DEDUP_EMBEDDING_THRESHOLD,
+)
+
+DEFAULT_INPUT = "knowledge_base_embeddings/all_knowledge_embeddings.json"
+DEFAULT_OUTPUT = "knowledge_base_embeddings/compiled"
+
+# 评估 IVF 召回率时抽样的查询数与 k
+RECALL_SAMPLE_QUERIES = 200
+RECALL_K = 10
+
+logger = logging.getLogger("compile_knowledge")
+
+
+def _resolve_ivf_lists(value: str, count: int) -> int:
+    if value == "auto":
+        return max(1, int(4 * np.sqrt(count)))
+    return int(value)
+
+
+def build_ivf(path: str, normalized: np.ndarray, nlist: int, nprobe: int, iterations: int) -> IVFIndex:
+    """构建 IVF 索引写入 path，并以知识库中抽样的向量为查询报告相对精确检索的召回率"""
+    start_time = time.time()
+    ivf = IVFIndex.build(normalized, nlist, nprobe=nprobe, iterations=iterations)
+    ivf.save(path)
+
+    sample = _recall_sample(normalized)
+    exact = DenseVectorIndex(normalized, normalized=True)
+    recall = measure_recall(exact, ivf, sample, RECALL_K)
+    logger.info(
+        f"IVF 索引: {ivf.nlist} 个簇, nprobe={nprobe}, recall@{RECALL_K}={recall:.3f}, "
+        f"用时 {time.time() - start_time:.2f} 秒"
+    )
+    return ivf
+
+
+def _recall_sample(normalized: np.ndarray) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return normalized[rng.choice(len(normalized), min(RECALL_SAMPLE_QUERIES, len(normalized)), replace=False)]
+
+
+def build_quantized(path: str, normalized: np.ndarray, storage: str, rerank_factor: int) -> QuantizedVectorIndex:
+    """写入量化向量，并报告量化打分与 float32 重排后相对精确检索的召回率"""
+    quantized = QuantizedVectorIndex.from_normalized(normalized, storage)
+    quantized.save(path)
+
+    sample = _recall_sample(normalized)
+    exact = DenseVectorIndex(normalized, normalized=True)
+    recall = measure_recall(exact, quantized, sample, RECALL_K)
+    quantized.rerank_vectors, quantized.rerank_factor = normalized, rerank_factor
+    rerank_recall = measure_recall(exact, quantized, sample, RECALL_K)
+    quantized.rerank_vectors = None
+    logger.info(
+        f"{storage} 量化向量: {quantized.nbytes / 1024 / 1024:.1f} MB "
+        f"(float32 为 {normalized.nbytes / 1024 / 1024:.1f} MB), recall@{RECALL_K}={recall:.4f}, "
+        f"float32 重排 (x{rerank_factor}) 后 recall@{RECALL_K}={rerank_recall:.4f}"
+    )
+    return quantized
+
+
+def make_extra_writer(count: int, ivf_lists: str = "0", ivf_nprobe: int = 8, ivf_iterations: int = 10,
+                      quantize: str = "none", rerank_factor: int = 4):
+    """返回供 write_compiled_index 使用的附加索引写入函数（IVF / 量化向量）"""
+    nlist = _resolve_ivf_lists(ivf_lists, count)
+
+    def extra_writer(path, normalized):
+        if nlist > 0:
+            build_ivf(path, normalized, nlist, ivf_nprobe, ivf_iterations)
+        if quantize != "none":
+            build_quantized(path, normalized, quantize, rerank_factor)
+
+    return extra_writer
+
+
+def add_index_arguments(parser: argparse.ArgumentParser):
+    """IVF / 量化相关的命令行参数，compile_knowledge.py 与 build_knowledge_base.py 共用"""
+    parser.add_argument("--ivf-lists", default="0", help="IVF 簇数，0 表示不构建，auto 表示 4*sqrt(N) (默认: 0)")
+    parser.add_argument("--ivf-nprobe", type=int, default=8, help="IVF 默认探查的簇数 (默认: 8)")
+    parser.add_argument("--ivf-iterations", type=int, default=10, help="k-means 迭代次数 (默认: 10)")
+    parser.add_argument("--quantize", choices=["none", "int8", "float16"], default="none",
+                        help="额外写入的量化向量格式 (默认: none)")
+    parser.add_argument("--rerank-factor", type=int, default=4, help="评估量化召回率时 float32 重排的候选倍数 (默认: 4)")
+
+
+def compile_knowledge(input_path: str, output_path: str, ivf_lists: str = "0", ivf_nprobe: int = 8,
+                      ivf_iterations: int = 10, quantize: str = "none", rerank_factor: int = 4,
+                      dedup_threshold: float = KNOWLEDGE_DEDUP_THRESHOLD,
+                      dedup_embedding_threshold: float = KNOWLEDGE_DEDUP_EMBEDDING_THRESHOLD) -> dict:
+    start_time = time.time()
+    with open(input_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError(f"{input_path} 的内容不是一个列表")
+
+    texts, risk_types = [], []
+    dim = None
+    valid = []
+    for i, entry in enumerate(data):
+        if not isinstance(entry, dict) or "text" not in entry or not isinstance(entry.get("embedding"), list):
+            logger.warning(f"条目 {i} 不是字典或缺少 'text'/'embedding' 键，已跳过")
+            continue
+        embedding = entry["embedding"]
+        if dim is None:
+            dim = len(embedding)
+        elif len(embedding) != dim:
+            logger.warning(f"条目 {i} 的向量维度 ({len(embedding)}) 与预期 ({dim}) 不符，已跳过")
+            continue
+        texts.append(str(entry["text"]))
+        risk_types.append(entry.get("riskType") or DEFAULT_RISK_TYPE)
+        valid.append(embedding)
+
+    if not valid:
+        raise ValueError(f"{input_path} 中没有有效的知识库条目")
+
+    try:
+        vectors = np.asarray(valid, dtype=np.float32)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"向量中包含非数值元素: {e}")
+    del data, valid
+
+    duplicate_counts = None
+    if dedup_threshold > 0:
+        keep, duplicate_counts = deduplicate(texts, risk_types, dedup_threshold)
+        texts, risk_types, vectors = [texts[i] for i in keep], [risk_types[i] for i in keep], vectors[keep]
+    if dedup_embedding_threshold > 0:
+        keep, duplicate_counts = deduplicate_vectors(
+            normalize_rows(vectors), risk_types, dedup_embedding_threshold, duplicate_counts
+        )
+        texts, risk_types, vectors = [texts[i] for i in keep], [risk_types[i] for i in keep], vectors[keep]
+
+    extra_writer = make_extra_writer(len(texts), ivf_lists, ivf_nprobe, ivf_iterations, quantize, rerank_factor)
+    meta = write_compiled_index(
+        output_path, texts, risk_types, vectors, source=input_path, extra_writer=extra_writer,
+        duplicate_counts=duplicate_counts,
+    )
+    logger.info(f"编译完成，用时 {time.time() - start_time:.2f} 秒")
+    return meta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="将知识库 JSON 编译为可内存映射的二进制格式")
+    parser.add_argument("--input", default=DEFAULT_INPUT, help=f"知识库 JSON 文件 (默认: {DEFAULT_INPUT})")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help=f"输出目录 (默认: {DEFAULT_OUTPUT})")
+    add_index_arguments(parser)
+    add_dedup_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    try:
+        meta = compile_knowledge(
+            args.input, args.output, args.ivf_lists, args.ivf_nprobe, args.ivf_iterations,
+            args.quantize, args.rerank_factor, args.dedup_threshold, args.dedup_embedding_threshold,
+        )
+    except (OSError, ValueError) as e:
+        logger.error(f"编译失败: {e}")
+        return 1
+    print(
+        f"已编译 {meta['count']} 条知识 (去重前 {meta['source_entries']} 条, 维度 {meta['dim']}, "
+        f"风险类型 {len(meta['risk_types'])} 种) -> {args.output}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+# compiled_index.py
+# 知识库编译格式：向量矩阵 + 文本/风险类型侧表，均可通过 np.memmap 打开，多个 worker 共享操作系统页缓存
+#
+# 目录结构:
+#   meta.json          版本、条目数、向量维度、风险类型名称表、各风险类型的行区间、源文件信息
+#   vectors.npy        (N, d) float32，已按行 L2 归一化
+#   texts.bin          所有文本的 UTF-8 字节顺序拼接
+#   text_offsets.npy   (N + 1,) int64，第 i 条文本为 texts.bin[offsets[i]:offsets[i + 1]]
+#   risk_ids.npy       (N,) int16，风险类型在 meta.json 中 risk_types 列表里的下标
+#   dup_counts.npy     （可选）(N,) int32，近重复去重后每条代表的原始条目数，见 dedup.py
+#   ivf_*.npy          （可选）IVF 近似检索索引，见 vector_index.IVFIndex
+#   lex_*              BM25 倒排索引，见 lexical_index.LexicalIndex
+#
+# 条目按风险类型分组存储（组内保持输入顺序），meta.json 的 partitions 记录每个风险类型的 [起始行, 结束行)，
+# 按风险类型过滤的检索只需对向量矩阵的一个连续切片打分。
+#
+# 重新编译时先写入临时目录再整体替换；替换期间持有同级的 .<目录名>.lock 排他锁，打开时持有共享锁。
+import os
+import json
+import time
+import shutil
+import logging
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，替换时不加锁
+    fcntl = None
+
+from vector_index import normalize_rows, IVFIndex, RowPartitions
+from lexical_index import LexicalIndex
+
+logger = logging.getLogger(__name__)
+
+COMPILED_FORMAT_VERSION = 1
+DEFAULT_RISK_TYPE = "未知风险"
+
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.npy"
+TEXTS_FILE = "texts.bin"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+RISK_IDS_FILE = "risk_ids.npy"
+DUP_COUNTS_FILE = "dup_counts.npy"
+
+
+class TextTable:
+    """按下标惰性解码的文本表，底层为内存映射的 UTF-8 字节与偏移量数组"""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        return self._data[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class RiskTypeTable:
+    """风险类型表：每条记录只保存一个小整数下标，名称在 meta.json 中只保存一份"""
+
+    def __init__(self, ids: np.ndarray, names: List[str], partitions: Optional[RowPartitions] = None):
+        self.ids = ids
+        self.names = names
+        self.partitions = partitions if partitions is not None else RowPartitions.from_ids(ids, names)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> str:
+        return self.names[int(self.ids[i])]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class CompiledKnowledge:
+    """一个已打开的编译知识库，vectors 为只读内存映射"""
+
+    def __init__(self, path: str, meta: dict, vectors: np.ndarray, texts: TextTable, risk_types: RiskTypeTable,
+                 ivf: Optional[IVFIndex] = None, lexical: Optional[LexicalIndex] = None,
+                 duplicate_counts: Optional[np.ndarray] = None):
+        self.path = path
+        self.meta = meta
+        self.vectors = vectors
+        self.texts = texts
+        self.risk_types = risk_types
+        self.ivf = ivf
+        self.lexical = lexical
+        # 每条代表的原始条目数，未去重时为 None
+        self.duplicate_counts = duplicate_counts
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+
+@contextmanager
+def _swap_lock(path: str, exclusive: bool):
+    """目录整体替换的跨进程文件锁：替换持有排他锁，打开持有共享锁，打开方不会在两次 rename 之间看到目录不存在"""
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    if fcntl is None or not os.path.isdir(parent):
+        yield
+        return
+    try:
+        lock_file = open(os.path.join(parent, f".{os.path.basename(path)}.lock"), "a")
+    except OSError:  # 只读目录等情况下不加锁
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_compiled_index(
+    out_dir: str,
+    texts: Sequence[str],
+    risk_types: Sequence[str],
+    vectors: np.ndarray,
+    source: Optional[str] = None,
+    extra_writer: Optional[Callable[[str, np.ndarray], None]] = None,
+    duplicate_counts: Optional[Sequence[int]] = None,
+) -> dict:
+    """
+    把知识库写成编译格式。先写入临时目录，再持排他锁整体替换 out_dir，
+    正在运行的进程不会读到写了一半的文件，也不会在替换间隙因目录不存在而回退到 JSON。返回写入的 meta。
+    extra_writer(tmp_dir, normalized_vectors) 可在替换前向目录追加附加索引文件。
+    duplicate_counts 为近重复去重后每条代表的原始条目数。
+    """
+    if len(texts) != vectors.shape[0] or len(risk_types) != vectors.shape[0]:
+        raise ValueError(f"文本数 {len(texts)}、风险类型数 {len(risk_types)} 与向量数 {vectors.shape[0]} 不一致")
+
+    names: List[str] = []
+    name_ids = {}
+    risk_ids = np.empty(len(risk_types), dtype=np.int16)
+    for i, name in enumerate(risk_types):
+        name = name or DEFAULT_RISK_TYPE
+        if name not in name_ids:
+            name_ids[name] = len(names)
+            names.append(name)
+        risk_ids[i] = name_ids[name]
+
+    # 按风险类型分组，使每个风险类型占据一段连续的行
+    order = np.argsort(risk_ids, kind="stable")
+    if np.any(order != np.arange(len(order))):
+        texts = [texts[i] for i in order]
+        risk_ids = risk_ids[order]
+        vectors = np.asarray(vectors)[order]
+        if duplicate_counts is not None:
+            duplicate_counts = np.asarray(duplicate_counts)[order]
+    bounds = np.searchsorted(risk_ids, np.arange(len(names) + 1))
+    partitions = {name: [int(bounds[i]), int(bounds[i + 1])] for i, name in enumerate(names)}
+
+    out_dir = os.path.abspath(out_dir)
+    tmp_dir = f"{out_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    normalized = normalize_rows(vectors)
+    np.save(os.path.join(tmp_dir, VECTORS_FILE), normalized)
+
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    with open(os.path.join(tmp_dir, TEXTS_FILE), "wb") as f:
+        for i, text in enumerate(texts):
+            encoded = str(text).encode("utf-8")
+            f.write(encoded)
+            offsets[i + 1] = offsets[i] + len(encoded)
+    np.save(os.path.join(tmp_dir, TEXT_OFFSETS_FILE), offsets)
+    LexicalIndex.build(texts).save(tmp_dir)
+    np.save(os.path.join(tmp_dir, RISK_IDS_FILE), risk_ids)
+    if duplicate_counts is not None:
+        np.save(os.path.join(tmp_dir, DUP_COUNTS_FILE), np.asarray(duplicate_counts, dtype=np.int32))
+
+    meta = {
+        "version": COMPILED_FORMAT_VERSION,
+        "count": int(vectors.shape[0]),
+        "dim": int(vectors.shape[1]),
+        "normalized": True,
+        "risk_types": names,
+        "partitions": partitions,
+        "source_entries": int(np.sum(duplicate_counts)) if duplicate_counts is not None else int(vectors.shape[0]),
+        "created_at": int(time.time()),
+    }
+    if source and os.path.exists(source):
+        stat = os.stat(source)
+        meta["source"] = {"path": os.path.abspath(source), "size": stat.st_size, "mtime": stat.st_mtime}
+    with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    if extra_writer is not None:
+        extra_writer(tmp_dir, normalized)
+    del normalized
+
+    old_dir = f"{out_dir}.old-{os.getpid()}"
+    # 首次写入只有一次 rename，不需要加锁（增量段目录也不会留下锁文件）
+    with _swap_lock(out_dir, exclusive=True) if os.path.exists(out_dir) else nullcontext():
+        if os.path.exists(out_dir):
+            os.rename(out_dir, old_dir)
+        os.rename(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    logger.info(f"已写入编译知识库 {out_dir}: {meta['count']} 条, 维度 {meta['dim']}")
+    return meta
+
+
+def open_compiled_index(path: str, lock: bool = True) -> Optional[CompiledKnowledge]:
+    """
+    以内存映射方式打开编译知识库；目录不存在或格式不符时返回 None。
+    默认持共享锁打开，与 write_compiled_index 的整体替换互斥；调用方已通过其他锁与写入方互斥时可传 lock=False。
+    """
+    if not lock:
+        return _open_compiled_index(path)
+    with _swap_lock(path, exclusive=False):
+        return _open_compiled_index(path)
+
+
+def _open_compiled_index(path: str) -> Optional[CompiledKnowledge]:
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != COMPILED_FORMAT_VERSION:
+            logger.error(f"编译知识库 {path} 的格式版本 {meta.get('version')} 不受支持，需要重新编译")
+            return None
+
+        vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        offsets = np.load(os.path.join(path, TEXT_OFFSETS_FILE), mmap_mode="r")
+        risk_ids = np.load(os.path.join(path, RISK_IDS_FILE), mmap_mode="r")
+        texts_path = os.path.join(path, TEXTS_FILE)
+        if os.path.getsize(texts_path) > 0:
+            text_data = np.memmap(texts_path, dtype=np.uint8, mode="r")
+        else:
+            text_data = np.empty(0, dtype=np.uint8)
+
+        count = meta["count"]
+        if vectors.shape != (count, meta["dim"]) or len(offsets) != count + 1 or len(risk_ids) != count:
+            logger.error(f"编译知识库 {path} 的文件与 meta.json 不一致，需要重新编译")
+            return None
+
+        ivf = IVFIndex.load(path)
+        if ivf is not None and (len(ivf) != count or ivf.dim != meta["dim"]):
+            logger.error(f"编译知识库 {path} 中的 IVF 索引与向量不一致，已忽略")
+            ivf = None
+
+        lexical = LexicalIndex.load(path)
+        if lexical is not None and len(lexical) != count:
+            logger.error(f"编译知识库 {path} 中的倒排索引与条目数不一致，已忽略")
+            lexical = None
+
+        duplicate_counts = None
+        if os.path.exists(os.path.join(path, DUP_COUNTS_FILE)):
+            duplicate_counts = np.load(os.path.join(path, DUP_COUNTS_FILE), mmap_mode="r")
+            if len(duplicate_counts) != count:
+                logger.error(f"编译知识库 {path} 中的去重计数与条目数不一致，已忽略")
+                duplicate_counts = None
+    except Exception as e:
+        logger.error(f"打开编译知识库 {path} 失败: {e}")
+        return None
+
+    source = meta.get("source")
+    if source and os.path.exists(source["path"]) and os.stat(source["path"]).st_mtime > source["mtime"]:
+        logger.warning(f"源文件 {source['path']} 在编译之后被修改过，请重新运行 compile_knowledge.py")
+
+    ivf_info = f", IVF {ivf.nlist} 个簇" if ivf is not None else ""
+    logger.info(f"已内存映射编译知识库 {path}: {count} 条, 维度 {meta['dim']}{ivf_info}")
+    if "partitions" in meta:
+        partitions = RowPartitions.from_ranges(meta["partitions"])
+    else:
+        logger.info(f"编译知识库 {path} 未按风险类型分组，按风险类型过滤的检索需要按行读取（重新编译可改善）")
+        partitions = RowPartitions.from_ids(risk_ids, meta["risk_types"])
+    return CompiledKnowledge(
+        path, meta, vectors, TextTable(text_data, offsets),
+        RiskTypeTable(risk_ids, meta["risk_types"], partitions), ivf, lexical, duplicate_counts
+    )
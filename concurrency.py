@@ -0,0 +1,89 @@
+# concurrency.py
+# 异步并发辅助工具
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+async def gather_limited(factories: List[Callable[[], Awaitable[Any]]], limit: int) -> List[Any]:
+    """
+    并发执行一组协程工厂，同时运行的数量不超过 limit，结果按输入顺序返回。
+    使用工厂而不是协程对象，避免排队中的协程在超过上限时被提前创建。
+    """
+    if not factories:
+        return []
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(factory):
+        async with semaphore:
+            return await factory()
+
+    return await asyncio.gather(*(run(factory) for factory in factories))
+
+
+
+class MicroBatcher:
+    """
+    把并发到达的单个请求合并为批次：批次达到 max_batch_size 或第一个请求等待满 max_wait_ms 时，
+    调用一次 batch_fn(items)，再把返回列表中的结果按顺序分发给各个等待者。
+    batch_fn 抛出异常时，该批次的所有等待者都会收到同一个异常。
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], Awaitable[List[Any]]],
+                 max_batch_size: int = 32, max_wait_ms: float = 5):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._pending: List[tuple] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self._counters = {"batches": 0, "items": 0, "max_batch_size_seen": 0}
+
+    async def submit(self, item: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        # 跳过在等待期间已被取消的请求
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[tuple]):
+        self._counters["batches"] += 1
+        self._counters["items"] += len(batch)
+        self._counters["max_batch_size_seen"] = max(self._counters["max_batch_size_seen"], len(batch))
+        try:
+            results = await self.batch_fn([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"批处理函数返回 {len(results)} 个结果，期望 {len(batch)} 个")
+        except Exception as e:
+            logger.error(f"微批处理失败 ({len(batch)} 个请求): {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        batches = self._counters["batches"]
+        return {
+            **self._counters,
+            "avg_batch_size": round(self._counters["items"] / batches, 2) if batches else 0.0,
+        }
@@ -0,0 +1,184 @@
+# dedup.py
+# 知识库近重复去重：把模板化、几乎相同的对话聚为一类，每类只保留一条代表（最早出现的一条）并记录该类的条目数。
+#
+# 两个阶段：
+#   文本阶段   字符 n-gram 的 MinHash 签名 + LSH 分桶，在向量化之前去掉字面上几乎相同的文本，省去这些 API 调用
+#   向量阶段   同一风险类型内按余弦相似度做 leader 聚类，合并改写过措辞、但语义几乎相同的话术
+#
+# 只在同一风险类型内聚类：同一段话术模板常同时出现在“无风险”与诈骗类别中，区别只在一两句话，不能合并。
+# 阈值为 0 时关闭对应阶段。
+import os
+import re
+import zlib
+import logging
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from embedding_cache import normalize_text
+from vector_index import RowPartitions
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 近重复判定阈值（字符 n-gram 集合的 Jaccard 相似度），0 表示不去重
+KNOWLEDGE_DEDUP_THRESHOLD = float(os.getenv("KNOWLEDGE_DEDUP_THRESHOLD", "0.8"))
+# 向量阶段的余弦相似度阈值，0 表示不做向量去重
+KNOWLEDGE_DEDUP_EMBEDDING_THRESHOLD = float(os.getenv("KNOWLEDGE_DEDUP_EMBEDDING_THRESHOLD", "0.97"))
+
+DEDUP_NGRAM = 3
+# 128 个哈希分为 32 个带、每带 4 行：Jaccard 0.8 的两条文本至少落入同一个桶的概率 > 0.999
+DEDUP_NUM_PERM = 128
+DEDUP_BANDS = 32
+
+# 去掉标点、空白与【坐席】/【客户】等说话人标记后再切分，只比较话术内容
+_SPEAKER_TAG_RE = re.compile(r"【[^】]{1,8}】")
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+_HASH_SEED = 0x5EED
+
+
+def _shingle_hashes(text: str, ngram: int = DEDUP_NGRAM) -> np.ndarray:
+    text = _NON_WORD_RE.sub("", _SPEAKER_TAG_RE.sub("", normalize_text(text).lower()))
+    if len(text) <= ngram:
+        grams = {text}
+    else:
+        grams = {text[i:i + ngram] for i in range(len(text) - ngram + 1)}
+    return np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash_signatures(texts: Sequence[str], num_perm: int = DEDUP_NUM_PERM, ngram: int = DEDUP_NGRAM) -> np.ndarray:
+    """
+    返回 (N, num_perm) uint32 MinHash 签名。哈希族为 multiply-shift：h(x) = ((a * x + b) mod 2^64) >> 32，
+    两条文本签名中相同位置相等的比例是其 n-gram 集合 Jaccard 相似度的无偏估计。
+    """
+    rng = np.random.default_rng(_HASH_SEED)
+    a = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+    shift = np.uint64(32)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for i, text in enumerate(texts):
+        hashes = _shingle_hashes(text, ngram)
+        signatures[i] = ((hashes[:, None] * a + b) >> shift).min(axis=0)
+    return signatures
+
+
+class _UnionFind:
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+
+    def find(self, x: int) -> int:
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x: int, y: int):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            # 以下标较小（更早出现）的条目为根，它就是该类的代表
+            self.parent[max(x, y)] = min(x, y)
+
+
+def near_duplicate_clusters(texts: Sequence[str], risk_types: Optional[Sequence[str]] = None,
+                            threshold: float = KNOWLEDGE_DEDUP_THRESHOLD,
+                            num_perm: int = DEDUP_NUM_PERM, bands: int = DEDUP_BANDS) -> np.ndarray:
+    """返回每条文本所属类的代表下标（代表为类中最早出现的条目）"""
+    n = len(texts)
+    if n == 0 or threshold <= 0:
+        return np.arange(n)
+    if num_perm % bands:
+        raise ValueError(f"num_perm ({num_perm}) 必须能被 bands ({bands}) 整除")
+    signatures = minhash_signatures(texts, num_perm)
+    rows = num_perm // bands
+    min_agree = threshold * num_perm
+    label_ids = {}
+    labels = [label_ids.setdefault(risk_type, len(label_ids)) for risk_type in risk_types] if risk_types else [0] * n
+
+    clusters = _UnionFind(n)
+    for band in range(bands):
+        buckets = {}
+        band_keys = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        for i in range(n):
+            key = (labels[i], band_keys[i].tobytes())
+            first = buckets.setdefault(key, i)
+            if first == i:
+                continue
+            # 与桶中第一条比较即可：相似关系通过并查集传递
+            if clusters.find(first) != clusters.find(i) and np.count_nonzero(signatures[first] == signatures[i]) >= min_agree:
+                clusters.union(first, i)
+    return np.fromiter((clusters.find(i) for i in range(n)), dtype=np.int64, count=n)
+
+
+def embedding_clusters(normalized: np.ndarray, risk_types: Optional[Sequence[str]] = None,
+                       threshold: float = KNOWLEDGE_DEDUP_EMBEDDING_THRESHOLD,
+                       block_rows: int = 1024) -> np.ndarray:
+    """
+    按余弦相似度做 leader 聚类，返回每条向量所属类的代表下标。按顺序处理每个风险类型内的条目：
+    与某个已有代表的相似度不低于 threshold 时归入最早的那一类，否则成为新的代表。
+    与并查集不同，类中每条都与代表直接相似，不会沿着一串两两相似的条目漂移到无关的内容。
+    normalized 为按行归一化的矩阵，分块计算相似度，每个风险类型的开销为 O(n^2 d)。
+    """
+    n = normalized.shape[0]
+    roots = np.arange(n)
+    if n == 0 or threshold <= 0:
+        return roots
+    partitions = RowPartitions.from_labels(risk_types) if risk_types is not None else RowPartitions({"": slice(0, n)})
+    for rows in partitions.rows.values():
+        members = roots[rows]
+        vectors = np.asarray(normalized[members], dtype=np.float32)
+        is_leader = np.zeros(len(members), dtype=bool)
+        for start in range(0, len(members), block_rows):
+            block = vectors[start:start + block_rows]
+            similarities = block @ vectors[:start + len(block)].T
+            for offset in range(len(block)):
+                position = start + offset
+                candidates = np.flatnonzero(similarities[offset, :position] >= threshold)
+                candidates = candidates[is_leader[candidates]]
+                if len(candidates):
+                    roots[members[position]] = members[candidates[0]]
+                else:
+                    is_leader[position] = True
+    return roots
+
+
+def _collapse(roots: np.ndarray, counts: Optional[Sequence[int]], description: str) -> Tuple[np.ndarray, np.ndarray]:
+    n = len(roots)
+    weights = np.ones(n, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+    keep = np.flatnonzero(roots == np.arange(n))
+    totals = np.bincount(roots, weights=weights, minlength=n).astype(np.int64)
+    if len(keep) < n:
+        logger.info(f"近重复去重 ({description}): {n} 条 -> {len(keep)} 条，最大的一类 {int(totals.max())} 条")
+    return keep, totals[keep]
+
+
+def deduplicate(texts: Sequence[str], risk_types: Sequence[str],
+                threshold: float = KNOWLEDGE_DEDUP_THRESHOLD,
+                counts: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    文本阶段去重，返回 (保留的条目下标（升序）, 每条保留条目代表的条目数)。
+    counts 为输入条目各自已代表的条目数（例如对已去重的知识库再次去重），默认每条为 1。
+    """
+    roots = near_duplicate_clusters(texts, risk_types, threshold)
+    return _collapse(roots, counts, f"n-gram Jaccard >= {threshold}")
+
+
+def deduplicate_vectors(normalized: np.ndarray, risk_types: Sequence[str],
+                        threshold: float = KNOWLEDGE_DEDUP_EMBEDDING_THRESHOLD,
+                        counts: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """向量阶段去重，返回值同 deduplicate"""
+    roots = embedding_clusters(normalized, risk_types, threshold)
+    return _collapse(roots, counts, f"余弦相似度 >= {threshold}")
+
+
+def add_dedup_arguments(parser):
+    """去重相关的命令行参数，compile_knowledge.py 与 build_knowledge_base.py 共用"""
+    parser.add_argument("--dedup-threshold", type=float, default=KNOWLEDGE_DEDUP_THRESHOLD,
+                        help=f"文本近重复去重的 n-gram Jaccard 阈值，0 表示不去重 (默认: {KNOWLEDGE_DEDUP_THRESHOLD})")
+    parser.add_argument("--dedup-embedding-threshold", type=float, default=KNOWLEDGE_DEDUP_EMBEDDING_THRESHOLD,
+                        help=f"向量近重复去重的余弦相似度阈值，0 表示不去重 (默认: {KNOWLEDGE_DEDUP_EMBEDDING_THRESHOLD})")
@@ -0,0 +1,223 @@
+# embedding_cache.py
+# 查询向量缓存：进程内 LRU + 可选的 SQLite 持久层（重启后保留，同机多个 worker 共享）
+import os
+import re
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 进程内 LRU 最多缓存的向量条数，0 表示关闭内存层
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+# SQLite 持久层路径，留空表示不启用
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+# 持久层最多保留的向量条数，超过后删除最早写入的条目
+EMBEDDING_CACHE_DISK_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_DISK_MAX_ENTRIES", "1000000"))
+
+# 每写入多少条检查一次持久层容量
+_PRUNE_EVERY = 1000
+# 持久层等待其他 worker 写锁的秒数；读写都在线程池中执行，超时按未命中 / 写入失败处理
+_BUSY_TIMEOUT_SECONDS = 5
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """NFKC 归一化（全角转半角等）并合并空白，使仅有格式差异的同一文本命中同一缓存项"""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def embedding_cache_key(model_name: str, text: str) -> str:
+    return hashlib.blake2b(f"{model_name}\0{normalize_text(text)}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    按 (模型名, 归一化文本) 的哈希缓存 embedding 向量。
+    先查进程内 LRU，未命中再查 SQLite 持久层，命中后回填内存层。
+    内存层与持久层分别加锁，持久层的读写不会让内存层的查询等待。
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        max_entries: int = EMBEDDING_CACHE_SIZE,
+        path: str = EMBEDDING_CACHE_PATH,
+        disk_max_entries: int = EMBEDDING_CACHE_DISK_MAX_ENTRIES,
+    ):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.path = path
+        self.disk_max_entries = disk_max_entries
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._pending_writes = set()
+        self._inserts_since_prune = 0
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(
+                path, timeout=_BUSY_TIMEOUT_SECONDS, check_same_thread=False, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_created ON embeddings(created_at)")
+            logger.info(f"向量缓存持久层已打开: {path}")
+
+    def _memory_put(self, key: str, vector: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _memory_lookup(self, keys: Sequence[str]) -> Tuple[Dict[int, np.ndarray], Dict[str, List[int]]]:
+        """只查内存层，返回 (命中的 {下标: 向量}, 未命中的 {键: [下标]})"""
+        found: Dict[int, np.ndarray] = {}
+        pending: Dict[str, List[int]] = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[i] = vector
+                    self._counters["memory_hits"] += 1
+                else:
+                    pending.setdefault(key, []).append(i)
+        return found, pending
+
+    def _disk_lookup(self, pending: Dict[str, List[int]]) -> Dict[int, np.ndarray]:
+        """查持久层并回填内存层（阻塞调用）；持久层出错时按未命中处理"""
+        found: Dict[int, np.ndarray] = {}
+        try:
+            with self._disk_lock:
+                placeholders = ",".join("?" * len(pending))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", list(pending)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"读取向量缓存持久层失败: {e}")
+            return found
+        with self._lock:
+            for key, blob in rows:
+                vector = np.frombuffer(blob, dtype=np.float32)
+                self._memory_put(key, vector)
+                for i in pending[key]:
+                    found[i] = vector
+                    self._counters["disk_hits"] += 1
+        return found
+
+    def _finish_lookup(self, found: Dict[int, np.ndarray], pending: Dict[str, List[int]]) -> List[int]:
+        missing = sorted(i for indices in pending.values() for i in indices if i not in found)
+        with self._lock:
+            self._counters["misses"] += len(missing)
+        return missing
+
+    def get_many(self, texts: Sequence[str]) -> Tuple[Dict[int, np.ndarray], List[int]]:
+        """返回 (命中的 {下标: 向量}, 未命中的下标列表)"""
+        found, pending = self._memory_lookup([embedding_cache_key(self.model_name, text) for text in texts])
+        if pending and self._conn is not None:
+            found.update(self._disk_lookup(pending))
+        return found, self._finish_lookup(found, pending)
+
+    async def get_many_async(self, texts: Sequence[str]) -> Tuple[Dict[int, np.ndarray], List[int]]:
+        """get_many 的异步版本：内存层在事件循环中查询，持久层查询放到线程池，不因写锁等待阻塞事件循环"""
+        found, pending = self._memory_lookup([embedding_cache_key(self.model_name, text) for text in texts])
+        if pending and self._conn is not None:
+            found.update(await asyncio.to_thread(self._disk_lookup, pending))
+        return found, self._finish_lookup(found, pending)
+
+    def _memory_put_many(self, texts: Sequence[str], vectors: Sequence[np.ndarray]) -> list:
+        rows = []
+        now = time.time()
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = embedding_cache_key(self.model_name, text)
+                vector = np.asarray(vector, dtype=np.float32)
+                self._memory_put(key, vector)
+                rows.append((key, vector.tobytes(), now))
+        return rows
+
+    def _disk_put(self, rows: list):
+        try:
+            with self._disk_lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)", rows
+                )
+                self._inserts_since_prune += len(rows)
+                if self._inserts_since_prune >= _PRUNE_EVERY:
+                    self._inserts_since_prune = 0
+                    self._prune()
+        except sqlite3.Error as e:
+            logger.warning(f"写入向量缓存持久层失败: {e}")
+
+    def put_many(self, texts: Sequence[str], vectors: Sequence[np.ndarray]):
+        rows = self._memory_put_many(texts, vectors)
+        if rows and self._conn is not None:
+            self._disk_put(rows)
+
+    def put_many_background(self, texts: Sequence[str], vectors: Sequence[np.ndarray]):
+        """立即写入内存层，持久层在线程池中后台写入，调用方不等待（需在事件循环中调用）"""
+        rows = self._memory_put_many(texts, vectors)
+        if rows and self._conn is not None:
+            task = asyncio.get_running_loop().create_task(asyncio.to_thread(self._disk_put, rows))
+            self._pending_writes.add(task)
+            task.add_done_callback(self._pending_writes.discard)
+
+    async def flush(self):
+        """等待进行中的后台写入完成"""
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+
+    def _prune(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = count - self.disk_max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY created_at LIMIT ?)",
+                (excess,),
+            )
+            logger.info(f"向量缓存持久层超过上限，已删除最早的 {excess} 条")
+
+    def stats(self) -> dict:
+        lookups = sum(self._counters.values())
+        hits = self._counters["memory_hits"] + self._counters["disk_hits"]
+        return {
+            "memory_entries": len(self._memory),
+            "persistent": self._conn is not None,
+            "pending_disk_writes": len(self._pending_writes),
+            **self._counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def create_embedding_cache(model_name: str) -> Optional[EmbeddingCache]:
+    """按环境变量创建向量缓存；内存层与持久层都关闭时返回 None"""
+    if EMBEDDING_CACHE_SIZE <= 0 and not EMBEDDING_CACHE_PATH:
+        return None
+    return EmbeddingCache(model_name)
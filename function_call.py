@@ -1,12 +1,19 @@
 import requests
 import os
 import json
+from urllib.parse import urlsplit, urlunsplit
 from dotenv import load_dotenv
 from auth_util import gen_sign_headers
+from http_client import get_async_client, request_timeout
 
 # 加载环境变量
 load_dotenv()
 
+# 一次回复中最多同时执行的 web_search 调用数，超出的调用被忽略
+WEB_SEARCH_MAX_CALLS = int(os.getenv("WEB_SEARCH_MAX_CALLS", "3"))
+# 所有搜索共享的截止时间（秒），到期时只使用已返回的结果
+WEB_SEARCH_DEADLINE_SECONDS = float(os.getenv("WEB_SEARCH_DEADLINE_SECONDS", "10"))
+
 def parse_function_call(answer: str):
     """
     解析 <APIs> ... </APIs> 结构，提取function call内容
@@ -17,17 +24,85 @@ def parse_function_call(answer: str):
         return answer[start_idx:end_idx].strip()
     return None
 
-def call_web_search_api(
+def parse_search_calls(func_call_str: str, max_calls: int = WEB_SEARCH_MAX_CALLS) -> list:
+    """
+    解析 function call 中的一个或多个搜索调用，返回各调用的 parameters 字典。
+    只要 parameters 中带有非空的 search_query 就保留（模型偶尔写错函数名），没有 search_query 的调用被丢弃；
+    相同的 search_query 只保留第一次出现的调用；JSON 无效时抛出 json.JSONDecodeError。
+    """
+    func_calls = json.loads(func_call_str)
+    if isinstance(func_calls, dict):
+        func_calls = [func_calls]
+    if not isinstance(func_calls, list):
+        return []
+
+    calls, seen_queries = [], set()
+    for func_call in func_calls:
+        if not isinstance(func_call, dict):
+            continue
+        params = func_call.get("parameters", {})
+        if not isinstance(params, dict):
+            continue
+        query_key = " ".join(str(params.get("search_query") or "").lower().split())
+        if not query_key or query_key in seen_queries:
+            continue
+        seen_queries.add(query_key)
+        calls.append(params)
+    return calls[:max(1, max_calls)]
+
+def _normalize_link(link: str) -> str:
+    """去掉锚点与末尾的斜杠、域名转小写，同一网页的不同写法视为同一链接"""
+    parts = urlsplit(link.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), parts.query, ""))
+
+def merge_search_results(results: list) -> dict:
+    """
+    合并多个搜索的返回结果 [(search_query, result), ...] 为一个 {"search_result": [...]}。
+    按链接去重（保留先出现的一条）；有多个搜索时每条结果带上对应的 "query"。
+    部分搜索失败时附带 "failed_searches": [{"query": ..., "error": ...}]，让模型知道缺少哪些查询的结果；
+    全部搜索都失败时返回 {"error": ...}。
+    """
+    merged, errors, seen_links = [], [], set()
+    tag_query = len(results) > 1
+    for search_query, result in results:
+        if not isinstance(result, dict) or "error" in result:
+            errors.append({
+                "query": search_query,
+                "error": str(result.get("error") if isinstance(result, dict) else result),
+            })
+            continue
+        items = result.get("search_result", result)
+        if not isinstance(items, list):
+            items = [items]
+        for item in items:
+            if isinstance(item, dict):
+                link = item.get("link")
+                if link:
+                    link_key = _normalize_link(str(link))
+                    if link_key in seen_links:
+                        continue
+                    seen_links.add(link_key)
+                if tag_query:
+                    item = {"query": search_query, **item}
+            merged.append(item)
+    if not merged and errors:
+        return {"error": "; ".join(f"{e['query']}: {e['error']}" for e in errors)}
+    if errors:
+        return {"search_result": merged, "failed_searches": errors}
+    return {"search_result": merged}
+
+def _build_search_request(
     search_query,
-    search_engine="search_std",
-    search_intent=True,
-    count=4,
-    search_domain_filter=None,
-    search_recency_filter="noLimit",
-    content_size="small",
-    request_id=None,
-    user_id=None
+    search_engine,
+    search_intent,
+    count,
+    search_domain_filter,
+    search_recency_filter,
+    content_size,
+    request_id,
+    user_id
 ):
+    """构造 web_search 请求的 (url, payload, headers)，同步与异步调用共用。"""
     url = os.getenv("WEB_SEARCH_URL")
     payload = {
         "search_query": search_query,
@@ -51,6 +126,23 @@ def call_web_search_api(
         "Content-Type": "application/json",
         "Authorization": f"Bearer {os.getenv('WEB_SEARCH_API_KEY')}" # 注意：此Token可能需要更新或从配置中读取
     }
+    return url, payload, headers
+
+def call_web_search_api(
+    search_query,
+    search_engine="search_std",
+    search_intent=True,
+    count=4,
+    search_domain_filter=None,
+    search_recency_filter="noLimit",
+    content_size="small",
+    request_id=None,
+    user_id=None
+):
+    url, payload, headers = _build_search_request(
+        search_query, search_engine, search_intent, count, search_domain_filter,
+        search_recency_filter, content_size, request_id, user_id
+    )
 
     try:
         resp = requests.post(url, data=json.dumps(payload), headers=headers, timeout=10)
@@ -58,3 +150,30 @@ def call_web_search_api(
         return resp.json()
     except Exception as e:
         return {"error": f"Web Search 调用失败: {str(e)}"}
+
+async def call_web_search_api_async(
+    search_query,
+    search_engine="search_std",
+    search_intent=True,
+    count=4,
+    search_domain_filter=None,
+    search_recency_filter="noLimit",
+    content_size="small",
+    request_id=None,
+    user_id=None,
+    timeout=10
+):
+    """call_web_search_api 的异步版本，使用共享连接池。"""
+    url, payload, headers = _build_search_request(
+        search_query, search_engine, search_intent, count, search_domain_filter,
+        search_recency_filter, content_size, request_id, user_id
+    )
+
+    try:
+        resp = await get_async_client().post(
+            url, content=json.dumps(payload), headers=headers, timeout=request_timeout(timeout)
+        )
+        resp.raise_for_status()
+        return resp.json()
+    except Exception as e:
+        return {"error": f"Web Search 调用失败: {str(e)}"}
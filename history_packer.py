@@ -0,0 +1,109 @@
+# history_packer.py
+# 按 token 预算打包会话历史：保留最新的若干轮，压缩旧消息中的图片识别内容
+import os
+import logging
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from token_counter import count_tokens, MESSAGE_TOKEN_OVERHEAD
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 历史消息总 token 预算（不含 system prompt 与当前用户消息）
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+# 旧消息中每个图片块（OCR 文字 / 图片描述）保留的最大字符数，0 表示整块省略
+HISTORY_IMAGE_BLOCK_CHARS = int(os.getenv("HISTORY_IMAGE_BLOCK_CHARS", "200"))
+# 最新的多少条历史消息保留完整的图片块
+HISTORY_FULL_IMAGE_MESSAGES = int(os.getenv("HISTORY_FULL_IMAGE_MESSAGES", "2"))
+
+# 图片块在用户消息中的起始标记（见 create_chat_completion 中 text_parts 的构造）
+IMAGE_BLOCK_PREFIXES = ("[用户发了一张图片,图片文字内容为]", "[用户发了张图片,图片描述为]")
+
+def _message_tokens(message: dict) -> int:
+    # 每条消息额外计入少量角色/分隔符开销
+    return count_tokens(message.get("content", "")) + MESSAGE_TOKEN_OVERHEAD
+
+
+def image_spans(text_parts: List[str]) -> List[List[int]]:
+    """
+    计算 "\\n".join(text_parts) 中每个图片块的 [start, end) 字符区间，
+    供历史消息记录在 _image_spans 字段中。
+    """
+    spans = []
+    offset = 0
+    for part in text_parts:
+        if part.startswith(IMAGE_BLOCK_PREFIXES):
+            spans.append([offset, offset + len(part)])
+        offset += len(part) + 1
+    return spans
+
+
+def shorten_image_blocks(content: str, spans: List[List[int]], max_chars: int) -> str:
+    """将 content 中的图片块截断到 max_chars 个字符（0 表示整块替换为占位说明）"""
+    if not spans:
+        return content
+    pieces = []
+    cursor = 0
+    for start, end in sorted(spans):
+        if start < cursor or end > len(content):
+            # 区间与内容不匹配（例如内容已被修改），保持原样
+            return content
+        pieces.append(content[cursor:start])
+        block = content[start:end]
+        if max_chars <= 0:
+            header = block.split("\n", 1)[0]
+            pieces.append(f"{header}\n[图片内容已省略]")
+        elif len(block) > max_chars:
+            pieces.append(f"{block[:max_chars]}…[已省略{len(block) - max_chars}字]")
+        else:
+            pieces.append(block)
+        cursor = end
+    pieces.append(content[cursor:])
+    return "".join(pieces)
+
+
+def clean_message(message: dict) -> dict:
+    """去掉以下划线开头的内部字段，只保留发送给上游模型的字段"""
+    return {k: v for k, v in message.items() if not k.startswith("_")}
+
+
+def pack_history(
+    messages: List[dict],
+    token_budget: Optional[int] = None,
+    image_block_chars: Optional[int] = None,
+    full_image_messages: Optional[int] = None,
+) -> List[dict]:
+    """
+    从最新的消息开始向前选取历史，直到 token 预算用完；较旧消息中的图片块会被截断或省略。
+    历史摘要消息（_summary）始终保留并优先占用预算。
+    返回按时间顺序排列的新消息列表，不修改传入的消息。
+    """
+    token_budget = HISTORY_TOKEN_BUDGET if token_budget is None else token_budget
+    image_block_chars = HISTORY_IMAGE_BLOCK_CHARS if image_block_chars is None else image_block_chars
+    full_image_messages = HISTORY_FULL_IMAGE_MESSAGES if full_image_messages is None else full_image_messages
+
+    pinned = [clean_message(m) for m in messages if m.get("_summary")]
+    recent = [m for m in messages if not m.get("_summary")]
+
+    packed = []
+    used_tokens = sum(_message_tokens(m) for m in pinned)
+    for age, message in enumerate(reversed(recent)):
+        packed_message = clean_message(message)
+        spans = message.get("_image_spans")
+        if spans and age >= full_image_messages:
+            packed_message["content"] = shorten_image_blocks(packed_message.get("content", ""), spans, image_block_chars)
+
+        tokens = _message_tokens(packed_message)
+        if used_tokens + tokens > token_budget:
+            break
+        used_tokens += tokens
+        packed.append(packed_message)
+
+    packed.reverse()
+    if len(packed) < len(recent):
+        logger.info(f"历史打包: 保留最新 {len(packed)}/{len(recent)} 条消息，约 {used_tokens} tokens")
+    return pinned + packed
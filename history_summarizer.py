@@ -0,0 +1,147 @@
+# history_summarizer.py
+# 滚动式会话摘要：历史过长时在后台把较早的轮次折叠为一条摘要消息
+import os
+import asyncio
+import logging
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+from vivogpt import ask_vivogpt_async
+from history_packer import shorten_image_blocks, HISTORY_IMAGE_BLOCK_CHARS
+from token_counter import token_meter
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 会话消息数达到该值时触发后台摘要
+HISTORY_SUMMARY_TRIGGER_MESSAGES = int(os.getenv("HISTORY_SUMMARY_TRIGGER_MESSAGES", "40"))
+# 摘要时保留原文的最新消息条数
+HISTORY_SUMMARY_KEEP_MESSAGES = int(os.getenv("HISTORY_SUMMARY_KEEP_MESSAGES", "10"))
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "vivo-BlueLM-TB-Pro")
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "512"))
+# 送入摘要 prompt 的单条消息最大字符数
+HISTORY_SUMMARY_MESSAGE_CHARS = int(os.getenv("HISTORY_SUMMARY_MESSAGE_CHARS", "1000"))
+
+SUMMARY_PREFIX = "【历史对话摘要】"
+
+
+def is_summary_message(message: dict) -> bool:
+    return bool(message.get("_summary"))
+
+
+def make_summary_message(summary: str) -> dict:
+    """摘要以 system 消息保存，发送时会被合并进 systemPrompt"""
+    return {"role": "system", "content": f"{SUMMARY_PREFIX}\n{summary.strip()}", "_summary": True}
+
+
+def _render_turns(messages: List[dict]) -> str:
+    lines = []
+    for message in messages:
+        content = str(message.get("content", ""))
+        spans = message.get("_image_spans")
+        if spans:
+            content = shorten_image_blocks(content, spans, HISTORY_IMAGE_BLOCK_CHARS)
+        if len(content) > HISTORY_SUMMARY_MESSAGE_CHARS:
+            content = content[:HISTORY_SUMMARY_MESSAGE_CHARS] + "…"
+        role = "用户" if message.get("role") == "user" else "助手"
+        lines.append(f"{role}: {content}")
+    return "\n".join(lines)
+
+
+def build_summary_prompt(previous_summary: str, turns: List[dict]) -> str:
+    prompt = (
+        "你是一个对话整理助手。请把下面的购物反诈咨询对话整理成一段简洁的摘要，"
+        "保留用户咨询过的商品、价格、平台、卖家、付款方式、已给出的风险结论与星级等关键信息，"
+        "以便后续对话继续参考。请直接输出摘要内容，不要添加任何额外解释，不超过300字。\n\n"
+    )
+    if previous_summary:
+        prompt += f"已有的历史摘要:\n{previous_summary}\n\n需要合并进摘要的新对话:\n"
+    else:
+        prompt += "对话内容:\n"
+    return prompt + _render_turns(turns)
+
+
+class HistorySummarizer:
+    """
+    会话消息数超过阈值时，在请求路径之外发起一次 ask_vivogpt 调用，
+    把除最新 keep_messages 条以外的历史（含已有摘要）折叠为新的摘要消息并写回会话存储。
+    之后的请求直接复用存储中的摘要，不需要等待摘要调用。
+    """
+
+    def __init__(
+        self,
+        store,
+        trigger_messages: int = HISTORY_SUMMARY_TRIGGER_MESSAGES,
+        keep_messages: int = HISTORY_SUMMARY_KEEP_MESSAGES,
+        model: str = HISTORY_SUMMARY_MODEL,
+    ):
+        self.store = store
+        self.trigger_messages = trigger_messages
+        self.keep_messages = keep_messages
+        self.model = model
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._counters = {"scheduled": 0, "succeeded": 0, "failed": 0, "stale": 0}
+
+    async def maybe_schedule(self, user_id: str):
+        """若会话已超过阈值且没有进行中的摘要任务，则在后台启动一次摘要"""
+        if self.trigger_messages <= 0 or user_id in self._pending:
+            return
+        if await self.store.message_count_async(user_id) < self.trigger_messages:
+            return
+        if user_id in self._pending:
+            return
+        task = asyncio.get_running_loop().create_task(self._summarize(user_id))
+        self._pending[user_id] = task
+        task.add_done_callback(lambda _: self._pending.pop(user_id, None))
+        self._counters["scheduled"] += 1
+
+    async def _summarize(self, user_id: str):
+        try:
+            history = await self.store.get_history_async(user_id)
+            if len(history) <= self.keep_messages:
+                return
+            head = history[:-self.keep_messages] if self.keep_messages > 0 else history
+            previous_summary = ""
+            turns = head
+            if is_summary_message(head[0]):
+                previous_summary = head[0]["content"][len(SUMMARY_PREFIX):].strip()
+                turns = head[1:]
+            if not turns:
+                return
+
+            summary_messages = [{"role": "user", "content": build_summary_prompt(previous_summary, turns)}]
+            summary, error = await ask_vivogpt_async(
+                messages=summary_messages,
+                model=self.model,
+                extra={"temperature": 0.1, "max_tokens": HISTORY_SUMMARY_MAX_TOKENS},
+            )
+            token_meter.record_call("history_summary", summary_messages, summary)
+            if not summary:
+                self._counters["failed"] += 1
+                logger.warning(f"用户 {user_id} 的历史摘要失败: {error}")
+                return
+
+            if await self.store.compact_history_async(user_id, head, make_summary_message(summary)):
+                self._counters["succeeded"] += 1
+                logger.info(f"用户 {user_id} 的 {len(head)} 条历史消息已折叠为摘要 ({len(summary)} 字)")
+            else:
+                # 摘要期间会话开头已变化（例如被裁剪），下次触发时重新摘要
+                self._counters["stale"] += 1
+                logger.info(f"用户 {user_id} 的会话在摘要期间发生变化，丢弃本次摘要")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.error(f"历史摘要任务出错: {e}", exc_info=True)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), **self._counters}
+
+    async def shutdown(self):
+        for task in list(self._pending.values()):
+            task.cancel()
+        if self._pending:
+            await asyncio.gather(*self._pending.values(), return_exceptions=True)
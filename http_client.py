@@ -0,0 +1,58 @@
+# http_client.py
+# 共享的异步 HTTP 客户端（连接池 + 按主机 keep-alive）
+import os
+import logging
+from typing import Optional
+
+import httpx
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 连接池配置
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "500"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "100"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    返回进程内共享的 httpx.AsyncClient，首次调用时惰性创建。
+    httpx 会按 (scheme, host, port) 维护连接池，同一上游的请求复用 keep-alive 连接。
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        limits = httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        _async_client = httpx.AsyncClient(
+            limits=limits,
+            timeout=httpx.Timeout(100, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        logger.info(
+            f"创建共享异步HTTP客户端: max_connections={HTTP_MAX_CONNECTIONS}, "
+            f"max_keepalive={HTTP_MAX_KEEPALIVE_CONNECTIONS}"
+        )
+    return _async_client
+
+
+def request_timeout(seconds: float) -> httpx.Timeout:
+    """构造单次请求的超时配置，连接超时保持全局设置。"""
+    return httpx.Timeout(seconds, connect=min(seconds, HTTP_CONNECT_TIMEOUT))
+
+
+async def close_async_client():
+    """关闭共享客户端，释放连接池（在应用关闭时调用）。"""
+    global _async_client
+    if _async_client is not None and not _async_client.is_closed:
+        await _async_client.aclose()
+        logger.info("共享异步HTTP客户端已关闭")
+    _async_client = None
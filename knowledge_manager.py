@@ -0,0 +1,376 @@
+# knowledge_manager.py
+# 知识库热更新：后台构建新的 KnowledgeBase，原子替换 RAGSystem，并等待旧索引上的检索完成；
+# 增量追加 / 删除条目写入增量段（见 knowledge_segments.py），后台定期合并到基础段
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from rag import RAGSystem, VivoEmbeddingClient, load_knowledge_base, knowledge_source_paths
+from compiled_index import META_FILE, DEFAULT_RISK_TYPE
+from compile_knowledge import make_extra_writer
+from concurrency import gather_limited
+from knowledge_segments import DeltaStore, entry_key, entry_keys
+from vector_index import QUANTIZED_FILES
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 轮询知识库文件变化的间隔（秒），0 表示不监听文件
+KNOWLEDGE_WATCH_INTERVAL_SECONDS = float(os.getenv("KNOWLEDGE_WATCH_INTERVAL_SECONDS", "0"))
+# 替换后等待旧索引上进行中的检索完成的最长时间（秒）
+KNOWLEDGE_DRAIN_TIMEOUT_SECONDS = float(os.getenv("KNOWLEDGE_DRAIN_TIMEOUT_SECONDS", "30"))
+# 增量段目录（追加 / 删除的条目在合并前保存在这里）
+KNOWLEDGE_DELTA_DIR = os.getenv("KNOWLEDGE_DELTA_DIR", "knowledge_base_embeddings/delta")
+# 检查是否需要合并的间隔（秒），0 表示不在后台合并
+KNOWLEDGE_COMPACT_INTERVAL_SECONDS = float(os.getenv("KNOWLEDGE_COMPACT_INTERVAL_SECONDS", "600"))
+# 增量段数达到该值，或增量条目数 + 删除标记数超过基础段的该比例时合并
+KNOWLEDGE_COMPACT_MAX_SEGMENTS = int(os.getenv("KNOWLEDGE_COMPACT_MAX_SEGMENTS", "8"))
+KNOWLEDGE_COMPACT_MAX_DELTA_RATIO = float(os.getenv("KNOWLEDGE_COMPACT_MAX_DELTA_RATIO", "0.1"))
+
+# 追加条目时每次 Embedding API 调用的句子数与并发数
+APPEND_EMBEDDING_BATCH_SIZE = 64
+APPEND_EMBEDDING_CONCURRENCY = 4
+
+
+def _file_signature(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class KnowledgeBaseManager:
+    """
+    持有当前的 RAGSystem。检索通过 acquire() 获取当前代的 RAGSystem 并登记为进行中；
+    reload() 在线程池中构建新知识库，构建成功后一次赋值完成替换，再等待旧一代的检索全部结束。
+    构建失败或新知识库为空时保留旧的知识库。
+    只有增量段变化时（追加 / 删除）新知识库复用当前的基础段，重建代价与增量规模成正比；
+    基础段已被其他 worker 合并或重新编译时总是整体重建。
+    """
+
+    def __init__(self, embedding_client: VivoEmbeddingClient,
+                 drain_timeout_seconds: float = KNOWLEDGE_DRAIN_TIMEOUT_SECONDS,
+                 delta_dir: str = KNOWLEDGE_DELTA_DIR):
+        self.embedding_client = embedding_client
+        self.drain_timeout_seconds = drain_timeout_seconds
+        self.delta_store = DeltaStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), delta_dir))
+        self.rag_system: Optional[RAGSystem] = None
+        self.generation = 0
+        self.loaded_at: Optional[float] = None
+        self._in_flight: Dict[int, int] = {}
+        self._drained: Dict[int, asyncio.Event] = {}
+        self._reload_lock = asyncio.Lock()
+        self._watch_task: Optional[asyncio.Task] = None
+        self._compact_task: Optional[asyncio.Task] = None
+        self._source_signature = self._current_signature()
+        # 当前知识库所用基础段的文件签名，与磁盘上的不同时不能只重建增量部分
+        self._base_signature = self._source_signature[0]
+        self._counters = {"reloads": 0, "reload_failures": 0, "drain_timeouts": 0, "compactions": 0}
+        self.last_reload: Optional[dict] = None
+
+    @property
+    def knowledge_base(self):
+        return self.rag_system.knowledge_base if self.rag_system is not None else None
+
+    def _current_signature(self):
+        """返回 ((基础段文件签名), 增量 manifest 签名)"""
+        compiled_dir, json_file = knowledge_source_paths()
+        base = _file_signature(os.path.join(compiled_dir, META_FILE)), _file_signature(json_file)
+        return base, _file_signature(self.delta_store.manifest_path)
+
+    def base_changed(self) -> bool:
+        """磁盘上的基础段是否已不是当前知识库所用的基础段（其他 worker 合并后或重新编译后）"""
+        return self._current_signature()[0] != self._base_signature
+
+    def _build(self, deltas_only: bool = False):
+        """
+        构建新的 RAGSystem，返回 (RAGSystem 或 None, 构建时读取的文件签名)。
+        持锁后再检查基础段：其他 worker 合并后 manifest 已清空，旧基础段配新 manifest 会丢失合并进基础段的条目，
+        因此基础段变化时忽略 deltas_only 整体重建。
+        """
+        with self.delta_store.locked(exclusive=False):
+            signature = self._current_signature()
+            if deltas_only and signature[0] != self._base_signature:
+                logger.info("基础段已被其他进程替换，整体重建知识库")
+                deltas_only = False
+            if deltas_only and self.knowledge_base is not None:
+                base = self.knowledge_base
+            else:
+                base = load_knowledge_base()
+            deltas, tombstones = self.delta_store.read_segments()
+        knowledge_base = base.with_deltas(deltas, tombstones)
+        if len(knowledge_base) == 0:
+            return None, signature
+        return RAGSystem(self.embedding_client, knowledge_base), signature
+
+    def _install(self, rag_system: RAGSystem) -> int:
+        old_generation = self.generation
+        self.rag_system = rag_system
+        self.generation += 1
+        self.loaded_at = time.time()
+        return old_generation
+
+    def load_initial(self):
+        """服务启动时同步加载知识库"""
+        rag_system, signature = self._build()
+        self._source_signature = signature
+        self._base_signature = signature[0]
+        if rag_system is None:
+            logger.warning("知识库为空或加载失败，RAG 系统将不可用。")
+            return
+        self._install(rag_system)
+        logger.info(f"RAG 系统初始化成功，知识库 {len(rag_system.knowledge_base)} 条。")
+
+    @asynccontextmanager
+    async def acquire(self):
+        """获取当前的 RAGSystem（可能为 None），在 with 块内登记为进行中的检索"""
+        generation = self.generation
+        self._in_flight[generation] = self._in_flight.get(generation, 0) + 1
+        try:
+            yield self.rag_system
+        finally:
+            self._in_flight[generation] -= 1
+            if self._in_flight[generation] == 0:
+                del self._in_flight[generation]
+                event = self._drained.pop(generation, None)
+                if event is not None:
+                    event.set()
+
+    async def _drain(self, generation: int) -> bool:
+        if not self._in_flight.get(generation):
+            return True
+        event = self._drained.setdefault(generation, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), self.drain_timeout_seconds)
+            return True
+        except asyncio.TimeoutError:
+            self._drained.pop(generation, None)
+            self._counters["drain_timeouts"] += 1
+            return False
+
+    async def reload(self, reason: str = "manual", deltas_only: bool = False) -> dict:
+        """后台重建知识库并原子替换；同一时间只进行一次重建。deltas_only 时复用当前的基础段"""
+        async with self._reload_lock:
+            start_time = time.time()
+            try:
+                rag_system, signature = await asyncio.to_thread(self._build, deltas_only)
+            except Exception as e:
+                logger.error(f"知识库重建失败 ({reason}): {e}", exc_info=True)
+                rag_system = None
+
+            if rag_system is None:
+                self._counters["reload_failures"] += 1
+                self.last_reload = {"status": "failed", "reason": reason, "at": int(time.time())}
+                logger.warning(f"知识库重建失败或为空 ({reason})，继续使用第 {self.generation} 代知识库")
+                return {**self.last_reload, "generation": self.generation}
+
+            self._source_signature = signature
+            self._base_signature = signature[0]
+            old_generation = self._install(rag_system)
+            build_seconds = time.time() - start_time
+            in_flight = self._in_flight.get(old_generation, 0)
+            logger.info(
+                f"知识库已替换为第 {self.generation} 代 ({len(rag_system.knowledge_base)} 条, 构建 {build_seconds:.2f} 秒, "
+                f"原因: {reason})，等待旧索引上的 {in_flight} 个检索完成"
+            )
+            drained = await self._drain(old_generation)
+            if not drained:
+                logger.warning(f"第 {old_generation} 代知识库上的检索在 {self.drain_timeout_seconds} 秒内未全部完成")
+
+            self._counters["reloads"] += 1
+            self.last_reload = {
+                "status": "ok",
+                "reason": reason,
+                "at": int(time.time()),
+                "entries": len(rag_system.knowledge_base),
+                "build_seconds": round(build_seconds, 3),
+                "drained": drained,
+            }
+            return {**self.last_reload, "generation": self.generation}
+
+    async def _watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            signature = self._current_signature()
+            if signature != self._source_signature and not self._reload_lock.locked():
+                # 先记录签名，重建失败时等文件再次变化后才重试
+                deltas_only = signature[0] == self._source_signature[0]
+                self._source_signature = signature
+                await self.reload(reason="file_change", deltas_only=deltas_only)
+
+    async def _embed(self, texts: List[str]) -> np.ndarray:
+        batches = [texts[i:i + APPEND_EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), APPEND_EMBEDDING_BATCH_SIZE)]
+        results = await gather_limited(
+            [lambda batch=batch: self.embedding_client.get_embeddings_async(batch) for batch in batches],
+            APPEND_EMBEDDING_CONCURRENCY,
+        )
+        for batch, vectors in zip(batches, results):
+            if len(vectors) != len(batch):
+                raise RuntimeError("Embedding API 调用失败，未追加任何条目")
+        return np.vstack([np.asarray(vector, dtype=np.float32) for vectors in results for vector in vectors])
+
+    async def append_entries(self, entries: List[Tuple[str, str]]) -> dict:
+        """
+        追加 [(text, riskType)]：先按条目键精确查找知识库中已有的条目，只为新文本与改标注的文本调用 Embedding API，
+        写入一个新的增量段后只重建增量部分。
+        - 空文本计入 empty；请求内重复的文本，以及文本与风险类型都和已有条目相同的文本计入 duplicates
+        - 文本已存在但风险类型不同时视为改标注：旧条目写入删除标记，新条目追加，计入 relabeled
+        """
+        texts, risk_types, seen = [], [], set()
+        empty = duplicates = 0
+        for text, risk_type in entries:
+            text = str(text).strip()
+            if not text:
+                empty += 1
+                continue
+            key = entry_key(text)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            texts.append(text)
+            risk_types.append(risk_type or DEFAULT_RISK_TYPE)
+
+        knowledge_base = self.knowledge_base
+        keys = entry_keys(texts).tolist()
+        existing = {}
+        if knowledge_base is not None and texts:
+            existing = await asyncio.to_thread(knowledge_base.find_live_risk_types, np.asarray(keys, dtype=np.uint64))
+        pending, replace_keys = [], []
+        for i, key in enumerate(keys):
+            current = existing.get(key)
+            if current == risk_types[i]:
+                duplicates += 1
+                continue
+            if current is not None:
+                replace_keys.append(key)
+            pending.append(i)
+
+        counts = {"added": 0, "relabeled": 0, "duplicates": duplicates, "empty": empty}
+        if not pending:
+            return {"status": "ok", **counts, "generation": self.generation}
+
+        texts = [texts[i] for i in pending]
+        risk_types = [risk_types[i] for i in pending]
+        vectors = await self._embed(texts)
+        if knowledge_base is not None and knowledge_base.index is not None and vectors.shape[1] != knowledge_base.index.dim:
+            raise ValueError(f"新条目的向量维度 {vectors.shape[1]} 与知识库维度 {knowledge_base.index.dim} 不符")
+
+        # 持锁后再按磁盘上的增量段检查一次，并发追加的相同条目只写入一次
+        segment, rows, relabeled = await asyncio.to_thread(
+            self.delta_store.append, texts, risk_types, vectors, replace_keys
+        )
+        counts.update(added=len(rows) - relabeled, relabeled=relabeled, duplicates=duplicates + len(texts) - len(rows))
+        if segment is None:
+            return {"status": "ok", **counts, "generation": self.generation}
+        result = await self.reload(reason="append", deltas_only=True)
+        return {**result, **counts, "segment": segment}
+
+    async def delete_entries(self, texts: List[str]) -> dict:
+        """按文本删除条目（写入删除标记），只重建增量部分；合并时才从基础段物理移除"""
+        keys = np.array(sorted({entry_key(text) for text in texts}), dtype=np.uint64)
+        knowledge_base = self.knowledge_base
+        if knowledge_base is None or len(keys) == 0:
+            return {"status": "ok", "deleted": 0, "generation": self.generation}
+
+        deleted, matched_keys = await asyncio.to_thread(knowledge_base.find_live_entries, keys)
+        if deleted == 0:
+            return {"status": "ok", "deleted": 0, "generation": self.generation}
+        await asyncio.to_thread(self.delta_store.delete, [int(key) for key in matched_keys])
+        result = await self.reload(reason="delete", deltas_only=True)
+        return {**result, "deleted": deleted}
+
+    def needs_compaction(self) -> bool:
+        knowledge_base = self.knowledge_base
+        if knowledge_base is None or (not knowledge_base.deltas and not knowledge_base.tombstones):
+            return False
+        stats = knowledge_base.segment_stats()
+        changes = stats["delta_entries"] + stats["tombstones"]
+        return (stats["delta_segments"] >= KNOWLEDGE_COMPACT_MAX_SEGMENTS
+                or changes > KNOWLEDGE_COMPACT_MAX_DELTA_RATIO * stats["base_entries"])
+
+    @staticmethod
+    def _load_compaction_base():
+        knowledge_base = load_knowledge_base(vector_storage="float32")
+        return (
+            knowledge_base.texts, knowledge_base.risk_types, knowledge_base.embeddings_matrix,
+            knowledge_base.duplicate_counts,
+        )
+
+    def _compaction_extra_writer(self, count: int):
+        """合并后的基础段沿用当前基础段的附加索引（IVF / 量化向量）"""
+        compiled_dir, _ = knowledge_source_paths()
+        ivf = self.knowledge_base.ivf_index if self.knowledge_base is not None else None
+        quantize = next(
+            (storage for storage, name in QUANTIZED_FILES.items() if os.path.exists(os.path.join(compiled_dir, name))),
+            "none",
+        )
+        return make_extra_writer(
+            count, "auto" if ivf is not None else "0", ivf.nprobe if ivf is not None else 8, quantize=quantize
+        )
+
+    async def compact(self, reason: str = "manual") -> dict:
+        """把增量段与删除标记合并进新的编译基础段，然后整体重建知识库"""
+        compiled_dir, _ = knowledge_source_paths()
+        start_time = time.time()
+        meta = await asyncio.to_thread(
+            self.delta_store.compact, compiled_dir, self._load_compaction_base, self._compaction_extra_writer
+        )
+        if meta is None:
+            if self.base_changed():
+                # 其他 worker 已经合并：换用新的基础段，否则本进程会一直保留旧的基础段与增量段并反复尝试合并
+                return await self.reload(reason=f"compaction:{reason}")
+            return {"status": "skipped", "reason": reason, "generation": self.generation}
+        self._counters["compactions"] += 1
+        logger.info(f"知识库合并用时 {time.time() - start_time:.2f} 秒 (原因: {reason})")
+        return await self.reload(reason=f"compaction:{reason}")
+
+    async def _compact_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            if self.needs_compaction():
+                try:
+                    await self.compact(reason="scheduled")
+                except Exception as e:
+                    logger.error(f"后台合并知识库失败: {e}", exc_info=True)
+
+    def start_background_tasks(self, watch_interval: float = KNOWLEDGE_WATCH_INTERVAL_SECONDS,
+                               compact_interval: float = KNOWLEDGE_COMPACT_INTERVAL_SECONDS):
+        loop = asyncio.get_running_loop()
+        if watch_interval > 0 and self._watch_task is None:
+            self._watch_task = loop.create_task(self._watch(watch_interval))
+            logger.info(f"开始监听知识库文件变化，间隔 {watch_interval} 秒")
+        if compact_interval > 0 and self._compact_task is None:
+            self._compact_task = loop.create_task(self._compact_periodically(compact_interval))
+
+    async def stop_background_tasks(self):
+        for task in (self._watch_task, self._compact_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._watch_task = self._compact_task = None
+
+    def stats(self) -> dict:
+        knowledge_base = self.knowledge_base
+        return {
+            "generation": self.generation,
+            "loaded_at": int(self.loaded_at) if self.loaded_at else None,
+            "in_flight": dict(self._in_flight),
+            "watching": self._watch_task is not None,
+            "segments": knowledge_base.segment_stats() if knowledge_base is not None else None,
+            **self._counters,
+            "last_reload": self.last_reload,
+        }
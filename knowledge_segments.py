@@ -0,0 +1,279 @@
+# knowledge_segments.py
+# 增量知识库：一个不可变的基础段（编译知识库 / JSON）+ 若干小的增量段 + 删除标记（tombstone）
+#
+# 增量目录结构（KNOWLEDGE_DELTA_DIR）:
+#   manifest.json     {"version": 1, "next_segment": 下一个段号, "segments": [段目录名],
+#                      "tombstones": {条目键: 删除时已存在的最大段号}}
+#   segment_000001/   每个增量段都是一个小的编译知识库（格式见 compiled_index.py）
+#   .lock             跨进程文件锁：追加 / 删除 / 合并持有排他锁，加载持有共享锁
+#
+# 条目键为归一化文本的 64 位哈希。tombstone 只删除段号不大于删除时最大段号的条目（基础段段号为 0），
+# 之后重新追加的同一文本不受影响；合并（compaction）后删除的条目被物理移除，tombstone 随之清空。
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只保证进程内互斥
+    fcntl = None
+
+from embedding_cache import normalize_text
+from compiled_index import write_compiled_index, open_compiled_index
+from vector_index import DenseVectorIndex
+from lexical_index import LexicalIndex
+
+logger = logging.getLogger(__name__)
+
+DELTA_FORMAT_VERSION = 1
+DELTA_MANIFEST_FILE = "manifest.json"
+DELTA_LOCK_FILE = ".lock"
+BASE_SEGMENT_SEQ = 0
+
+
+def entry_key(text: str) -> int:
+    """条目键：归一化文本的 64 位 blake2b 哈希"""
+    digest = hashlib.blake2b(normalize_text(str(text)).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def entry_keys(texts: Sequence[str]) -> np.ndarray:
+    return np.fromiter((entry_key(text) for text in texts), dtype=np.uint64, count=len(texts))
+
+
+def deleted_mask(keys: np.ndarray, seq: int, tombstones: Dict[int, int]) -> Optional[np.ndarray]:
+    """返回段号为 seq 的段中被删除条目的布尔掩码；没有条目被删除时返回 None"""
+    applicable = [key for key, upto in tombstones.items() if upto >= seq]
+    if not applicable or len(keys) == 0:
+        return None
+    mask = np.isin(keys, np.fromiter(applicable, dtype=np.uint64, count=len(applicable)))
+    return mask if mask.any() else None
+
+
+def _segment_seq(name: str) -> int:
+    return int(name.rsplit("_", 1)[1])
+
+
+class DeltaSegment:
+    """一个已打开的增量段：条目较少，始终精确检索，并总是带有 BM25 倒排索引"""
+
+    def __init__(self, name: str, compiled, tombstones: Dict[int, int]):
+        self.name = name
+        self.seq = _segment_seq(name)
+        self.index = DenseVectorIndex(compiled.vectors, normalized=True)
+        self.texts = compiled.texts
+        self.risk_types = compiled.risk_types
+        self.partitions = compiled.risk_types.partitions
+        self.duplicate_counts = compiled.duplicate_counts
+        self.lexical = compiled.lexical if compiled.lexical is not None else LexicalIndex.build(self.texts)
+        self.keys = entry_keys(self.texts)
+        self.deleted = deleted_mask(self.keys, self.seq, tombstones)
+        self.deleted_count = int(self.deleted.sum()) if self.deleted is not None else 0
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def live_count(self) -> int:
+        return len(self) - self.deleted_count
+
+    def live_mask(self, keys: np.ndarray) -> np.ndarray:
+        live = np.isin(self.keys, keys)
+        if self.deleted is not None:
+            live &= ~self.deleted
+        return live
+
+
+class DeltaStore:
+    """增量目录的读写。所有修改先写新文件再替换 manifest.json，读取方不会看到写了一半的状态"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self, exclusive: bool = True):
+        """进程内互斥 + 跨进程文件锁；目录不存在时读取不加文件锁"""
+        with self._lock:
+            if fcntl is None or (not exclusive and not os.path.isdir(self.path)):
+                yield
+                return
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, DELTA_LOCK_FILE), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.path, DELTA_MANIFEST_FILE)
+
+    def read_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {"version": DELTA_FORMAT_VERSION, "next_segment": 1, "segments": [], "tombstones": {}}
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != DELTA_FORMAT_VERSION:
+            raise ValueError(f"增量目录 {self.path} 的格式版本 {manifest.get('version')} 不受支持")
+        return manifest
+
+    def _write_manifest(self, manifest: dict):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _tombstones(manifest: dict) -> Dict[int, int]:
+        return {int(key, 16): upto for key, upto in manifest["tombstones"].items()}
+
+    def read_segments(self) -> Tuple[List[DeltaSegment], Dict[int, int]]:
+        """打开所有增量段并应用删除标记，返回 (增量段, tombstones)。调用方需持有锁"""
+        manifest = self.read_manifest()
+        tombstones = self._tombstones(manifest)
+        segments = []
+        for name in manifest["segments"]:
+            compiled = open_compiled_index(os.path.join(self.path, name), lock=False)
+            if compiled is None:
+                raise ValueError(f"无法打开增量段 {name}")
+            segments.append(DeltaSegment(name, compiled, tombstones))
+        return segments, tombstones
+
+    def _live_delta_risk_types(self, manifest: dict, keys: np.ndarray) -> Dict[int, str]:
+        """增量段中键在 keys 内且未被删除的条目的 {条目键: 风险类型}，以最新的段为准。调用方需持有锁"""
+        tombstones = self._tombstones(manifest)
+        found = {}
+        for name in manifest["segments"]:
+            compiled = open_compiled_index(os.path.join(self.path, name), lock=False)
+            if compiled is None:
+                raise ValueError(f"无法打开增量段 {name}")
+            segment_keys = entry_keys(compiled.texts)
+            live = np.isin(segment_keys, keys)
+            deleted = deleted_mask(segment_keys, _segment_seq(name), tombstones)
+            if deleted is not None:
+                live &= ~deleted
+            for row in np.flatnonzero(live):
+                found[int(segment_keys[row])] = compiled.risk_types[row]
+        return found
+
+    def append(
+        self,
+        texts: Sequence[str],
+        risk_types: Sequence[str],
+        vectors: np.ndarray,
+        replace_keys: Iterable[int] = (),
+    ) -> Tuple[Optional[str], List[int], int]:
+        """
+        把一批新条目写为一个新的增量段，返回 (段名, 实际写入的行号, 改标注的条目数)；没有需要写入的行时段名为 None。
+        持锁后按磁盘上的增量段重新检查（调用方的检查基于尚未重载的知识库，并发追加时会过期）：
+        文本与风险类型都相同的条目已存在时跳过该行；文本已存在但风险类型不同，或条目键在 replace_keys 中时，
+        先为旧条目写入删除标记再追加新条目，删除标记只作用于已有的段，不影响本次写入的段。
+        """
+        keys = entry_keys(texts).tolist()
+        replace_keys = {int(key) for key in replace_keys}
+        with self.locked():
+            manifest = self.read_manifest()
+            existing = self._live_delta_risk_types(manifest, np.asarray(keys, dtype=np.uint64))
+            rows, replaced = [], []
+            for row, key in enumerate(keys):
+                current = existing.get(key)
+                if current == risk_types[row]:
+                    continue
+                rows.append(row)
+                if current is not None or key in replace_keys:
+                    replaced.append(key)
+            if not rows:
+                return None, [], 0
+
+            seq = manifest["next_segment"]
+            name = f"segment_{seq:06d}"
+            write_compiled_index(
+                os.path.join(self.path, name), [texts[i] for i in rows], [risk_types[i] for i in rows], vectors[rows]
+            )
+            for key in replaced:
+                manifest["tombstones"][f"{key:016x}"] = seq - 1
+            manifest["next_segment"] = seq + 1
+            manifest["segments"].append(name)
+            self._write_manifest(manifest)
+        logger.info(f"已追加增量段 {name}: {len(rows)} 条 (其中改标注 {len(replaced)} 条)")
+        return name, rows, len(replaced)
+
+    def delete(self, keys: Iterable[int]) -> int:
+        """为条目键写入删除标记，对已有的所有段生效，返回写入的标记数"""
+        with self.locked():
+            manifest = self.read_manifest()
+            upto = manifest["next_segment"] - 1
+            count = 0
+            for key in keys:
+                manifest["tombstones"][f"{key:016x}"] = upto
+                count += 1
+            self._write_manifest(manifest)
+        return count
+
+    def compact(
+        self,
+        out_dir: str,
+        load_base: Callable[[], Tuple[Sequence[str], Sequence[str], Optional[np.ndarray], Optional[np.ndarray]]],
+        make_extra_writer: Optional[Callable[[int], Callable]] = None,
+    ) -> Optional[dict]:
+        """
+        把基础段与所有增量段中未删除的条目合并写为新的编译知识库 out_dir，并清空增量目录。
+        全程持有排他锁，多个 worker 同时触发时只有第一个真正合并。没有增量时返回 None。
+        load_base() 返回基础段的 (texts, risk_types, 归一化的 float32 向量, 近重复计数或 None)。
+        """
+        with self.locked():
+            manifest = self.read_manifest()
+            if not manifest["segments"] and not manifest["tombstones"]:
+                return None
+            segments, tombstones = self.read_segments()
+
+            texts, risk_types, parts, counts = [], [], [], []
+
+            def collect(source_texts, source_risk_types, vectors, duplicate_counts, deleted):
+                rows = np.arange(len(source_texts)) if deleted is None else np.flatnonzero(~deleted)
+                texts.extend(source_texts[i] for i in rows)
+                risk_types.extend(source_risk_types[i] for i in rows)
+                parts.append(np.asarray(vectors[rows], dtype=np.float32))
+                counts.append(np.ones(len(rows), dtype=np.int32) if duplicate_counts is None else duplicate_counts[rows])
+
+            base_texts, base_risk_types, base_vectors, base_counts = load_base()
+            if base_vectors is not None and len(base_texts):
+                base_deleted = deleted_mask(entry_keys(base_texts), BASE_SEGMENT_SEQ, tombstones)
+                collect(base_texts, base_risk_types, base_vectors, base_counts, base_deleted)
+            for segment in segments:
+                collect(segment.texts, segment.risk_types, segment.index.vectors, segment.duplicate_counts, segment.deleted)
+
+            if not texts:
+                logger.warning("合并后知识库为空，保留现有的基础段与增量段")
+                return None
+            vectors = np.concatenate(parts)
+            parts.clear()  # 释放逐段的向量拷贝，写入期间只保留合并后的矩阵
+            duplicate_counts = np.concatenate(counts)
+            extra_writer = make_extra_writer(len(texts)) if make_extra_writer is not None else None
+            meta = write_compiled_index(
+                out_dir, texts, risk_types, vectors, extra_writer=extra_writer,
+                duplicate_counts=duplicate_counts if np.any(duplicate_counts > 1) else None,
+            )
+
+            self._write_manifest({
+                "version": DELTA_FORMAT_VERSION,
+                "next_segment": manifest["next_segment"],
+                "segments": [],
+                "tombstones": {},
+            })
+            for segment in segments:
+                shutil.rmtree(os.path.join(self.path, segment.name), ignore_errors=True)
+        logger.info(
+            f"知识库合并完成: {len(segments)} 个增量段、{len(tombstones)} 个删除标记合并为 {meta['count']} 条 -> {out_dir}"
+        )
+        return meta
@@ -0,0 +1,208 @@
+# lexical_index.py
+# 本地词法检索：中文按字二元组（bigram）、英文数字按词切分，BM25 打分，倒排表为紧凑的 numpy 数组
+#
+# 编译知识库目录中的文件:
+#   lex_meta.json      条目数、词项数、倒排项数、BM25 参数
+#   lex_terms.npy      (T,) uint64，词项哈希，升序排列，查询时二分查找，不需要加载词典
+#   lex_idf.npy        (T,) float32，词项 idf
+#   lex_offsets.npy    (T + 1,) int64，第 t 个词项的倒排表为 [offsets[t], offsets[t + 1])
+#   lex_docs.npy       (P,) int32，倒排表中的文档下标
+#   lex_weights.npy    (P,) float32，预先算好的 BM25 词项权重，查询时只需按文档累加
+import os
+import re
+import json
+import hashlib
+import logging
+import functools
+from collections import Counter
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from embedding_cache import normalize_text
+from vector_index import top_k, Rows
+
+logger = logging.getLogger(__name__)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 查询时跳过出现在超过该比例文档中的常见词项（如“客服”“您好”），且只在其文档数也超过 COMMON_TERM_MIN_DF 时跳过，
+# 条目很少的增量段不受影响。长查询（OCR 合并文本）的大部分倒排项来自这些词项，它们的 idf 低，对排序贡献很小
+COMMON_TERM_DF_RATIO = 0.1
+COMMON_TERM_MIN_DF = 1000
+# 查询词项哈希的缓存条数，常见二元组在各查询间反复出现
+QUERY_TERM_HASH_CACHE_SIZE = 1 << 16
+
+LEXICAL_META_FILE = "lex_meta.json"
+LEXICAL_TERMS_FILE = "lex_terms.npy"
+LEXICAL_IDF_FILE = "lex_idf.npy"
+LEXICAL_OFFSETS_FILE = "lex_offsets.npy"
+LEXICAL_DOCS_FILE = "lex_docs.npy"
+LEXICAL_WEIGHTS_FILE = "lex_weights.npy"
+
+_CJK_RUN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """中文连续片段切为相邻两字的二元组（单字片段保留单字），英文与数字按词切分并转小写"""
+    text = normalize_text(text).lower()
+    tokens = []
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(_WORD_RE.findall(text))
+    return tokens
+
+
+def term_hash(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+_query_term_hash = functools.lru_cache(maxsize=QUERY_TERM_HASH_CACHE_SIZE)(term_hash)
+
+
+class LexicalIndex:
+    """
+    BM25 倒排索引。每个倒排项保存 (文档下标, 预计算的 BM25 权重)，
+    查询只需收集查询词项的倒排项并按文档求和。
+    返回的分数除以该查询可能达到的最大 BM25 分数，落在 (0, 1] 区间。
+    """
+
+    def __init__(self, terms: np.ndarray, idf: np.ndarray, offsets: np.ndarray, docs: np.ndarray,
+                 weights: np.ndarray, count: int, k1: float = BM25_K1):
+        self.terms = terms
+        self.idf = idf
+        self.offsets = offsets
+        self.docs = docs
+        self.weights = weights
+        self.count = count
+        self.k1 = k1
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.terms, self.idf, self.offsets, self.docs, self.weights))
+
+    @classmethod
+    def build(cls, texts: Sequence[str], k1: float = BM25_K1, b: float = BM25_B) -> "LexicalIndex":
+        vocabulary = {}
+        term_ids, doc_ids, tfs = [], [], []
+        doc_lengths = np.zeros(len(texts), dtype=np.float32)
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+
+        # 词项按哈希排序，查询时在 terms 上二分查找
+        hashes = np.fromiter((term_hash(term) for term in vocabulary), dtype=np.uint64, count=len(vocabulary))
+        order = np.argsort(hashes, kind="stable")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+
+        term_ranks = rank[np.asarray(term_ids, dtype=np.int64)] if term_ids else np.empty(0, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.float32)
+        postings = np.lexsort((doc_ids, term_ranks))
+        term_ranks, doc_ids, tfs = term_ranks[postings], doc_ids[postings], tfs[postings]
+
+        df = np.bincount(term_ranks, minlength=len(order)).astype(np.float32)
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(df, out=offsets[1:])
+        n = max(len(texts), 1)
+        idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(doc_lengths.mean()) if len(texts) and doc_lengths.mean() > 0 else 1.0
+        norm = k1 * (1 - b + b * doc_lengths[doc_ids] / avgdl)
+        weights = (idf[term_ranks] * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32)
+        return cls(hashes[order], idf, offsets, doc_ids, weights, len(texts), k1)
+
+    def save(self, path: str):
+        np.save(os.path.join(path, LEXICAL_TERMS_FILE), self.terms)
+        np.save(os.path.join(path, LEXICAL_IDF_FILE), self.idf)
+        np.save(os.path.join(path, LEXICAL_OFFSETS_FILE), self.offsets)
+        np.save(os.path.join(path, LEXICAL_DOCS_FILE), self.docs)
+        np.save(os.path.join(path, LEXICAL_WEIGHTS_FILE), self.weights)
+        with open(os.path.join(path, LEXICAL_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"count": self.count, "terms": len(self.terms), "postings": len(self.docs), "k1": self.k1}, f)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        """以内存映射方式加载倒排表；文件不存在时返回 None"""
+        meta_path = os.path.join(path, LEXICAL_META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        return cls(
+            terms=np.load(os.path.join(path, LEXICAL_TERMS_FILE)),
+            idf=np.load(os.path.join(path, LEXICAL_IDF_FILE)),
+            offsets=np.load(os.path.join(path, LEXICAL_OFFSETS_FILE)),
+            docs=np.load(os.path.join(path, LEXICAL_DOCS_FILE), mmap_mode="r"),
+            weights=np.load(os.path.join(path, LEXICAL_WEIGHTS_FILE), mmap_mode="r"),
+            count=meta["count"],
+            k1=meta.get("k1", BM25_K1),
+        )
+
+    def search(self, query_text: str, k: int, rows: Optional[Rows] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        返回 BM25 最高的 k 个文档的 (下标, 归一化分数)，没有任何词项命中时返回空结果。
+        给定 rows（连续区间或升序下标数组）时只在这些文档中检索；idf 仍按全部文档计算。
+        常见词项（见 COMMON_TERM_DF_RATIO）不参与打分，但仍计入归一化用的最大分数；全部命中词项都是常见词项时保留 idf 最高的一个。
+        """
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query_terms = Counter(tokenize(query_text))
+        if not query_terms or len(self.terms) == 0:
+            return empty
+
+        hashes = np.fromiter((_query_term_hash(term) for term in query_terms), dtype=np.uint64, count=len(query_terms))
+        query_tf = np.fromiter(query_terms.values(), dtype=np.float32, count=len(query_terms))
+        positions = np.minimum(np.searchsorted(self.terms, hashes), len(self.terms) - 1)
+        found = self.terms[positions] == hashes
+        if not found.any():
+            return empty
+        # 该查询可能达到的最大分数：每个查询词项都以 tf -> 无穷命中；知识库中没有的词项按最大 idf 计入
+        unseen_idf = np.log(1.0 + (self.count + 0.5) / 0.5)
+        idf = np.where(found, self.idf[positions], unseen_idf)
+        max_score = float((idf * query_tf).sum() * (self.k1 + 1))
+
+        positions, query_tf, idf = positions[found], query_tf[found], idf[found]
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        keep = lengths <= max(COMMON_TERM_DF_RATIO * self.count, COMMON_TERM_MIN_DF)
+        if not keep.any():
+            keep[np.argmax(idf)] = True
+        starts, lengths, query_tf = starts[keep], lengths[keep], query_tf[keep]
+
+        # 一次性收集所有词项的倒排项下标，不逐个词项切片拼接
+        flat = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+        docs = self.docs[flat]
+        weights = self.weights[flat] * np.repeat(query_tf, lengths)
+        if rows is not None:
+            keep = _in_rows(docs, rows)
+            docs, weights = docs[keep], weights[keep]
+            if len(docs) == 0:
+                return empty
+        scores = np.bincount(docs, weights=weights, minlength=self.count).astype(np.float32) / max_score
+        positions, top_scores = top_k(scores, k)
+        matched = top_scores > 0
+        return positions[matched].astype(np.int64), top_scores[matched]
+
+    def search_batch(self, query_texts: Sequence[str], k: int,
+                     rows: Optional[Rows] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [self.search(query_text, k, rows) for query_text in query_texts]
+
+
+def _in_rows(docs: np.ndarray, rows: Rows) -> np.ndarray:
+    if isinstance(rows, slice):
+        return (docs >= rows.start) & (docs < rows.stop)
+    if len(rows) == 0:
+        return np.zeros(len(docs), dtype=bool)
+    positions = np.minimum(np.searchsorted(rows, docs), len(rows) - 1)
+    return rows[positions] == docs
@@ -1,20 +1,38 @@
 import logging
 import time
+import asyncio
 import uuid
 import json
 import uvicorn
 import base64
 import os
+import secrets
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse,StreamingResponse
 from dotenv import load_dotenv
-from typing import Dict, Any
+from typing import Any
 
 # 导入项目模块
-from MultiModal import extract_text, interpret_image
-from vivogpt import ask_vivogpt,ask_vivogpt_stream
-from rag import VivoEmbeddingClient, KnowledgeBase, RAGSystem, ALL_KNOWLEDGE_EMBEDDING_DATA
-from function_call import parse_function_call, call_web_search_api
+from MultiModal import analyze_images_async
+from vivogpt import ask_vivogpt_async, ask_vivogpt_stream_async
+from rag import VivoEmbeddingClient
+from knowledge_manager import KnowledgeBaseManager
+from function_call import (
+    parse_function_call, parse_search_calls, merge_search_results, call_web_search_api_async,
+    WEB_SEARCH_DEADLINE_SECONDS,
+)
+from http_client import close_async_client
+from pipeline import run_speculative, SPECULATIVE_PIPELINE
+from session_store import create_session_store
+from history_packer import pack_history, image_spans, clean_message
+from history_summarizer import HistorySummarizer
+from token_counter import count_message_tokens, token_meter
+from embedding_cache import create_embedding_cache
+from relevance_classifier import load_relevance_gate
+from search_cache import create_search_cache
+from search_compressor import (
+    compress_search_results, SEARCH_SUMMARY_MODE, SEARCH_SUMMARY_THRESHOLD_CHARS, SEARCH_SUMMARY_MAX_TOKENS,
+)
 from prompt import get_shopping_function_call_prompt,get_normal_function_call_prompt ,get_system_prompt,shopping_relevance_prompt
 
 # 加载环境变量
@@ -23,7 +41,8 @@ load_dotenv()
 # 导入新的 schemas
 from schemas import (
     ModelCard, ModelList, ChatMessage, ChatCompletionRequest,
-    ChatCompletionResponse, ChatCompletionResponseChoice, UsageInfo
+    ChatCompletionResponse, ChatCompletionResponseChoice, UsageInfo,
+    KnowledgeAppendRequest, KnowledgeDeleteRequest
 )
 
 # --- 日志和应用初始化 ---
@@ -38,14 +57,14 @@ app = FastAPI(
     version="1.0.0",
 )
 
-def parse_sse_response(response):
+async def parse_sse_response(response):
     """解析vivo API的SSE流式响应"""
     full_content = ""
     
     try:
-        for line in response.iter_lines():
+        async for line in response.aiter_lines():
             if line:
-                line_str = line.decode('utf-8', errors='ignore').strip()
+                line_str = line.strip()
                 logger.debug(f"收到流式数据行: {line_str}")
                 
                 # 处理data行
@@ -106,7 +125,7 @@ def parse_sse_response(response):
         logger.error(f"解析SSE响应时发生错误: {e}")
         yield f"\n[流式解析错误: {str(e)}]"
 
-def generate_openai_stream(response, request_id, model, user_id, conversation_history):
+async def generate_openai_stream(response, request_id, model, user_id, conversation_history, messages_for_llm=None):
     """生成OpenAI格式的流式响应 - 根据vivo API格式修复"""
     complete_content = ""
     chunk_count = 0
@@ -114,6 +133,7 @@ def generate_openai_stream(response, request_id, model, user_id, conversation_hi
     try:
         # 检查响应状态
         if response.status_code != 200:
+            await response.aread()
             error_msg = f"流式请求失败，状态码: {response.status_code}, 响应: {response.text}"
             logger.error(error_msg)
             
@@ -148,7 +168,7 @@ def generate_openai_stream(response, request_id, model, user_id, conversation_hi
         yield f"data: {json.dumps(start_data)}\n\n"
         
         # 解析并转发内容
-        for chunk in parse_sse_response(response):
+        async for chunk in parse_sse_response(response):
             if chunk:
                 complete_content += chunk
                 chunk_count += 1
@@ -168,7 +188,8 @@ def generate_openai_stream(response, request_id, model, user_id, conversation_hi
         
         logger.info(f"流式响应解析完成，共处理 {chunk_count} 个块，总内容长度: {len(complete_content)}")
         
-        # 发送结束标记
+        # 发送结束标记，并在最后一个块中附带 token 用量
+        prompt_tokens, completion_tokens = token_meter.record_call("final_answer", messages_for_llm or [], complete_content)
         final_data = {
             'id': request_id,
             'object': 'chat.completion.chunk',
@@ -178,30 +199,29 @@ def generate_openai_stream(response, request_id, model, user_id, conversation_hi
                 'index': 0,
                 'delta': {},
                 'finish_reason': 'stop'
-            }]
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens
+            }
         }
         yield f"data: {json.dumps(final_data)}\n\n"
         yield "data: [DONE]\n\n"
         
         # 将完整的回复添加到历史记录
         if complete_content.strip() and user_id:
-            if user_id not in conversation_history:
-                conversation_history[user_id] = []
-            
             assistant_message = {
                 "role": "assistant",
                 "content": complete_content.strip()
             }
-            conversation_history[user_id].append(assistant_message)
-            
-            # 限制历史记录长度
-            max_history = 100
-            if len(conversation_history[user_id]) > max_history * 2:
-                conversation_history[user_id] = conversation_history[user_id][-(max_history * 2):]
+            # 会话存储负责限制历史记录长度，过长时在后台折叠为摘要
+            await conversation_history.append_message_async(user_id, assistant_message)
+            await history_summarizer.maybe_schedule(user_id)
             
             logger.info(f"流式响应完成，已将回复添加到用户 {user_id} 的历史记录")
             logger.info(f"- 完整内容长度: {len(complete_content)}")
-            logger.info(f"- 当前用户历史记录条目数: {len(conversation_history[user_id])}")
+            logger.info(f"- 当前用户历史记录条目数: {await conversation_history.message_count_async(user_id)}")
             logger.info(f"- 完整内容预览: {complete_content[:200]}...")
         else:
             logger.warning(f"流式响应内容为空或用户ID无效。内容长度: {len(complete_content)}, 用户ID: {user_id}")
@@ -211,9 +231,7 @@ def generate_openai_stream(response, request_id, model, user_id, conversation_hi
         
         # 如果已经有部分内容，仍然保存到历史记录
         if complete_content.strip() and user_id:
-            if user_id not in conversation_history:
-                conversation_history[user_id] = []
-            conversation_history[user_id].append({
+            await conversation_history.append_message_async(user_id, {
                 "role": "assistant",
                 "content": complete_content.strip() + f"\n[流式输出中断: {str(e)}]"
             })
@@ -233,8 +251,15 @@ def generate_openai_stream(response, request_id, model, user_id, conversation_hi
         }
         yield f"data: {json.dumps(error_data)}\n\n"
         yield "data: [DONE]\n\n"
+    finally:
+        # 释放上游连接回连接池
+        await response.aclose()
+
 # --- 会话历史管理---
-conversation_history: Dict[str, list] = {}
+conversation_history = create_session_store()
+history_summarizer = HistorySummarizer(conversation_history)
+relevance_gate = load_relevance_gate()
+search_cache = create_search_cache()
 
 # --- RAG 系统初始化 ---
 RAG_APP_ID = os.getenv('VIVO_APP_ID')
@@ -245,9 +270,11 @@ RAG_API_URI = os.getenv('RAG_API_URI')
 if not all([RAG_APP_ID, RAG_APP_KEY, RAG_API_DOMAIN, RAG_API_URI]):
     raise ValueError("请在.env文件中配置RAG_APP_ID,RAG_APP_KEY, RAG_API_DOMAIN 和 RAG_API_URI。")
 
+# 管理员接口令牌（用于 /v1/admin/reload-knowledge），未配置时管理员接口不可用
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 embedding_client_rag = None
-knowledge_base_rag = None
-rag_system_instance = None
+knowledge_manager = None
 
 if True:#某些调用RAG的逻辑RAG_APP_ID != 'YOUR_VIVO_APP_ID' and RAG_APP_KEY != 'YOUR_VIVO_APP_KEY':
     try:
@@ -255,23 +282,45 @@ if True:#某些调用RAG的逻辑RAG_APP_ID != 'YOUR_VIVO_APP_ID' and RAG_APP_KE
             app_id=RAG_APP_ID,
             app_key=RAG_APP_KEY,
             domain=RAG_API_DOMAIN,
-            uri=RAG_API_URI
+            uri=RAG_API_URI,
+            cache=create_embedding_cache(VivoEmbeddingClient.model_name)
         )
-        
-        knowledge_base_rag = KnowledgeBase()
-        knowledge_base_rag.load_knowledge_from_list(ALL_KNOWLEDGE_EMBEDDING_DATA)
-        
-        if knowledge_base_rag.embeddings_matrix is not None and knowledge_base_rag.embeddings_matrix.shape[0] > 0:
-            rag_system_instance = RAGSystem(embedding_client_rag, knowledge_base_rag)
-            logger.info("RAG 系统初始化成功。")
-        else:
-            logger.warning("知识库为空或加载失败，RAG 系统将不可用。")
+        # 知识库可在运行中重建并原子替换，检索时通过 knowledge_manager.acquire() 获取当前的 RAGSystem
+        knowledge_manager = KnowledgeBaseManager(embedding_client_rag)
+        knowledge_manager.load_initial()
     except Exception as e:
         logger.error(f"RAG 系统初始化失败: {e}", exc_info=True)
-        rag_system_instance = None
 else:
     logger.warning("RAG_APP_ID 或 RAG_APP_KEY 未配置。RAG 系统将不可用。")
 
+def current_rag_system():
+    """当前的 RAGSystem，知识库不可用时为 None"""
+    return knowledge_manager.rag_system if knowledge_manager is not None else None
+
+def knowledge_base_size() -> int:
+    rag_system = current_rag_system()
+    return len(rag_system.knowledge_base) if rag_system is not None else 0
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """启动会话过期清理任务、知识库文件监听与增量段合并"""
+    conversation_history.start_sweeper()
+    if knowledge_manager is not None:
+        knowledge_manager.start_background_tasks()
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    """应用关闭时停止后台任务并释放共享HTTP连接池"""
+    await conversation_history.stop_sweeper()
+    if knowledge_manager is not None:
+        await knowledge_manager.stop_background_tasks()
+    await history_summarizer.shutdown()
+    if embedding_client_rag is not None and embedding_client_rag.cache is not None:
+        await embedding_client_rag.cache.flush()
+    if search_cache is not None:
+        await search_cache.flush()
+    await close_async_client()
+
 # --- 标准化错误处理 ---
 @app.exception_handler(HTTPException)
 async def handle_http_exception(request: Request, exc: HTTPException):
@@ -321,6 +370,191 @@ def determine_user_type(messages: list) -> str:
     """根据消息内容判断用户类型"""
     return "学生"
 
+async def check_shopping_relevance(merged_text: str, model: str) -> bool:
+    """调用LLM判断用户问题是否与购物相关，判断失败时默认为购物相关"""
+    shopping_check_messages = [
+        {"role": "user", "content": shopping_relevance_prompt(merged_text)}
+    ]
+
+    logger.info("开始购物相关性判断...")
+
+    shopping_relevance_response, relevance_error = await ask_vivogpt_async(
+        messages=shopping_check_messages,
+        model=model,
+        extra={"temperature": 0.1, "max_tokens": 10}
+    )
+    token_meter.record_call("relevance", shopping_check_messages, shopping_relevance_response)
+
+    is_shopping_related = False
+    if shopping_relevance_response:
+        relevance_clean = shopping_relevance_response.strip().lower()
+        is_shopping_related = "是" in relevance_clean or "yes" in relevance_clean
+        logger.info(f"购物相关性判断结果: {shopping_relevance_response.strip()} -> {is_shopping_related}")
+    else:
+        logger.warning(f"购物相关性判断失败: {relevance_error}，默认为购物相关")
+        is_shopping_related = True  # 默认为购物相关，避免误判
+    return is_shopping_related
+
+async def web_search(search_query: str, search_params: dict, user_id: str) -> dict:
+    """调用联网搜索；启用 SEARCH_CACHE 时相同的搜索在有效期内直接返回缓存结果"""
+    async def fetch():
+        return await call_web_search_api_async(search_query=search_query, user_id=user_id, **search_params)
+
+    if search_cache is None:
+        return await fetch()
+    return await search_cache.get_or_fetch(search_query, search_params, fetch)
+
+def search_request_from_params(func_params: dict):
+    """从 web_search 调用的 parameters 中提取 (search_query, 其余搜索参数)；parameters 需已由 parse_search_calls 过滤"""
+    search_query = str(func_params["search_query"]).strip()
+    search_params = {
+        "search_engine": func_params.get("search_engine", "search_std"),
+        "search_intent": bool(func_params.get("search_intent", False)),
+        "count": int(func_params.get("count", 10)),
+        "search_domain_filter": func_params.get("search_domain_filter"),
+        "search_recency_filter": func_params.get("search_recency_filter", "noLimit"),
+        "content_size": func_params.get("content_size", "medium"),
+        "request_id": func_params.get("request_id"),
+    }
+    return search_query, search_params
+
+async def run_web_searches(searches: list, user_id: str) -> dict:
+    """
+    并发执行多个搜索，共享 WEB_SEARCH_DEADLINE_SECONDS 截止时间；到期未返回的搜索被取消并记为失败。
+    返回按链接去重合并后的结果（见 function_call.merge_search_results）。
+    """
+    tasks = [asyncio.create_task(web_search(query, params, user_id)) for query, params in searches]
+    done, pending = await asyncio.wait(tasks, timeout=WEB_SEARCH_DEADLINE_SECONDS)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+        logger.warning(f"{len(pending)}/{len(tasks)} 个联网搜索在 {WEB_SEARCH_DEADLINE_SECONDS} 秒内未返回，已取消")
+
+    results = []
+    for (query, _), task in zip(searches, tasks):
+        if task in done and task.exception() is None:
+            results.append((query, task.result()))
+        else:
+            error = task.exception() if task in done else "超时"
+            results.append((query, {"error": f"Web Search 调用失败: {error}"}))
+    return merge_search_results(results)
+
+def format_search_content(search_result, failed_searches=None) -> str:
+    """web_search 函数消息的内容；部分搜索失败时一并附上失败的查询与原因"""
+    content = {"search_result": search_result}
+    if failed_searches:
+        content["failed_searches"] = failed_searches
+    return json.dumps(content, ensure_ascii=False)
+
+async def summarize_search_result_llm(core_result_str: str, search_query: str, is_shopping_related: bool,
+                                      model: str, extra_params: dict):
+    """调用LLM把搜索结果总结为摘要（SEARCH_SUMMARY_MODE=llm），失败时返回 None"""
+    if is_shopping_related:
+        summarization_prompt = (
+            f"你是一个信息处理助手。请将以下联网搜索结果总结为一段保留核心信息的摘要，特别关注价格,品质,平台可信度等和购物诈骗有关的的关键信息，以便后续用于回答用户关于'{search_query}'的问题。请直接输出摘要内容，不要添加任何额外解释。\n\n"
+            f"原始搜索结果:\n{core_result_str}"
+        )
+    else:
+        summarization_prompt = (
+            f"你是一个信息处理助手。请将以下联网搜索结果总结为一段保留核心信息的摘要，以便后续用于回答用户关于'{search_query}'的问题。请直接输出摘要内容，不要添加任何额外解释。\n\n"
+            f"原始搜索结果:\n{core_result_str}"
+        )
+
+    summarization_messages = [
+        {"role": "user", "content": summarization_prompt}
+    ]
+
+    summary, summary_error = await ask_vivogpt_async(
+        messages=summarization_messages,
+        model=model,
+        extra={**extra_params, "max_tokens": SEARCH_SUMMARY_MAX_TOKENS}
+    )
+    token_meter.record_call("search_summary", summarization_messages, summary)
+
+    if summary:
+        logger.info(f"搜索结果摘要成功: {summary[:200]}...")
+        return summary
+    logger.warning(f"搜索结果摘要失败: {summary_error}。将使用抽取式压缩。")
+    return None
+
+async def retrieve_rag_context(request: ChatCompletionRequest, merged_text: str) -> str:
+    """执行RAG检索，返回格式化后的背景知识（可能为空字符串）"""
+    retrieved_rag_context = ""
+    if not request.enable_rag:
+        logger.info("RAG: 用户禁用了RAG检索功能")
+        return retrieved_rag_context
+    if knowledge_manager is None:
+        logger.info("RAG: 系统未初始化或知识库为空，跳过 RAG 检索")
+        return retrieved_rag_context
+
+    # 检索期间持有当前一代知识库，热更新替换后旧知识库会等到这里结束才被释放
+    async with knowledge_manager.acquire() as rag_system:
+        if rag_system is None:
+            logger.info("RAG: 系统未初始化或知识库为空，跳过 RAG 检索")
+            return retrieved_rag_context
+        try:
+            logger.info(f"RAG: 启用RAG检索，使用查询 \"{merged_text[:100]}...\" 进行检索")
+            rag_top_k = request.rag_top_k or 2
+            retrieved_rag_context = await rag_system.retrieve_and_format_async(
+                merged_text, top_n=rag_top_k,
+                risk_types=request.rag_risk_types,
+                exclude_risk_types=request.rag_exclude_risk_types,
+                per_risk_type=request.rag_per_risk_type,
+            )
+            if retrieved_rag_context:
+                logger.info(f"RAG: 检索到的上下文长度: {len(retrieved_rag_context)}")
+                logger.info(f"RAG: 检索到的上下文:\n{retrieved_rag_context[:200]}...")
+            else:
+                logger.info("RAG: 未检索到相关上下文。")
+        except Exception as e:
+            logger.error(f"RAG 检索过程中发生错误: {e}", exc_info=True)
+            retrieved_rag_context = ""
+    return retrieved_rag_context
+
+async def run_tool_decision(is_shopping_related: bool, request: ChatCompletionRequest, merged_text: str,
+                            user_type: str, extra_params: dict):
+    """RAG检索（仅购物相关）与第一次LLM调用（工具判断），返回 (llm_response_raw, time_cost)"""
+    if is_shopping_related:
+        retrieved_rag_context = await retrieve_rag_context(request, merged_text)
+    else:
+        retrieved_rag_context = ""
+        logger.info("购物相关性判断结果为否，跳过 RAG 检索")
+
+    # 6. 构造LLM输入
+
+    # 准备传递给大模型的内容，可能已用RAG上下文增强
+    content_for_llm = merged_text
+    if retrieved_rag_context:
+        content_for_llm = f"请参考以下背景知识:\n---\n{retrieved_rag_context}\n---\n\n用户的原始问题是:\n{merged_text}"
+        logger.info(f"传递给LLM的增强内容 (带RAG):\n{content_for_llm[:300]}...")
+    else:
+        logger.info(f"传递给LLM的内容 (无RAG):\n{content_for_llm[:300]}...")
+
+    # 9. 第一次LLM调用：判断是否需要工具,以及和购物相关调用不同prompt
+    if is_shopping_related:
+        function_call_system_prompt = get_shopping_function_call_prompt(user_type)
+    else:
+        function_call_system_prompt = get_normal_function_call_prompt(user_type)
+
+    messages_for_llm = [
+        {"role": "user", 
+         "content": f"这是用户的问题:{content_for_llm}"
+        },
+        {"role": "system",
+        "content": function_call_system_prompt
+        }
+    ]
+
+    logger.info("开始第一次LLM调用（工具判断）...")
+    llm_response_raw, time_cost = await ask_vivogpt_async(
+        messages=messages_for_llm,
+        model=request.model,
+        extra=extra_params
+    )
+    token_meter.record_call("tool_decision", messages_for_llm, llm_response_raw)
+    return llm_response_raw, time_cost
+
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
 async def create_chat_completion(request: ChatCompletionRequest):
     """处理聊天补全请求，完全复制原server.py的功能逻辑。"""
@@ -389,35 +623,30 @@ async def create_chat_completion(request: ChatCompletionRequest):
         text_parts = []
         try:
             if has_image:
-                # 处理图片消息 (先OCR，再图片理解)
-                for msg in converted_messages:
-                    if msg.get("contentType") == "image":
-                        base64_str = msg.get("content", "")
-                        if not base64_str:
-                            continue
-                        
-                        logger.info("开始OCR文字提取...")
-                        # OCR文字提取
-                        ocr_text, ocr_error = extract_text(base64_str, temperature=0.1)
-                        if ocr_error:
-                            logger.error(f"OCR图片文字提取失败: {ocr_error}")
-                        else:
-                            logger.info(f"OCR提取成功，文字长度: {len(ocr_text) if ocr_text else 0}")
-                            if ocr_text and ocr_text.strip():
-                                text_parts.append(f"[用户发了一张图片,图片文字内容为]:\n{ocr_text.strip()}")
-                        
-                        logger.info("开始图片理解...")
-                        # 图片理解 (使用默认prompt)
-                        img_desc, img_error = interpret_image(
-                            base64_str,
-                            temperature=0.9
-                        )
-                        if img_error:
-                            logger.error(f"图片理解失败: {img_error}")
-                        else:
-                            logger.info(f"图片理解成功，描述长度: {len(img_desc) if img_desc else 0}")
-                            if img_desc and img_desc.strip():
-                                text_parts.append(f"[用户发了张图片,图片描述为]:\n{img_desc.strip()}")
+                # 处理图片消息：所有图片的OCR与图片理解同时发出
+                images = [
+                    msg.get("content", "") for msg in converted_messages
+                    if msg.get("contentType") == "image" and msg.get("content")
+                ]
+                logger.info(f"开始并发处理 {len(images)} 张图片 (OCR + 图片理解)...")
+                image_results = await analyze_images_async(images)
+
+                for result in image_results:
+                    ocr_text, ocr_error = result["ocr_text"], result["ocr_error"]
+                    if ocr_error:
+                        logger.error(f"OCR图片文字提取失败: {ocr_error}")
+                    else:
+                        logger.info(f"OCR提取成功，文字长度: {len(ocr_text) if ocr_text else 0}")
+                        if ocr_text and ocr_text.strip():
+                            text_parts.append(f"[用户发了一张图片,图片文字内容为]:\n{ocr_text.strip()}")
+
+                    img_desc, img_error = result["description"], result["description_error"]
+                    if img_error:
+                        logger.error(f"图片理解失败: {img_error}")
+                    else:
+                        logger.info(f"图片理解成功，描述长度: {len(img_desc) if img_desc else 0}")
+                        if img_desc and img_desc.strip():
+                            text_parts.append(f"[用户发了张图片,图片描述为]:\n{img_desc.strip()}")
                 
                 # 文本消息放在图片内容之后
                 for msg in converted_messages:
@@ -443,81 +672,21 @@ async def create_chat_completion(request: ChatCompletionRequest):
 
         logger.info(f"原始合并后的文本内容: {merged_text[:]}...")
 
-        shopping_check_messages = [
-            {"role": "user", "content": shopping_relevance_prompt(merged_text)}
-        ]
-
-        logger.info("开始购物相关性判断...")
-
-        shopping_relevance_response, relevance_error = ask_vivogpt(
-            messages=shopping_check_messages,
-            model=request.model,
-            extra={"temperature": 0.1, "max_tokens": 10}
-        )
-
-        is_shopping_related = False
-        if shopping_relevance_response:
-            relevance_clean = shopping_relevance_response.strip().lower()
-            is_shopping_related = "是" in relevance_clean or "yes" in relevance_clean
-            logger.info(f"购物相关性判断结果: {shopping_relevance_response.strip()} -> {is_shopping_related}")
-        else:
-            logger.warning(f"购物相关性判断失败: {relevance_error}，默认为购物相关")
-            is_shopping_related = True  # 默认为购物相关，避免误判
-        
-        # 会话历史管理
-        if user_id not in conversation_history:
-            conversation_history[user_id] = []
-
-        # 确保会话历史不超过最大长度
-        max_history = 100
-        history_messages = conversation_history[user_id][-(max_history * 2):]
+        # 会话历史管理（长度与内存上限由会话存储负责）
+        history_messages = await conversation_history.get_history_async(user_id)
 
         # 为历史记录存储原始用户消息
         original_user_message_for_history = {
             "role": "user",
             "content": merged_text
         }
+        if has_image:
+            # 记录图片块位置，后续轮次打包历史时用于截断旧的OCR/图片描述
+            original_user_message_for_history["_image_spans"] = image_spans(text_parts)
 
         # 将用户的原始消息添加到历史记录
         if not history_messages or history_messages[-1].get("content") != original_user_message_for_history["content"]:
-            conversation_history[user_id].append(original_user_message_for_history)
-
-        # 5. RAG检索 (改为可选)
-        if is_shopping_related:
-            retrieved_rag_context = ""
-            
-            # 检查是否启用RAG
-            if request.enable_rag and rag_system_instance:
-                try:
-                    logger.info(f"RAG: 启用RAG检索，使用查询 \"{merged_text[:100]}...\" 进行检索")
-                    rag_top_k = request.rag_top_k or 2
-                    retrieved_rag_context = rag_system_instance.retrieve_and_format(merged_text, top_n=rag_top_k)
-                    if retrieved_rag_context:
-                        logger.info(f"RAG: 检索到的上下文长度: {len(retrieved_rag_context)}")
-                        logger.info(f"RAG: 检索到的上下文:\n{retrieved_rag_context[:200]}...")
-                    else:
-                        logger.info("RAG: 未检索到相关上下文。")
-                except Exception as e:
-                    logger.error(f"RAG 检索过程中发生错误: {e}", exc_info=True)
-                    retrieved_rag_context = ""
-            elif not request.enable_rag:
-                logger.info("RAG: 用户禁用了RAG检索功能")
-            elif not rag_system_instance:
-                logger.info("RAG: 系统未初始化或知识库为空，跳过 RAG 检索")
-        
-        else:
-            retrieved_rag_context = ""
-            logger.info("购物相关性判断结果为否，跳过 RAG 检索")
-
-        # 6. 构造LLM输入
-
-        # 准备传递给大模型的内容，可能已用RAG上下文增强
-        content_for_llm = merged_text
-        if retrieved_rag_context:
-            content_for_llm = f"请参考以下背景知识:\n---\n{retrieved_rag_context}\n---\n\n用户的原始问题是:\n{merged_text}"
-            logger.info(f"传递给LLM的增强内容 (带RAG):\n{content_for_llm[:300]}...")
-        else:
-            logger.info(f"传递给LLM的内容 (无RAG):\n{content_for_llm[:300]}...")
+            await conversation_history.append_message_async(user_id, original_user_message_for_history)
 
         # 8. 准备extra参数
         extra_params = request.extra or {}
@@ -525,27 +694,31 @@ async def create_chat_completion(request: ChatCompletionRequest):
         extra_params.setdefault("max_tokens", request.max_tokens or 1024)
         extra_params.setdefault("top_p", request.top_p or 1.0)
 
-        # 9. 第一次LLM调用：判断是否需要工具,以及和购物相关调用不同prompt
-        if is_shopping_related:
-            function_call_system_prompt = get_shopping_function_call_prompt(user_type)
+        # 5-9. 购物相关性判断、RAG检索、第一次LLM调用（工具判断）
+        # 本地分类器置信度足够时直接采用其结果，省去相关性判断的 LLM 调用与推测执行
+        local_relevance, relevance_probability = relevance_gate.decide(merged_text)
+        if local_relevance is not None:
+            is_shopping_related = local_relevance
+            logger.info(f"购物相关性本地判断: p={relevance_probability:.3f} -> {is_shopping_related}")
+            llm_response_raw, time_cost = await run_tool_decision(
+                is_shopping_related, request, merged_text, user_type, extra_params
+            )
+        elif SPECULATIVE_PIPELINE == "off":
+            is_shopping_related = await check_shopping_relevance(merged_text, request.model)
+            llm_response_raw, time_cost = await run_tool_decision(
+                is_shopping_related, request, merged_text, user_type, extra_params
+            )
         else:
-            function_call_system_prompt = get_normal_function_call_prompt(user_type)
-
-        messages_for_llm = [
-            {"role": "user", 
-             "content": f"这是用户的问题:{content_for_llm}"
-            },
-            {"role": "system",
-            "content": function_call_system_prompt
-            }
-        ]
-
-        logger.info("开始第一次LLM调用（工具判断）...")
-        llm_response_raw, time_cost = ask_vivogpt(
-            messages=messages_for_llm,
-            model=request.model,
-            extra=extra_params
-        )
+            # 相关性判断与两个分支的 RAG/工具判断同时进行，判断结果返回后取消未命中的分支
+            speculate = [True, False] if SPECULATIVE_PIPELINE == "all" else [True]
+            is_shopping_related, (llm_response_raw, time_cost) = await run_speculative(
+                check_shopping_relevance(merged_text, request.model),
+                {
+                    flag: (lambda flag=flag: run_tool_decision(flag, request, merged_text, user_type, extra_params))
+                    for flag in (True, False)
+                },
+                speculate,
+            )
 
         if llm_response_raw is None:
             logger.error(f"function_call模型推理失败: {time_cost}")
@@ -559,37 +732,17 @@ async def create_chat_completion(request: ChatCompletionRequest):
         if func_call_str:
             logger.info("检测到函数调用，开始执行...")
             
+            search_query = ""
             try:
-                func_calls = json.loads(func_call_str)
-                if isinstance(func_calls, list) and func_calls:
-                    func_params = func_calls[0].get("parameters", {})
-                elif isinstance(func_calls, dict):
-                    func_params = func_calls.get("parameters", {})
+                search_calls = parse_search_calls(func_call_str)
+                if not search_calls:
+                    logger.warning(f"Function call string '{func_call_str}' 中没有带 search_query 的调用，不执行搜索。")
+                    function_result = {"error": "function call 中没有可用的 search_query"}
                 else:
-                    func_params = {}
-                    logger.warning(f"Function call string '{func_call_str}' 解析后不是预期的列表或字典结构。")
-
-                # 提取搜索参数
-                search_query = func_params.get("search_query", "测试搜索关键词")
-                search_engine = func_params.get("search_engine", "search_std")
-                search_intent = bool(func_params.get("search_intent", False))
-                count = int(func_params.get("count", 10))
-                search_domain_filter = func_params.get("search_domain_filter")
-                search_recency_filter = func_params.get("search_recency_filter", "noLimit")
-                content_size = func_params.get("content_size", "medium")
-                request_id_param = func_params.get("request_id")
-
-                function_result = call_web_search_api(
-                    search_query=search_query,
-                    search_engine=search_engine,
-                    search_intent=search_intent,
-                    count=count,
-                    search_domain_filter=search_domain_filter,
-                    search_recency_filter=search_recency_filter,
-                    content_size=content_size,
-                    request_id=request_id_param,
-                    user_id=user_id
-                )
+                    # 提取搜索参数，多个搜索并发执行并合并结果
+                    searches = [search_request_from_params(func_params) for func_params in search_calls]
+                    search_query = "；".join(query for query, _ in searches)
+                    function_result = await run_web_searches(searches, user_id)
             except json.JSONDecodeError as json_ex:
                 logger.warning(f"Function call JSON解析失败: {json_ex}. Raw string: '{func_call_str}'")
                 function_result = {"error": "invalid function call JSON format"}
@@ -600,50 +753,42 @@ async def create_chat_completion(request: ChatCompletionRequest):
             logger.info(f"web_search联网搜索返回: {json.dumps(function_result, ensure_ascii=False)}")
             
             core_result = function_result.get("search_result", function_result)
+            failed_searches = function_result.get("failed_searches")
             
-            # 搜索结果摘要处理
+            # 搜索结果压缩：默认本地抽取式压缩，SEARCH_SUMMARY_MODE=llm 时调用 LLM 生成摘要
             final_search_content_for_llm = ""
             try:
                 core_result_str = json.dumps(core_result, ensure_ascii=False)
-                
-                if len(core_result_str) > 1500:
-                    logger.info(f"搜索结果过长 ({len(core_result_str)} chars)，将进行摘要。")
-                    
-                    if is_shopping_related:
-                        summarization_prompt = (
-                            f"你是一个信息处理助手。请将以下联网搜索结果总结为一段保留核心信息的摘要，特别关注价格,品质,平台可信度等和购物诈骗有关的的关键信息，以便后续用于回答用户关于'{search_query}'的问题。请直接输出摘要内容，不要添加任何额外解释。\n\n"
-                            f"原始搜索结果:\n{core_result_str}"
-                        )
-                    
-                    else:
-                        summarization_prompt = (
-                            f"你是一个信息处理助手。请将以下联网搜索结果总结为一段保留核心信息的摘要，以便后续用于回答用户关于'{search_query}'的问题。请直接输出摘要内容，不要添加任何额外解释。\n\n"
-                            f"原始搜索结果:\n{core_result_str}"
+
+                if len(core_result_str) > SEARCH_SUMMARY_THRESHOLD_CHARS and SEARCH_SUMMARY_MODE != "off":
+                    logger.info(f"搜索结果过长 ({len(core_result_str)} chars)，将进行压缩 ({SEARCH_SUMMARY_MODE})。")
+
+                    summary = None
+                    if SEARCH_SUMMARY_MODE == "llm":
+                        summary = await summarize_search_result_llm(
+                            core_result_str, search_query, is_shopping_related, request.model, extra_params
                         )
-                    
-                    summarization_messages = [
-                        {"role": "user", "content": summarization_prompt}
-                    ]
-                    
-                    summary, summary_error = ask_vivogpt(
-                        messages=summarization_messages,
-                        model=request.model,
-                        extra=extra_params
-                    )
-                    
                     if summary:
-                        final_search_content_for_llm = summary
-                        logger.info(f"搜索结果摘要成功: {final_search_content_for_llm[:200]}...")
+                        final_search_content_for_llm = (
+                            format_search_content(summary, failed_searches) if failed_searches else summary
+                        )
                     else:
-                        logger.warning(f"搜索结果摘要失败: {summary_error}。将使用原始搜索结果。")
-                        final_search_content_for_llm = json.dumps({"search_result": core_result}, ensure_ascii=False)
+                        compressed = compress_search_results(core_result, search_query, shopping=is_shopping_related)
+                        if compressed:
+                            final_search_content_for_llm = format_search_content(compressed, failed_searches)
+                            logger.info(
+                                f"搜索结果抽取式压缩: {len(core_result_str)} -> {len(final_search_content_for_llm)} chars"
+                            )
+                        else:
+                            logger.info("搜索结果中没有与问题相关的句子，使用原始结果。")
+                            final_search_content_for_llm = format_search_content(core_result, failed_searches)
                 else:
-                    logger.info("搜索结果长度适中，无需摘要，使用原始结果。")
-                    final_search_content_for_llm = json.dumps({"search_result": core_result}, ensure_ascii=False)
+                    logger.info("搜索结果长度适中，无需压缩，使用原始结果。")
+                    final_search_content_for_llm = format_search_content(core_result, failed_searches)
 
             except Exception as e:
-                logger.error(f"处理搜索结果摘要时发生意外错误: {e}", exc_info=True)
-                final_search_content_for_llm = json.dumps({"search_result": core_result}, ensure_ascii=False)
+                logger.error(f"处理搜索结果压缩时发生意外错误: {e}", exc_info=True)
+                final_search_content_for_llm = format_search_content(core_result, failed_searches)
 
             # 11. 第二次LLM调用：生成最终回复
             if is_shopping_related:
@@ -652,9 +797,11 @@ async def create_chat_completion(request: ChatCompletionRequest):
                 system_prompt_for_final_answer = "你是一个智能助手，旨在回答用户的问题。请根据用户的提问和提供的背景信息生成准确的回复。"
 
             messages_for_final_llm = [{"role": "system", "content": system_prompt_for_final_answer}]
-            updated_history_messages = conversation_history[user_id][-(max_history * 2):-1]
+            updated_history_messages = pack_history((await conversation_history.get_history_async(user_id))[:-1])
+            # 单独记录历史窗口占用的 token 数（已计入 final_answer 的 prompt_tokens）
+            token_meter.record("history_window", prompt_tokens=count_message_tokens(updated_history_messages))
             messages_for_final_llm.extend(updated_history_messages)
-            messages_for_final_llm.append(original_user_message_for_history)
+            messages_for_final_llm.append(clean_message(original_user_message_for_history))
             messages_for_final_llm.append({
                 "role": "assistant",
                 "content": llm_response_raw
@@ -675,32 +822,37 @@ async def create_chat_completion(request: ChatCompletionRequest):
                 system_prompt_for_final_answer = "你是一个智能助手，旨在回答用户的问题。"
             
             messages_for_final_llm = [{"role": "system", "content": system_prompt_for_final_answer}]
-            updated_history_messages = conversation_history[user_id][-(max_history * 2):-1]
+            updated_history_messages = pack_history((await conversation_history.get_history_async(user_id))[:-1])
+            # 单独记录历史窗口占用的 token 数（已计入 final_answer 的 prompt_tokens）
+            token_meter.record("history_window", prompt_tokens=count_message_tokens(updated_history_messages))
             messages_for_final_llm.extend(updated_history_messages)
-            messages_for_final_llm.append(original_user_message_for_history)
+            messages_for_final_llm.append(clean_message(original_user_message_for_history))
 
         # ========== 这里决定是否使用流式输出 ==========
         if request.stream:
             # 流式响应
             logger.info("使用流式输出生成最终回复")
             
-            stream_response = ask_vivogpt_stream(
+            stream_response = await ask_vivogpt_stream_async(
                 messages=messages_for_final_llm,
                 model=request.model,
                 extra=extra_params
             )
             
             if stream_response is None or stream_response.status_code != 200:
+                if stream_response is not None:
+                    await stream_response.aclose()
                 raise HTTPException(status_code=500, detail="流式模型推理失败")
 
             return StreamingResponse(
-                generate_openai_stream(stream_response, request_id, request.model, user_id, conversation_history),
+                generate_openai_stream(stream_response, request_id, request.model, user_id, conversation_history,
+                                       messages_for_final_llm),
                 media_type="text/plain",
                 headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
             )
         else:
             # 非流式响应（保持原有逻辑）
-            final_answer_from_llm, error_message = ask_vivogpt(
+            final_answer_from_llm, error_message = await ask_vivogpt_async(
                 messages=messages_for_final_llm,
                 model=request.model,
                 extra=extra_params
@@ -709,16 +861,17 @@ async def create_chat_completion(request: ChatCompletionRequest):
             if final_answer_from_llm is None:
                 logger.error("最终模型推理失败")
                 logger.error(f"错误信息: {error_message}")
-                conversation_history[user_id].append({"role": "assistant", "content": "抱歉，我处理后续信息时遇到了点问题。"})
+                await conversation_history.append_message_async(user_id, {"role": "assistant", "content": "抱歉，我处理后续信息时遇到了点问题。"})
                 raise HTTPException(status_code=500, detail="最终模型推理失败")
             
             logger.info(f"最终大模型推理成功: 响应内容={final_answer_from_llm}")
             final_reply_to_user = final_answer_from_llm
 
-            conversation_history[user_id].append({
+            await conversation_history.append_message_async(user_id, {
                 "role": "assistant",
                 "content": final_reply_to_user
             })
+            await history_summarizer.maybe_schedule(user_id)
             
             # 返回标准响应
             response_message = ChatMessage(role="assistant", content=final_answer_from_llm)
@@ -728,8 +881,9 @@ async def create_chat_completion(request: ChatCompletionRequest):
                 finish_reason="stop"
             )
             
-            prompt_tokens = sum(len(str(msg.get("content", ""))) for msg in messages_for_final_llm) // 4
-            completion_tokens = len(final_answer_from_llm) // 4
+            prompt_tokens, completion_tokens = token_meter.record_call(
+                "final_answer", messages_for_final_llm, final_answer_from_llm
+            )
             usage = UsageInfo(
                 prompt_tokens=prompt_tokens,
                 completion_tokens=completion_tokens,
@@ -765,30 +919,103 @@ async def root():
 @app.get("/v1/health")
 async def health_check():
     """健康检查端点"""
+    session_stats = await conversation_history.stats_async()
     return {
         "status": "healthy",
         "timestamp": int(time.time()),
-        "rag_available": rag_system_instance is not None,
-        "active_sessions": len(conversation_history),
+        "rag_available": current_rag_system() is not None,
+        "active_sessions": session_stats["sessions"],
+        "session_store": session_stats,
         "system_info": {
-            "rag_initialized": rag_system_instance is not None,
-            "knowledge_base_size": len(ALL_KNOWLEDGE_EMBEDDING_DATA) if ALL_KNOWLEDGE_EMBEDDING_DATA else 0
+            "rag_initialized": current_rag_system() is not None,
+            "knowledge_base_size": knowledge_base_size()
         }
     }
 
+def rag_stats() -> dict:
+    rag_system = current_rag_system()
+    knowledge_base = rag_system.knowledge_base if rag_system is not None else None
+    return {
+        "rag_status": "available" if rag_system else "unavailable",
+        "knowledge_base_entries": knowledge_base_size(),
+        "knowledge_base_format": knowledge_base.source_format if knowledge_base is not None else None,
+        "knowledge_base_reload": knowledge_manager.stats() if knowledge_manager is not None else None,
+        "rag_search_mode": rag_system.search_mode if rag_system else None,
+        "rag_vector_storage": knowledge_base.vector_storage if knowledge_base is not None else None,
+        "rag_retrieval": rag_system.stats() if rag_system else None,
+        "rag_batching": rag_system.batcher.stats() if rag_system and rag_system.batcher else None,
+        "embedding_cache": (
+            embedding_client_rag.cache.stats()
+            if embedding_client_rag is not None and embedding_client_rag.cache else None
+        )
+    }
+
 @app.get("/v1/stats")
 async def get_stats():
     """获取服务器统计信息"""
+    session_stats = await conversation_history.stats_async()
     return {
-        "active_sessions": len(conversation_history),
-        "total_messages": sum(len(history) for history in conversation_history.values()),
-        "rag_status": "available" if rag_system_instance else "unavailable",
-        "knowledge_base_entries": len(ALL_KNOWLEDGE_EMBEDDING_DATA) if ALL_KNOWLEDGE_EMBEDDING_DATA else 0
+        "active_sessions": session_stats["sessions"],
+        "total_messages": session_stats["messages"],
+        "session_store": session_stats,
+        "history_summaries": history_summarizer.stats(),
+        "relevance_classifier": relevance_gate.stats(),
+        "search_cache": search_cache.stats() if search_cache is not None else None,
+        "token_usage": token_meter.stats(),
+        **rag_stats(),
     }
 
+def verify_admin(request: Request):
+    """校验 Authorization: Bearer <ADMIN_TOKEN> 或 X-Admin-Token 请求头；未配置 ADMIN_TOKEN 时拒绝所有请求"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理员接口未启用（未配置 ADMIN_TOKEN）")
+    token = request.headers.get("x-admin-token", "")
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if not secrets.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="管理员令牌无效")
+    if knowledge_manager is None:
+        raise HTTPException(status_code=503, detail="RAG 系统未初始化")
+
+@app.post("/v1/admin/reload-knowledge")
+async def reload_knowledge(request: Request):
+    """
+    重新加载知识库（编译目录或 JSON），构建完成后原子替换，进行中的检索继续使用旧知识库直到完成。
+    多 worker 部署时本接口只重载处理该请求的 worker，请改用 KNOWLEDGE_WATCH_INTERVAL_SECONDS 文件监听。
+    """
+    verify_admin(request)
+    result = await knowledge_manager.reload(reason="admin")
+    if result["status"] != "ok":
+        raise HTTPException(status_code=500, detail="知识库重建失败或为空，继续使用原知识库")
+    return result
+
+@app.post("/v1/admin/knowledge/entries")
+async def append_knowledge_entries(request: Request, body: KnowledgeAppendRequest):
+    """追加知识库条目：只为新文本计算向量并写入增量段，已存在的相同文本会被跳过"""
+    verify_admin(request)
+    try:
+        return await knowledge_manager.append_entries([(entry.text, entry.riskType) for entry in body.entries])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+@app.post("/v1/admin/knowledge/delete")
+async def delete_knowledge_entries(request: Request, body: KnowledgeDeleteRequest):
+    """按文本删除知识库条目，合并前以删除标记的形式生效"""
+    verify_admin(request)
+    return await knowledge_manager.delete_entries(body.texts)
+
+@app.post("/v1/admin/knowledge/compact")
+async def compact_knowledge(request: Request):
+    """立即把增量段与删除标记合并进基础段"""
+    verify_admin(request)
+    return await knowledge_manager.compact(reason="admin")
+
 # --- 运行服务器 ---
 if __name__ == "__main__":
     logger.info("启动 OpenAI-Compatible FastAPI 服务器...")
-    logger.info(f"RAG系统状态: {'可用' if rag_system_instance else '不可用'}")
-    logger.info(f"知识库条目数: {len(ALL_KNOWLEDGE_EMBEDDING_DATA) if ALL_KNOWLEDGE_EMBEDDING_DATA else 0}")
+    logger.info(f"RAG系统状态: {'可用' if current_rag_system() else '不可用'}")
+    logger.info(f"知识库条目数: {knowledge_base_size()}")
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
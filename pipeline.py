@@ -0,0 +1,51 @@
+# pipeline.py
+# 推测式并行流水线：在判定结果返回前提前启动候选分支
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Iterable, Tuple
+
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 流水线模式:
+#   off      - 串行执行：先判定，再执行对应分支（不产生额外上游调用）
+#   shopping - 只提前启动购物分支（判定为"否"时才浪费一次分支调用）
+#   all      - 同时提前启动所有分支，判定结果返回后取消未命中的分支
+SPECULATIVE_PIPELINE_MODES = ("off", "shopping", "all")
+SPECULATIVE_PIPELINE = os.getenv("SPECULATIVE_PIPELINE", "off").strip().lower()
+if SPECULATIVE_PIPELINE not in SPECULATIVE_PIPELINE_MODES:
+    logger.warning(f"未知的 SPECULATIVE_PIPELINE 配置: {SPECULATIVE_PIPELINE}，回退为 off")
+    SPECULATIVE_PIPELINE = "off"
+
+
+async def run_speculative(
+    decide: Awaitable[Any],
+    branches: Dict[Any, Callable[[], Awaitable[Any]]],
+    speculate: Iterable[Any],
+) -> Tuple[Any, Any]:
+    """
+    与判定协程 decide 同时启动 speculate 中列出的分支，判定完成后保留命中的分支、取消其余分支。
+    命中的分支若未被提前启动，则在判定后再启动。返回 (判定结果, 命中分支的结果)。
+    """
+    tasks = {key: asyncio.create_task(branches[key]()) for key in speculate}
+    try:
+        key = await decide
+        for other_key, task in tasks.items():
+            if other_key != key and not task.done():
+                task.cancel()
+                logger.info(f"推测流水线: 取消未命中的分支 {other_key}")
+        if key in tasks:
+            logger.info(f"推测流水线: 命中已提前启动的分支 {key}")
+            return key, await tasks[key]
+        logger.info(f"推测流水线: 分支 {key} 未提前启动，现在执行")
+        return key, await branches[key]()
+    finally:
+        # 出现异常或请求被取消时，确保不留下后台上游调用
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
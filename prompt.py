@@ -201,9 +201,9 @@ def get_shopping_function_call_prompt(user_type):
 </APIs>
 
 你在调用API时，如果一个问题涉及多个关键信息点（如商品价格、平台可信度、价格异常等），
-请将其自动分解为多个独立的名词.
+请将其自动分解为多个独立的名词，每个关键信息点对应列表中的一个 web_search 调用，这些搜索会同时执行.
 最终输出格式为：
-<APIs>[{{"name": "web_search", "parameters": {{"search_query": "...", ...}}}}]</APIs>。
+<APIs>[{{"name": "web_search", "parameters": {{"search_query": "...", ...}}}}, {{"name": "web_search", "parameters": {{"search_query": "...", ...}}}}]</APIs>。
 请判断用户的输入是否需要联网搜索。如果需要，请严格按照上述 <APIs> 格式返回 function call，此时你的回答应该只包含 <APIs> ... </APIs> 结构。
 如果你认为当前用户输入不需要联网搜索，或者你无法为当前问题构造一个合适的搜索查询，你可以直接回答用户的问题。在这种情况下，请在回答时向用户说明你的答复未经联网核实。
 """
@@ -1,16 +1,55 @@
 # encoding: utf-8
 import requests
+import httpx
 import numpy as np
 import json
 import logging
 import os # 新增导入 os
+import copy
+import asyncio
+from dotenv import load_dotenv
 from auth_util import gen_sign_headers # 确保 auth_util.py 在同一目录或PYTHONPATH中
+from http_client import get_async_client, request_timeout
+from vector_index import DenseVectorIndex, QuantizedVectorIndex, RowPartitions
+from lexical_index import LexicalIndex
+from compiled_index import open_compiled_index
+from concurrency import MicroBatcher
+from knowledge_segments import entry_keys, deleted_mask, BASE_SEGMENT_SEQ
+
+# 加载环境变量
+load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 # --- 从 JSON 文件加载知识库数据 ---
-ALL_KNOWLEDGE_EMBEDDING_DATA = []
 DEFAULT_KNOWLEDGE_FILE = "knowledge_base_embeddings/all_knowledge_embeddings.json"
+# 编译后的知识库目录（由 compile_knowledge.py 生成），存在时优先使用，不再解析 JSON
+KNOWLEDGE_INDEX_DIR = os.getenv("KNOWLEDGE_INDEX_DIR", "knowledge_base_embeddings/compiled")
+# 检索模式: exact（精确检索）/ ivf（近似检索，需要编译时构建 IVF 索引）
+RAG_SEARCH_MODES = ("exact", "ivf")
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "exact").strip().lower()
+# IVF 每次查询探查的簇数，0 表示使用构建索引时的默认值
+RAG_IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "0"))
+# 精确检索的向量存储格式: float32 / int8（每行缩放系数）/ float16
+RAG_VECTOR_STORAGES = ("float32", "int8", "float16")
+RAG_VECTOR_STORAGE = os.getenv("RAG_VECTOR_STORAGE", "float32").strip().lower()
+# 量化检索时按 float32 精确重排的候选倍数（top_n * 倍数），0 或 1 表示不重排
+RAG_RERANK_FACTOR = int(os.getenv("RAG_RERANK_FACTOR", "4"))
+# 并发检索请求的微批处理：等待窗口（毫秒，0 表示不合并）与单批最大查询数
+RAG_BATCH_WINDOW_MS = float(os.getenv("RAG_BATCH_WINDOW_MS", "5"))
+RAG_BATCH_MAX_SIZE = int(os.getenv("RAG_BATCH_MAX_SIZE", "32"))
+# 检索方式: dense（向量）/ hybrid（向量 + BM25 按排名融合）/ lexical（只用本地 BM25，不调用 Embedding API）
+RAG_RETRIEVAL_MODES = ("dense", "hybrid", "lexical")
+RAG_RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "dense").strip().lower()
+# Embedding API 超时或失败时是否改用本地 BM25 检索: on / off
+RAG_LEXICAL_FALLBACK = os.getenv("RAG_LEXICAL_FALLBACK", "on").strip().lower() != "off"
+# 启用 BM25 回退时，Embedding API 的截止时间（毫秒），超过后直接用 BM25 结果；0 表示一直等待
+RAG_EMBEDDING_DEADLINE_MS = float(os.getenv("RAG_EMBEDDING_DEADLINE_MS", "1500"))
+# 只有用到 BM25 时才构建 / 加载倒排索引
+RAG_LEXICAL_ENABLED = RAG_RETRIEVAL_MODE != "dense" or RAG_LEXICAL_FALLBACK
+# 混合检索时每种检索取 top_n * 该倍数个候选，再按倒数排名融合（RRF）
+HYBRID_CANDIDATE_FACTOR = 4
+RRF_K = 60
 
 def load_knowledge_from_json(file_path: str) -> list:
     """从指定的 JSON 文件加载知识库数据。"""
@@ -38,88 +77,135 @@ def load_knowledge_from_json(file_path: str) -> list:
         return []
     return data
 
-# 在模块加载时执行加载操作
-ALL_KNOWLEDGE_EMBEDDING_DATA = load_knowledge_from_json(DEFAULT_KNOWLEDGE_FILE)
-
-if not ALL_KNOWLEDGE_EMBEDDING_DATA:
-    logger.warning(
-        f"未能从 {DEFAULT_KNOWLEDGE_FILE} 加载任何知识库数据。"
-        "RAG 系统可能无法正常工作，除非数据在其他地方被正确加载。"
-        "请确保 'all_knowledge_embeddings.json' 文件存在于 server 目录下且格式正确。"
-    )
 # --- 知识库数据加载结束 ---
 
 
 class VivoEmbeddingClient:
-    def __init__(self, app_id, app_key, domain, uri, method='POST'):
+    model_name = "m3e-base"
+
+    def __init__(self, app_id, app_key, domain, uri, method='POST', cache=None):
         self.app_id = app_id
         self.app_key = app_key
         self.domain = domain
         self.uri = uri
         self.method = method
         self.url = f'https://{self.domain}{self.uri}'
+        # 可选的查询向量缓存（embedding_cache.EmbeddingCache），命中时不再请求 Embedding API
+        self.cache = cache
 
-    def get_embeddings(self, sentences: list):
-        if not sentences:
-            return []
-    
+    def _build_request(self, sentences: list):
         params = {}
         post_data = {
-            "model_name": "m3e-base",
+            "model_name": self.model_name,
             "sentences": sentences
         }
+        headers = gen_sign_headers(self.app_id, self.app_key, self.method, self.uri, params)
+        headers['Content-Type'] = 'application/json'
+        return headers, post_data
+
+    def _parse_response(self, response_json: dict):
+        # 修改响应解析逻辑
+        if "data" in response_json and isinstance(response_json["data"], list):
+            # 直接处理 data 字段中的向量数据
+            vectors = response_json["data"]
+            if vectors and all(isinstance(vec, list) for vec in vectors):
+                return [np.array(emb) for emb in vectors]
         
+        # 如果有 code 字段，按原逻辑处理
+        if response_json.get("code") == 0:
+            # 尝试从常见的响应结构中提取向量
+            vectors = None
+            if "result" in response_json and "vectors" in response_json["result"]:
+                vectors = response_json["result"]["vectors"]
+            elif "data" in response_json and "embeddings" in response_json["data"]:
+                vectors = response_json["data"]["embeddings"]
+            elif "embeddings" in response_json and isinstance(response_json["embeddings"], list):
+                vectors = response_json["embeddings"]
+            elif "vectors" in response_json and isinstance(response_json["vectors"], list):
+                vectors = response_json["vectors"]
+            else: # 尝试更通用的查找
+                def find_embeddings_list(data_node):
+                    if isinstance(data_node, list) and data_node and all(isinstance(el, list) for el in data_node):
+                        if all(isinstance(num, (float, int)) for el_list in data_node for num in el_list):
+                            return data_node
+                    if isinstance(data_node, dict):
+                        for k, v_node in data_node.items():
+                            if k in ["embeddings", "vectors", "embedding_vectors"] and isinstance(v_node, list):
+                                if v_node and all(isinstance(el, list) for el in v_node):
+                                     if all(isinstance(num, (float, int)) for el_list in v_node for num in el_list):
+                                        return v_node
+                            res = find_embeddings_list(v_node)
+                            if res: return res
+                    return None
+                vectors = find_embeddings_list(response_json)
+
+            if vectors is not None:
+                return [np.array(emb) for emb in vectors]
+            
+            logger.error(f"无法从API响应中提取向量。Code: {response_json.get('code')}, Msg: {response_json.get('message', response_json.get('msg', 'N/A'))}. Response: {json.dumps(response_json, ensure_ascii=False)}")
+            return []
+        else:
+            logger.error(f"Embedding API 调用失败。Code: {response_json.get('code')}, Msg: {response_json.get('message', response_json.get('msg', 'N/A'))}. Response: {json.dumps(response_json, ensure_ascii=False)}")
+            return []
+
+    def _lookup_cache(self, sentences: list):
+        """返回 (已命中的 {下标: 向量}, 需要请求 API 的句子下标)"""
+        if self.cache is None:
+            return {}, list(range(len(sentences)))
+        return self.cache.get_many(sentences)
+
+    async def _lookup_cache_async(self, sentences: list):
+        """_lookup_cache 的异步版本，持久层查询不阻塞事件循环"""
+        if self.cache is None:
+            return {}, list(range(len(sentences)))
+        return await self.cache.get_many_async(sentences)
+
+    def _merge_cached(self, sentences: list, cached: dict, missing: list, fetched: list, background: bool = False):
+        """
+        把 API 返回的向量写入缓存，并与命中的向量按原顺序合并；API 调用失败时返回空列表。
+        background 为 True 时持久层在后台写入，请求不等待 SQLite。
+        """
+        if missing and len(fetched) != len(missing):
+            return []
+        fetched = [np.asarray(vector, dtype=np.float32) for vector in fetched]
+        if self.cache is not None and fetched:
+            missing_sentences = [sentences[i] for i in missing]
+            if background:
+                self.cache.put_many_background(missing_sentences, fetched)
+            else:
+                self.cache.put_many(missing_sentences, fetched)
+        merged = dict(cached)
+        merged.update(zip(missing, fetched))
+        return [merged[i] for i in range(len(sentences))]
+
+    def get_embeddings(self, sentences: list):
+        if not sentences:
+            return []
+
+        cached, missing = self._lookup_cache(sentences)
+        if not missing:
+            return [cached[i] for i in range(len(sentences))]
+        fetched = self._fetch_embeddings([sentences[i] for i in missing])
+        return self._merge_cached(sentences, cached, missing, fetched)
+
+    async def get_embeddings_async(self, sentences: list, timeout=20):
+        """get_embeddings 的异步版本，使用共享连接池。"""
+        if not sentences:
+            return []
+
+        cached, missing = await self._lookup_cache_async(sentences)
+        if not missing:
+            return [cached[i] for i in range(len(sentences))]
+        fetched = await self._fetch_embeddings_async([sentences[i] for i in missing], timeout)
+        return self._merge_cached(sentences, cached, missing, fetched, background=True)
+
+    def _fetch_embeddings(self, sentences: list):
         try:
-            headers = gen_sign_headers(self.app_id, self.app_key, self.method, self.uri, params)
-            headers['Content-Type'] = 'application/json'
+            headers, post_data = self._build_request(sentences)
 
             response = requests.post(self.url, json=post_data, headers=headers, timeout=20)
             response.raise_for_status()
-            response_json = response.json()
-
-            # 修改响应解析逻辑
-            if "data" in response_json and isinstance(response_json["data"], list):
-                # 直接处理 data 字段中的向量数据
-                vectors = response_json["data"]
-                if vectors and all(isinstance(vec, list) for vec in vectors):
-                    return [np.array(emb) for emb in vectors]
-            
-            # 如果有 code 字段，按原逻辑处理
-            if response_json.get("code") == 0:
-                # 尝试从常见的响应结构中提取向量
-                vectors = None
-                if "result" in response_json and "vectors" in response_json["result"]:
-                    vectors = response_json["result"]["vectors"]
-                elif "data" in response_json and "embeddings" in response_json["data"]:
-                    vectors = response_json["data"]["embeddings"]
-                elif "embeddings" in response_json and isinstance(response_json["embeddings"], list):
-                    vectors = response_json["embeddings"]
-                elif "vectors" in response_json and isinstance(response_json["vectors"], list):
-                    vectors = response_json["vectors"]
-                else: # 尝试更通用的查找
-                    def find_embeddings_list(data_node):
-                        if isinstance(data_node, list) and data_node and all(isinstance(el, list) for el in data_node):
-                            if all(isinstance(num, (float, int)) for el_list in data_node for num in el_list):
-                                return data_node
-                        if isinstance(data_node, dict):
-                            for k, v_node in data_node.items():
-                                if k in ["embeddings", "vectors", "embedding_vectors"] and isinstance(v_node, list):
-                                    if v_node and all(isinstance(el, list) for el in v_node):
-                                         if all(isinstance(num, (float, int)) for el_list in v_node for num in el_list):
-                                            return v_node
-                                res = find_embeddings_list(v_node)
-                                if res: return res
-                        return None
-                    vectors = find_embeddings_list(response_json)
-
-                if vectors is not None:
-                    return [np.array(emb) for emb in vectors]
-                
-                logger.error(f"无法从API响应中提取向量。Code: {response_json.get('code')}, Msg: {response_json.get('message', response_json.get('msg', 'N/A'))}. Response: {json.dumps(response_json, ensure_ascii=False)}")
-                return []
-            else:
-                logger.error(f"Embedding API 调用失败。Code: {response_json.get('code')}, Msg: {response_json.get('message', response_json.get('msg', 'N/A'))}. Response: {json.dumps(response_json, ensure_ascii=False)}")
-                return []
+            return self._parse_response(response.json())
 
         except requests.exceptions.RequestException as e:
             logger.error(f"调用 Embedding API 时发生网络错误: {e}")
@@ -128,24 +214,186 @@ class VivoEmbeddingClient:
             logger.error(f"解析 Embedding API 响应时出错: {e}. Response text: {response.text if 'response' in locals() else 'N/A'}")
             return []
 
+    async def _fetch_embeddings_async(self, sentences: list, timeout=20):
+        try:
+            headers, post_data = self._build_request(sentences)
+
+            response = await get_async_client().post(
+                self.url, json=post_data, headers=headers, timeout=request_timeout(timeout)
+            )
+            response.raise_for_status()
+            return self._parse_response(response.json())
+
+        except httpx.HTTPError as e:
+            logger.error(f"调用 Embedding API 时发生网络错误: {e}")
+            return []
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            logger.error(f"解析 Embedding API 响应时出错: {e}. Response text: {response.text if 'response' in locals() else 'N/A'}")
+            return []
+
 
 class KnowledgeBase:
-    def __init__(self):
-        self.knowledge_entries = []
+    def __init__(self, vector_storage: str = None, rerank_factor: int = None, lexical: bool = None):
         self.embeddings_matrix = None
         self.texts = []
+        self.risk_types = []
+        # 各风险类型在基础段中的行（vector_index.RowPartitions），用于按风险类型过滤的检索
+        self.partitions = None
+        # 近重复去重后每条代表的原始条目数（见 dedup.py），未去重时为 None
+        self.duplicate_counts = None
+        self.index = None
+        self.ivf_index = None
+        # BM25 倒排索引（lexical_index.LexicalIndex），lexical_enabled 为 False 时不构建
+        self.lexical_index = None
+        self.lexical_enabled = RAG_LEXICAL_ENABLED if lexical is None else lexical
+        # 知识库来源: compiled / json，未加载时为 None
+        self.source_format = None
+        # 增量段（knowledge_segments.DeltaSegment）、删除标记与基础段中被删除条目的掩码，见 with_deltas
+        self.deltas = []
+        self.tombstones = {}
+        self.base_deleted = None
+        self.base_deleted_count = 0
+        self._base_keys = None
+        self.vector_storage = (vector_storage or RAG_VECTOR_STORAGE).lower()
+        self.rerank_factor = RAG_RERANK_FACTOR if rerank_factor is None else rerank_factor
+        if self.vector_storage not in RAG_VECTOR_STORAGES:
+            logger.warning(f"未知的向量存储格式 {self.vector_storage}，回退为 float32")
+            self.vector_storage = "float32"
+
+    def __len__(self):
+        """未删除的条目数（基础段 + 增量段）"""
+        base_count = len(self.index) - self.base_deleted_count if self.index is not None else 0
+        return base_count + sum(segment.live_count for segment in self.deltas)
+
+    def _reset(self):
+        self.embeddings_matrix = None
+        self.texts = []
+        self.risk_types = []
+        self.partitions = None
+        self.duplicate_counts = None
+        self.index = None
+        self.ivf_index = None
+        self.lexical_index = None
+        self.source_format = None
+        self.base_deleted = None
+        self.base_deleted_count = 0
+        self._base_keys = None
+
+    def _get_base_keys(self) -> np.ndarray:
+        """基础段各条目的键，首次需要时计算，之后在共享同一基础段的副本间复用"""
+        if self._base_keys is None:
+            self._base_keys = entry_keys(self.texts)
+        return self._base_keys
+
+    def with_deltas(self, deltas: list, tombstones: dict) -> "KnowledgeBase":
+        """
+        返回共享同一基础段、换用新的增量段与删除标记的副本，不复制基础段的向量与文本，
+        代价与增量规模成正比（有删除标记且首次计算基础段条目键时除外）。
+        """
+        if tombstones and self.index is not None:
+            self._get_base_keys()
+        knowledge_base = copy.copy(self)
+        knowledge_base.deltas = list(deltas)
+        knowledge_base.tombstones = dict(tombstones)
+        knowledge_base.base_deleted = None
+        if tombstones and self.index is not None:
+            knowledge_base.base_deleted = deleted_mask(self._base_keys, BASE_SEGMENT_SEQ, tombstones)
+        knowledge_base.base_deleted_count = (
+            int(knowledge_base.base_deleted.sum()) if knowledge_base.base_deleted is not None else 0
+        )
+        return knowledge_base
+
+    def _live_sources(self, keys: np.ndarray):
+        """基础段与各增量段的 (条目键, 风险类型, 键在 keys 中且未被删除的掩码)，按段号从旧到新"""
+        sources = []
+        if self.index is not None:
+            live = np.isin(self._get_base_keys(), keys)
+            if self.base_deleted is not None:
+                live &= ~self.base_deleted
+            sources.append((self._base_keys, self.risk_types, live))
+        sources.extend((segment.keys, segment.risk_types, segment.live_mask(keys)) for segment in self.deltas)
+        return sources
+
+    def find_live_entries(self, keys: np.ndarray):
+        """返回 (条目键在 keys 中且未被删除的条目数, 其中实际出现的条目键)"""
+        count, matched = 0, []
+        for source_keys, _, live in self._live_sources(keys):
+            count += int(live.sum())
+            matched.append(source_keys[live])
+        matched_keys = np.unique(np.concatenate(matched)) if matched else np.empty(0, dtype=np.uint64)
+        return count, matched_keys
+
+    def find_live_risk_types(self, keys: np.ndarray) -> dict:
+        """返回 keys 中实际存在且未被删除的条目的 {条目键: 风险类型}，同一键出现在多个段时以最新的段为准"""
+        found = {}
+        for source_keys, risk_types, live in self._live_sources(keys):
+            for row in np.flatnonzero(live):
+                found[int(source_keys[row])] = risk_types[row]
+        return found
+
+    def segment_stats(self) -> dict:
+        return {
+            "base_entries": len(self.index) if self.index is not None else 0,
+            "base_deleted": self.base_deleted_count,
+            "delta_segments": len(self.deltas),
+            "delta_entries": sum(len(segment) for segment in self.deltas),
+            "tombstones": len(self.tombstones),
+            "lexical_index": self.lexical_available,
+            "risk_types": self.risk_type_sizes(),
+            "deduplicated_entries": (
+                int(np.sum(self.duplicate_counts)) - len(self.duplicate_counts)
+                if self.duplicate_counts is not None else 0
+            ),
+        }
+
+    def risk_type_names(self) -> list:
+        """基础段与增量段中出现过的所有风险类型"""
+        names = dict.fromkeys(self.partitions.labels if self.partitions is not None else [])
+        for segment in self.deltas:
+            names.update(dict.fromkeys(segment.partitions.labels))
+        return list(names)
+
+    def risk_type_sizes(self) -> dict:
+        """各风险类型的条目数（含尚未合并掉的已删除条目）"""
+        sizes = dict(self.partitions.sizes()) if self.partitions is not None else {}
+        for segment in self.deltas:
+            for name, size in segment.partitions.sizes().items():
+                sizes[name] = sizes.get(name, 0) + size
+        return sizes
+
+    @property
+    def lexical_available(self) -> bool:
+        """是否可以做 BM25 检索（增量段总是带有倒排索引）"""
+        return self.lexical_enabled and (self.lexical_index is not None or self.index is None)
+
+    def _use_quantized(self, quantized, memory_mapped: bool):
+        """
+        切换到量化索引。只有 float32 矩阵是内存映射（编译知识库）且开启重排时才保留它用于重排；
+        从 JSON 加载时 float32 矩阵常驻内存，保留它会让量化失去节省内存的意义，因此释放并关闭重排。
+        """
+        rerank = self.rerank_factor > 1 and memory_mapped
+        if rerank:
+            quantized.rerank_vectors = self.embeddings_matrix
+            quantized.rerank_factor = self.rerank_factor
+        else:
+            if self.rerank_factor > 1:
+                logger.info("从 JSON 加载的知识库不做 float32 重排（重排需要编译知识库的内存映射向量）")
+            self.embeddings_matrix = None
+        self.index = quantized
+        logger.info(
+            f"KnowledgeBase 使用 {self.vector_storage} 量化向量 ({quantized.nbytes / 1024 / 1024:.1f} MB)，"
+            f"float32 重排: {'x' + str(self.rerank_factor) if rerank else '关闭'}"
+        )
 
     def load_knowledge_from_list(self, knowledge_data: list):
         if not knowledge_data:
             logger.warning("知识库数据列表为空。")
-            self.knowledge_entries = []
-            self.embeddings_matrix = None
-            self.texts = []
+            self._reset()
             return
 
-        valid_entries = []
         embeddings_list = []
         texts_list = []
+        risk_types_list = []
         expected_dim = None
 
         for i, entry in enumerate(knowledge_data):
@@ -158,107 +406,316 @@ class KnowledgeBase:
                         logger.warning(f"知识库条目 {i} 的向量维度 ({len(embedding_vector)}) 与预期 ({expected_dim}) 不符。已跳过。")
                         continue
                     
-                    valid_entries.append(entry)
                     embeddings_list.append(np.array(embedding_vector, dtype=np.float32))
                     texts_list.append(str(entry["text"]))
+                    risk_types_list.append(entry.get("riskType", "未知风险"))
                 else:
                     logger.warning(f"知识库条目 {i} 的 embedding 格式无效或非数值类型。已跳过。内容: {embedding_vector}")
             else:
                 logger.warning(f"知识库条目 {i} 不是字典或缺少 'text'/'embedding' 键。已跳过。条目内容: {entry}")
         
-        self.knowledge_entries = valid_entries
         if embeddings_list:
             try:
-                self.embeddings_matrix = np.array(embeddings_list)
+                # 按风险类型分组（组内保持原顺序），每个风险类型占据一段连续的行，过滤检索只需对切片打分
+                first_seen = {name: i for i, name in enumerate(dict.fromkeys(risk_types_list))}
+                order = sorted(range(len(risk_types_list)), key=lambda i: first_seen[risk_types_list[i]])
+                embeddings_list = [embeddings_list[i] for i in order]
+                texts_list = [texts_list[i] for i in order]
+                risk_types_list = [risk_types_list[i] for i in order]
+                # 索引持有归一化后的 float32 矩阵，embeddings_matrix 直接引用它，不再保留第二份拷贝
+                self.index = DenseVectorIndex(np.vstack(embeddings_list))
+                del embeddings_list
+                self.embeddings_matrix = self.index.vectors
                 self.texts = texts_list
-                logger.info(f"成功加载 {len(self.knowledge_entries)} 条知识库条目到 KnowledgeBase。向量维度: {expected_dim if expected_dim else 'N/A'}.")
+                self.risk_types = risk_types_list
+                self.partitions = RowPartitions.from_labels(risk_types_list)
+                self.duplicate_counts = None
+                self.ivf_index = None
+                self.source_format = "json"
+                self.lexical_index = LexicalIndex.build(self.texts) if self.lexical_enabled else None
+                if self.vector_storage != "float32":
+                    self._use_quantized(
+                        QuantizedVectorIndex.from_normalized(self.embeddings_matrix, self.vector_storage),
+                        memory_mapped=False,
+                    )
+                logger.info(f"成功加载 {len(self)} 条知识库条目到 KnowledgeBase。向量维度: {expected_dim if expected_dim else 'N/A'}.")
             except Exception as e:
                 logger.error(f"将 embeddings_list 转换为 NumPy 数组时出错: {e}")
-                self.embeddings_matrix = None
-                self.texts = []
+                self._reset()
         else:
             logger.warning("未找到有效的知识库条目进行加载到 KnowledgeBase。")
-            self.embeddings_matrix = None
-            self.texts = []
-
-
-    def _cosine_similarity(self, query_vec: np.ndarray, doc_matrix: np.ndarray):
-        if query_vec is None or doc_matrix is None or doc_matrix.shape[0] == 0 or query_vec.ndim != 1 or doc_matrix.ndim != 2 or query_vec.shape[0] != doc_matrix.shape[1]:
-            logger.warning(f"余弦相似度计算的输入无效。Query_vec shape: {query_vec.shape if query_vec is not None else 'None'}, Doc_matrix shape: {doc_matrix.shape if doc_matrix is not None else 'None'}")
-            return np.array([])
-        
-        query_norm = np.linalg.norm(query_vec)
-        if query_norm == 0:
-            return np.zeros(doc_matrix.shape[0])
-        
-        query_vec_normalized = query_vec / query_norm
-        
-        doc_norms = np.linalg.norm(doc_matrix, axis=1)
-        doc_matrix_normalized = np.zeros_like(doc_matrix, dtype=float)
-        
-        valid_indices = doc_norms > 1e-8 # 使用一个小的阈值避免除以零
-        doc_matrix_normalized[valid_indices] = doc_matrix[valid_indices] / doc_norms[valid_indices, np.newaxis]
-        
-        similarities = np.dot(doc_matrix_normalized, query_vec_normalized)
-        return similarities
-
-    def find_similar_texts(self, query_embedding: np.ndarray, top_n=3):
-        if self.embeddings_matrix is None or self.embeddings_matrix.shape[0] == 0:
-            return []
-        if query_embedding is None:
-            logger.warning("查询向量为 None。")
-            return []
-
-        similarities = self._cosine_similarity(query_embedding, self.embeddings_matrix)
-        
-        if similarities.size == 0:
-            return []
-
-        num_items_to_return = min(top_n, len(similarities))
-        if num_items_to_return == 0:
-            return []
-            
-        top_indices = np.argsort(similarities)[-num_items_to_return:][::-1]
-
+            self._reset()
+
+    def load_compiled(self, compiled):
+        """从编译知识库（compiled_index.CompiledKnowledge）加载，向量与文本均直接引用内存映射，不复制"""
+        self.index = DenseVectorIndex(compiled.vectors, normalized=True)
+        self.embeddings_matrix = self.index.vectors
+        self.texts = compiled.texts
+        self.risk_types = compiled.risk_types
+        self.partitions = compiled.risk_types.partitions
+        self.duplicate_counts = compiled.duplicate_counts
+        self.ivf_index = compiled.ivf
+        self.source_format = "compiled"
+        self.lexical_index = compiled.lexical if self.lexical_enabled else None
+        if self.lexical_enabled and self.lexical_index is None:
+            logger.info("编译知识库中没有倒排索引，在内存中构建（重新运行 compile_knowledge.py 可省去这一步）")
+            self.lexical_index = LexicalIndex.build(self.texts)
+        if self.vector_storage != "float32":
+            quantized = QuantizedVectorIndex.load(compiled.path, self.vector_storage)
+            if quantized is None:
+                logger.warning(
+                    f"编译知识库中没有 {self.vector_storage} 量化向量（可用 compile_knowledge.py --quantize 生成），将在内存中量化。"
+                )
+                quantized = QuantizedVectorIndex.from_normalized(self.embeddings_matrix, self.vector_storage)
+            self._use_quantized(quantized, memory_mapped=True)
+        logger.info(f"成功加载 {len(self)} 条编译知识库条目到 KnowledgeBase。向量维度: {self.index.dim}.")
+
+    @staticmethod
+    def _format_hits(hits: list) -> list:
+        """
+        hits 为已排好序的 [(分数, 来源段, 行号, 分数类型)]，读取对应的文本、风险类型与该条代表的近重复条目数。
+        分数类型为 dense（余弦相似度）或 lexical（归一化的 BM25 分数，不可当作余弦相似度）。
+        """
         results = []
-        for i in top_indices:
-            if similarities[i] > 0: # 可以根据需要调整相似度阈值
-                # 获取完整的知识库条目信息
-                entry = self.knowledge_entries[i]
+        for score, source, row, score_type in hits:
+            if score > 0: # 可以根据需要调整相似度阈值
                 results.append({
-                    "text": entry.get("text", ""),
-                    "riskType": entry.get("riskType", "未知风险"),
-                    "similarity": float(similarities[i]),
+                    "text": source.texts[row],
+                    "riskType": source.risk_types[row],
+                    "similarity": score,
+                    "score_type": score_type,
+                    "duplicates": int(source.duplicate_counts[row]) if source.duplicate_counts is not None else 1,
                 })
         return results
 
+    @staticmethod
+    def _ranked(hits: list, top_n: int) -> list:
+        return sorted(hits, key=lambda hit: hit[0], reverse=True)[:top_n]
+
+    @staticmethod
+    def _fuse(dense_hits: list, lexical_hits: list, top_n: int) -> list:
+        """
+        倒数排名融合（RRF）：按两种检索中的名次合并排序。两种检索都命中时展示向量余弦相似度，
+        只被 BM25 命中的条目保留 BM25 分数及其分数类型
+        """
+        fused = {}
+        for hits in (dense_hits, lexical_hits):
+            for rank, hit in enumerate(sorted(hits, key=lambda hit: hit[0], reverse=True)):
+                key = (id(hit[1]), hit[2])
+                entry = fused.get(key)
+                if entry is None:
+                    fused[key] = [1.0 / (RRF_K + rank + 1), hit]
+                else:
+                    entry[0] += 1.0 / (RRF_K + rank + 1)
+        ranked = sorted(fused.values(), key=lambda entry: entry[0], reverse=True)[:top_n]
+        return [hit for _, hit in ranked]
+
+    def _search_index(self, search_mode: str, nprobe: int):
+        """返回 (索引, 额外检索参数)；IVF 索引不可用时回退到精确检索"""
+        if search_mode == "ivf" and self.ivf_index is not None:
+            return self.ivf_index, {"nprobe": nprobe or None}
+        return self.index, {}
+
+    def _collect_hits(self, kind: str, queries, k: int, search_mode: str = "exact", nprobe: int = 0,
+                      risk_types: list = None) -> list:
+        """
+        在基础段与各增量段中分别检索：kind 为 dense 时 queries 是查询向量矩阵，为 lexical 时是查询文本列表。
+        每个段多取该段已删除条目数个候选，过滤删除标记后仍能保证每个段的 top-k 完整。
+        给定 risk_types 时只对这些风险类型的分区打分（精确检索，不使用 IVF）。
+        返回每个查询未排序的 [(分数, 来源段, 行号, kind)]。
+        """
+        sources = []
+        if kind == "dense":
+            if self.index is not None:
+                index, search_kwargs = self._search_index(search_mode if risk_types is None else "exact", nprobe)
+                sources.append((self, index, search_kwargs, self.base_deleted, self.base_deleted_count))
+            sources.extend((segment, segment.index, {}, segment.deleted, segment.deleted_count) for segment in self.deltas)
+        else:
+            if self.lexical_index is not None:
+                sources.append((self, self.lexical_index, {}, self.base_deleted, self.base_deleted_count))
+            sources.extend((segment, segment.lexical, {}, segment.deleted, segment.deleted_count) for segment in self.deltas)
+
+        hits = [[] for _ in range(len(queries))]
+        for source, index, search_kwargs, deleted, deleted_count in sources:
+            if risk_types is None:
+                partitions = [None]
+            else:
+                partitions = source.partitions.select(risk_types)
+            for rows in partitions:
+                kwargs = search_kwargs if rows is None else {"rows": rows}
+                results = index.search_batch(queries, k + deleted_count, **kwargs)
+                for query_hits, (indices, scores) in zip(hits, results):
+                    if deleted is not None:
+                        live = ~deleted[indices]
+                        indices, scores = indices[live], scores[live]
+                    query_hits.extend((float(score), source, int(i), kind) for i, score in zip(indices, scores))
+        return hits
+
+    def _search_group(self, queries, query_texts, top_n: int, search_mode: str, nprobe: int,
+                      retrieval_mode: str, risk_types: list = None) -> list:
+        """在 risk_types（None 表示全部）中检索，返回每个查询排好序的 top_n [(分数, 来源段, 行号, 分数类型)]"""
+        if retrieval_mode == "lexical":
+            return [
+                self._ranked(hits, top_n)
+                for hits in self._collect_hits("lexical", query_texts, top_n, risk_types=risk_types)
+            ]
+
+        if retrieval_mode == "hybrid" and query_texts is not None and self.lexical_available:
+            k = top_n * HYBRID_CANDIDATE_FACTOR
+            dense_hits = self._collect_hits("dense", queries, k, search_mode, nprobe, risk_types)
+            lexical_hits = self._collect_hits("lexical", query_texts, k, risk_types=risk_types)
+            return [self._fuse(d, l, top_n) for d, l in zip(dense_hits, lexical_hits)]
+        return [
+            self._ranked(hits, top_n)
+            for hits in self._collect_hits("dense", queries, top_n, search_mode, nprobe, risk_types)
+        ]
+
+    def _search(self, query_embeddings, query_texts, top_n: int, search_mode: str, nprobe: int,
+                retrieval_mode: str, risk_types: list = None, per_risk_type: bool = False) -> list:
+        queries = None if retrieval_mode == "lexical" else np.vstack(query_embeddings)
+        if not per_risk_type:
+            return [
+                self._format_hits(hits)
+                for hits in self._search_group(queries, query_texts, top_n, search_mode, nprobe, retrieval_mode, risk_types)
+            ]
+
+        # 每个风险类型各取 top_n，合并后按相似度排序
+        count = len(query_texts) if queries is None else len(queries)
+        results = [[] for _ in range(count)]
+        for risk_type in risk_types:
+            group_hits = self._search_group(queries, query_texts, top_n, search_mode, nprobe, retrieval_mode, [risk_type])
+            for hits, hits_in_group in zip(results, group_hits):
+                hits.extend(hits_in_group)
+        return [self._format_hits(self._ranked(hits, len(hits))) for hits in results]
+
+    def _select_risk_types(self, risk_types=None, exclude_risk_types=None, per_risk_type: bool = False):
+        """返回需要检索的风险类型列表；不做过滤也不按类型分组时返回 None（检索完整索引，可使用 IVF）"""
+        if not risk_types and not exclude_risk_types and not per_risk_type:
+            return None
+        selected = self.risk_type_names()
+        if risk_types:
+            wanted = set(risk_types)
+            selected = [name for name in selected if name in wanted]
+        excluded = set(exclude_risk_types or ())
+        return [name for name in selected if name not in excluded]
+
+    def find_similar_texts(self, query_embedding: np.ndarray, top_n=3, search_mode="exact", nprobe=0,
+                           query_text: str = None, retrieval_mode="dense", risk_types=None,
+                           exclude_risk_types=None, per_risk_type=False):
+        if query_embedding is None and retrieval_mode != "lexical":
+            logger.warning("查询向量为 None。")
+            return []
+        query_texts = [query_text] if query_text is not None else None
+        return self.find_similar_texts_batch(
+            [query_embedding], top_n, search_mode, nprobe, query_texts=query_texts, retrieval_mode=retrieval_mode,
+            risk_types=risk_types, exclude_risk_types=exclude_risk_types, per_risk_type=per_risk_type
+        )[0]
+
+    def find_similar_texts_batch(self, query_embeddings: list, top_n=3, search_mode="exact", nprobe=0,
+                                 query_texts: list = None, retrieval_mode="dense", risk_types=None,
+                                 exclude_risk_types=None, per_risk_type=False):
+        """
+        批量版本的 find_similar_texts，所有查询共用一次矩阵乘法，返回与输入顺序一致的结果列表。
+        retrieval_mode 为 lexical 时只用 query_texts 做 BM25 检索，为 hybrid 时两者按排名融合。
+        risk_types / exclude_risk_types 只检索 / 排除这些风险类型，只对相应分区的行打分；
+        per_risk_type 为 True 时每个风险类型各返回 top_n 条。
+        """
+        count = len(query_texts or []) if retrieval_mode == "lexical" else len(query_embeddings)
+        if len(self) == 0 or count == 0:
+            return [[] for _ in range(count)]
+        if retrieval_mode == "lexical" and not self.lexical_available:
+            logger.warning("知识库没有倒排索引，无法进行 BM25 检索。")
+            return [[] for _ in range(count)]
+        selected = self._select_risk_types(risk_types, exclude_risk_types, per_risk_type)
+        if selected is not None and not selected:
+            return [[] for _ in range(count)]
+
+        try:
+            return self._search(
+                query_embeddings, query_texts, top_n, search_mode, nprobe, retrieval_mode, selected, per_risk_type
+            )
+        except ValueError as e:
+            logger.warning(f"向量检索的输入无效: {e}")
+            return [[] for _ in range(count)]
+
 class RAGSystem:
-    def __init__(self, embedding_client: VivoEmbeddingClient, knowledge_base: KnowledgeBase):
+    def __init__(self, embedding_client: VivoEmbeddingClient, knowledge_base: KnowledgeBase,
+                 search_mode: str = None, nprobe: int = None,
+                 batch_window_ms: float = RAG_BATCH_WINDOW_MS, batch_max_size: int = RAG_BATCH_MAX_SIZE,
+                 retrieval_mode: str = None, lexical_fallback: bool = RAG_LEXICAL_FALLBACK,
+                 embedding_deadline_ms: float = RAG_EMBEDDING_DEADLINE_MS):
         self.embedding_client = embedding_client
         self.knowledge_base = knowledge_base
-        if self.knowledge_base.embeddings_matrix is None or self.knowledge_base.embeddings_matrix.shape[0] == 0:
+        self.search_mode = (search_mode or RAG_SEARCH_MODE).lower()
+        self.nprobe = RAG_IVF_NPROBE if nprobe is None else nprobe
+        if self.search_mode not in RAG_SEARCH_MODES:
+            logger.warning(f"未知的检索模式 {self.search_mode}，回退为 exact")
+            self.search_mode = "exact"
+        if self.search_mode == "ivf" and self.knowledge_base.ivf_index is None:
+            logger.warning("RAGSystem 初始化：检索模式为 ivf，但知识库没有 IVF 索引（请用 compile_knowledge.py --ivf-lists 构建），回退为精确检索。")
+            self.search_mode = "exact"
+        self.retrieval_mode = (retrieval_mode or RAG_RETRIEVAL_MODE).lower()
+        if self.retrieval_mode not in RAG_RETRIEVAL_MODES:
+            logger.warning(f"未知的检索方式 {self.retrieval_mode}，回退为 dense")
+            self.retrieval_mode = "dense"
+        if self.retrieval_mode != "dense" and not self.knowledge_base.lexical_available:
+            logger.warning(f"RAGSystem 初始化：检索方式为 {self.retrieval_mode}，但知识库没有倒排索引，回退为 dense。")
+            self.retrieval_mode = "dense"
+        self.lexical_fallback = lexical_fallback and self.knowledge_base.lexical_available
+        self.embedding_deadline = embedding_deadline_ms / 1000
+        self._counters = {"lexical_fallbacks": 0, "embedding_timeouts": 0}
+        if len(self.knowledge_base) == 0:
             logger.warning("RAGSystem 初始化：知识库为空。RAG检索将不可用。")
+        # 异步检索时，把并发请求合并为一次 Embedding API 调用 + 一次批量矩阵乘法
+        self.batcher = None
+        if batch_window_ms > 0 and batch_max_size > 1:
+            self.batcher = MicroBatcher(self._retrieve_batch, batch_max_size, batch_window_ms)
 
-
-    def retrieve_and_format(self, query_text: str, top_n=3):
+    def _is_available(self, query_text: str) -> bool:
         if not query_text.strip():
             logger.warning("RAG: 查询文本为空。")
-            return ""
+            return False
         
-        if self.knowledge_base.embeddings_matrix is None or self.knowledge_base.embeddings_matrix.shape[0] == 0:
+        if len(self.knowledge_base) == 0:
             logger.info("RAG: 知识库为空，无法执行检索。")
-            return ""
-
-        query_embeddings = self.embedding_client.get_embeddings([query_text])
-
+            return False
+        return True
+
+    @staticmethod
+    def _risk_filter(risk_types=None, exclude_risk_types=None, per_risk_type=False) -> tuple:
+        """把风险类型过滤条件整理为可哈希的 (risk_types, exclude_risk_types, per_risk_type)，用于微批处理分组"""
+        return (
+            tuple(risk_types) if risk_types else None,
+            tuple(exclude_risk_types) if exclude_risk_types else None,
+            bool(per_risk_type),
+        )
+
+    def _search_docs(self, query_texts: list, query_embeddings: list, top_n: int,
+                     risk_filter: tuple = (None, None, False)) -> list:
+        """按配置的检索方式检索；没有查询向量时（Embedding API 超时或失败）回退到本地 BM25"""
+        risk_types, exclude_risk_types, per_risk_type = risk_filter
+        filter_kwargs = {
+            "risk_types": risk_types, "exclude_risk_types": exclude_risk_types, "per_risk_type": per_risk_type,
+        }
+        if self.retrieval_mode == "lexical":
+            return self.knowledge_base.find_similar_texts_batch(
+                None, top_n=top_n, query_texts=query_texts, retrieval_mode="lexical", **filter_kwargs
+            )
         if not query_embeddings:
-            logger.warning(f"RAG: 无法获取查询 '{query_text[:50]}...' 的向量。")
-            return ""
-        
-        query_embedding = query_embeddings[0]
-
-        similar_docs_info = self.knowledge_base.find_similar_texts(query_embedding, top_n=top_n)
-
+            if not self.lexical_fallback:
+                logger.warning(f"RAG: 无法获取 {len(query_texts)} 个查询的向量。")
+                return [[] for _ in query_texts]
+            self._counters["lexical_fallbacks"] += len(query_texts)
+            logger.warning(f"RAG: 无法获取 {len(query_texts)} 个查询的向量，改用本地 BM25 检索。")
+            return self.knowledge_base.find_similar_texts_batch(
+                None, top_n=top_n, query_texts=query_texts, retrieval_mode="lexical", **filter_kwargs
+            )
+        return self.knowledge_base.find_similar_texts_batch(
+            query_embeddings, top_n=top_n, search_mode=self.search_mode, nprobe=self.nprobe,
+            query_texts=query_texts, retrieval_mode=self.retrieval_mode, **filter_kwargs
+        )
+
+    def _format_docs(self, similar_docs_info: list) -> str:
         if not similar_docs_info:
             return ""
 
@@ -267,9 +724,128 @@ class RAGSystem:
             risk_type = doc_info.get('riskType', '未知风险')
             text_content = doc_info.get('text', '')
             similarity = doc_info.get('similarity', 0.0)
+            duplicates = doc_info.get('duplicates', 1)
+            # BM25 分数只反映字面重合程度，与余弦相似度的尺度不同，标注为关键词匹配度以免模型混淆
+            score_label = "关键词匹配度" if doc_info.get('score_type') == "lexical" else "相似度"
             
             # 格式化为明确的知识库参考信息
-            formatted_text = f"【{risk_type}】的知识库参考信息 (相似度: {similarity:.2f}):\n{text_content}"
+            similar_cases = f", 同类话术 {duplicates} 条" if duplicates > 1 else ""
+            formatted_text = f"【{risk_type}】的知识库参考信息 ({score_label}: {similarity:.2f}{similar_cases}):\n{text_content}"
             formatted_texts.append(formatted_text)
         
         return "\n\n".join(formatted_texts)
+
+    def retrieve_and_format(self, query_text: str, top_n=3, risk_types=None, exclude_risk_types=None,
+                            per_risk_type=False):
+        """
+        检索并格式化背景知识。risk_types / exclude_risk_types 只检索 / 排除这些风险类型，
+        per_risk_type 为 True 时每个风险类型各取 top_n 条。
+        """
+        if not self._is_available(query_text):
+            return ""
+
+        risk_filter = self._risk_filter(risk_types, exclude_risk_types, per_risk_type)
+        query_embeddings = None
+        if self.retrieval_mode != "lexical":
+            query_embeddings = self.embedding_client.get_embeddings([query_text])
+        return self._format_docs(self._search_docs([query_text], query_embeddings, top_n, risk_filter)[0])
+
+    async def retrieve_and_format_async(self, query_text: str, top_n=3, risk_types=None, exclude_risk_types=None,
+                                        per_risk_type=False):
+        """retrieve_and_format 的异步版本，向量请求不阻塞事件循环。"""
+        if not self._is_available(query_text):
+            return ""
+
+        risk_filter = self._risk_filter(risk_types, exclude_risk_types, per_risk_type)
+        if self.retrieval_mode == "lexical":
+            # 纯本地检索，无需等待合并窗口
+            return self._format_docs(self._search_docs([query_text], None, top_n, risk_filter)[0])
+        if self.batcher is not None:
+            return await self.batcher.submit((query_text, top_n, risk_filter))
+
+        query_embeddings = await self._embed_queries([query_text])
+        return self._format_docs(self._search_docs([query_text], query_embeddings, top_n, risk_filter)[0])
+
+    async def _embed_queries(self, query_texts: list):
+        """
+        获取查询向量，失败时返回 None。可以回退到 BM25 时最多等待 embedding_deadline，
+        超时后未完成的请求在后台继续执行，返回的向量仍会写入向量缓存。
+        """
+        task = asyncio.ensure_future(self.embedding_client.get_embeddings_async(query_texts))
+        if not self.lexical_fallback or self.embedding_deadline <= 0:
+            return await task or None
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.embedding_deadline) or None
+        except asyncio.TimeoutError:
+            self._counters["embedding_timeouts"] += 1
+            logger.warning(f"RAG: Embedding API 超过 {self.embedding_deadline * 1000:.0f} 毫秒未返回")
+            return None
+
+    async def _retrieve_batch(self, items: list) -> list:
+        """
+        微批处理函数：items 为 [(query_text, top_n, risk_filter)]，返回与之对应的格式化检索结果。
+        所有查询共用一次 Embedding API 调用，过滤条件相同的查询共用一次检索。
+        """
+        unique_texts = list(dict.fromkeys(query_text for query_text, _, _ in items))
+        query_embeddings = await self._embed_queries(unique_texts)
+        embedding_by_text = dict(zip(unique_texts, query_embeddings)) if query_embeddings else {}
+
+        # 按每个风险类型分组取 top_n 时，不同 top_n 的结果不能互相截取，需分开检索
+        def group_key(n, risk_filter):
+            return risk_filter, n if risk_filter[2] else None
+
+        groups = {}
+        for query_text, n, risk_filter in items:
+            groups.setdefault(group_key(n, risk_filter), []).append((query_text, n))
+        docs = {}
+        for key, group_items in groups.items():
+            texts = list(dict.fromkeys(query_text for query_text, _ in group_items))
+            embeddings = [embedding_by_text[text] for text in texts] if embedding_by_text else None
+            top_n = max(n for _, n in group_items)
+            for query_text, text_docs in zip(texts, self._search_docs(texts, embeddings, top_n, key[0])):
+                docs[(query_text, key)] = text_docs
+        if len(items) > 1:
+            logger.info(f"RAG: 微批处理 {len(items)} 个检索请求（{len(unique_texts)} 个不同查询）")
+        results = []
+        for query_text, n, risk_filter in items:
+            text_docs = docs[(query_text, group_key(n, risk_filter))]
+            results.append(self._format_docs(text_docs if risk_filter[2] else text_docs[:n]))
+        return results
+
+    def stats(self) -> dict:
+        return {
+            "retrieval_mode": self.retrieval_mode,
+            "lexical_fallback": self.lexical_fallback,
+            **self._counters,
+        }
+
+
+def knowledge_source_paths():
+    """返回 (编译知识库目录, 知识库 JSON 文件) 的绝对路径"""
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(current_dir, KNOWLEDGE_INDEX_DIR), os.path.join(current_dir, DEFAULT_KNOWLEDGE_FILE)
+
+
+def load_knowledge_base(**kwargs) -> KnowledgeBase:
+    """
+    加载知识库：优先内存映射编译知识库，不存在时回退到 JSON。
+    JSON 解析出的 Python 列表只在加载期间存在，向量复制进索引后即被释放。
+    """
+    knowledge_base = KnowledgeBase(**kwargs)
+    compiled_dir, json_file = knowledge_source_paths()
+    compiled = open_compiled_index(compiled_dir)
+    if compiled is not None:
+        knowledge_base.load_compiled(compiled)
+        return knowledge_base
+
+    knowledge_data = load_knowledge_from_json(json_file)
+    if knowledge_data:
+        logger.info("未找到编译知识库，已从 JSON 加载。运行 compile_knowledge.py 可缩短启动时间并在多个 worker 间共享内存。")
+        knowledge_base.load_knowledge_from_list(knowledge_data)
+    else:
+        logger.warning(
+            f"未能从 {KNOWLEDGE_INDEX_DIR} 或 {DEFAULT_KNOWLEDGE_FILE} 加载任何知识库数据。"
+            "RAG 系统可能无法正常工作，除非数据在其他地方被正确加载。"
+            "请确保 'all_knowledge_embeddings.json' 文件存在于 server 目录下且格式正确。"
+        )
+    return knowledge_base
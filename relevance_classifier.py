@@ -0,0 +1,202 @@
+# relevance_classifier.py
+# 本地购物相关性分类器：字符 n-gram 哈希特征 + 逻辑回归，用随服务发布的标注集（relevance_labels.json）在启动时训练。
+#
+# 输出的置信度经过 Platt 校准（在交叉验证的折外预测上拟合），置信度足够高时直接给出“是/否”，
+# 只有不确定的输入才交给 LLM 判断，省去大多数请求上的一次串行 LLM 调用。
+import os
+import json
+import logging
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from embedding_cache import normalize_text
+from lexical_index import term_hash
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 本地分类器: on（先本地判断，不确定时调用 LLM）/ off（总是调用 LLM）
+RELEVANCE_CLASSIFIER = os.getenv("RELEVANCE_CLASSIFIER", "on").strip().lower()
+# 校准后的置信度达到该值时直接采用本地判断，否则交给 LLM
+RELEVANCE_CONFIDENCE = float(os.getenv("RELEVANCE_CONFIDENCE", "0.85"))
+# 标注集路径（相对于本文件所在目录），每条为 {"text": ..., "shopping": true/false}
+RELEVANCE_LABELS_PATH = os.getenv("RELEVANCE_LABELS_PATH", "relevance_labels.json")
+
+HASH_DIM = 1 << 16
+L2_REGULARIZATION = 1e-3
+TRAIN_ITERATIONS = 200
+CV_FOLDS = 5
+
+
+def extract_features(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    返回 (特征下标, 特征值)。特征为字符一元组、二元组与三元组，哈希到 HASH_DIM 维，
+    按出现与否取值并做 L2 归一化，长文本（如 OCR 结果）与短问题的尺度一致。
+    """
+    text = normalize_text(text).lower()
+    grams = set()
+    for n in (1, 2, 3):
+        grams.update(f"{n}:{text[i:i + n]}" for i in range(len(text) - n + 1))
+    if not grams:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    columns = np.unique(np.fromiter((term_hash(gram) % HASH_DIM for gram in grams), dtype=np.int64, count=len(grams)))
+    values = np.full(len(columns), 1.0 / np.sqrt(len(columns)), dtype=np.float32)
+    return columns, values
+
+
+class _SparseRows:
+    """把若干条样本的稀疏特征拼接为 (行号, 列号, 值) 三个数组，便于用 bincount 做矩阵-向量乘法"""
+
+    def __init__(self, features: Sequence[Tuple[np.ndarray, np.ndarray]]):
+        self.count = len(features)
+        self.rows = np.concatenate([np.full(len(columns), i) for i, (columns, _) in enumerate(features)])
+        self.columns = np.concatenate([columns for columns, _ in features])
+        self.values = np.concatenate([values for _, values in features])
+
+    def dot(self, weights: np.ndarray) -> np.ndarray:
+        return np.bincount(self.rows, weights=self.values * weights[self.columns], minlength=self.count)
+
+    def transpose_dot(self, residuals: np.ndarray) -> np.ndarray:
+        return np.bincount(self.columns, weights=self.values * residuals[self.rows], minlength=HASH_DIM)
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30, 30)))
+
+
+def _train_logistic(features: Sequence[Tuple[np.ndarray, np.ndarray]], labels: np.ndarray,
+                    iterations: int = TRAIN_ITERATIONS, l2: float = L2_REGULARIZATION) -> Tuple[np.ndarray, float]:
+    """L2 正则的逻辑回归，Adam 全批量梯度下降；正负样本按数量加权平衡"""
+    matrix = _SparseRows(features)
+    positive = labels.mean()
+    sample_weights = np.where(labels > 0, 0.5 / max(positive, 1e-6), 0.5 / max(1 - positive, 1e-6)) / len(labels)
+    weights = np.zeros(HASH_DIM)
+    bias = 0.0
+    m_w, v_w = np.zeros(HASH_DIM), np.zeros(HASH_DIM)
+    m_b = v_b = 0.0
+    beta1, beta2, learning_rate = 0.9, 0.999, 0.1
+    for step in range(1, iterations + 1):
+        residuals = (_sigmoid(matrix.dot(weights) + bias) - labels) * sample_weights
+        grad_w = matrix.transpose_dot(residuals) + l2 * weights
+        grad_b = residuals.sum()
+        m_w = beta1 * m_w + (1 - beta1) * grad_w
+        v_w = beta2 * v_w + (1 - beta2) * grad_w ** 2
+        m_b = beta1 * m_b + (1 - beta1) * grad_b
+        v_b = beta2 * v_b + (1 - beta2) * grad_b ** 2
+        correction1, correction2 = 1 - beta1 ** step, 1 - beta2 ** step
+        weights -= learning_rate * (m_w / correction1) / (np.sqrt(v_w / correction2) + 1e-8)
+        bias -= learning_rate * (m_b / correction1) / (np.sqrt(v_b / correction2) + 1e-8)
+    return weights.astype(np.float32), float(bias)
+
+
+def _fit_platt(logits: np.ndarray, labels: np.ndarray, iterations: int = 500) -> Tuple[float, float]:
+    """在折外 logit 上拟合 p = sigmoid(a * z + b)，使输出概率与实际正确率一致"""
+    a, b = 1.0, 0.0
+    for _ in range(iterations):
+        residuals = _sigmoid(a * logits + b) - labels
+        a -= 0.5 * float(np.mean(residuals * logits))
+        b -= 0.5 * float(np.mean(residuals))
+    return a, b
+
+
+class RelevanceClassifier:
+    """购物相关性的本地分类器。predict 返回校准后的“与购物相关”概率"""
+
+    def __init__(self, weights: np.ndarray, bias: float, scale: float = 1.0, offset: float = 0.0):
+        self.weights = weights
+        self.bias = bias
+        self.scale = scale
+        self.offset = offset
+
+    @classmethod
+    def train(cls, texts: Sequence[str], labels: Sequence[bool], folds: int = CV_FOLDS) -> "RelevanceClassifier":
+        features = [extract_features(text) for text in texts]
+        labels = np.asarray(labels, dtype=np.float64)
+
+        # k 折交叉验证得到折外 logit，用于校准与报告准确率
+        order = np.random.default_rng(0).permutation(len(labels))
+        out_of_fold = np.zeros(len(labels))
+        for fold in range(folds):
+            held_out = order[fold::folds]
+            train_rows = np.setdiff1d(order, held_out)
+            weights, bias = _train_logistic([features[i] for i in train_rows], labels[train_rows])
+            held_out_matrix = _SparseRows([features[i] for i in held_out])
+            out_of_fold[held_out] = held_out_matrix.dot(weights) + bias
+        scale, offset = _fit_platt(out_of_fold, labels)
+        probabilities = _sigmoid(scale * out_of_fold + offset)
+        accuracy = float(np.mean((probabilities >= 0.5) == (labels > 0)))
+        confident = np.maximum(probabilities, 1 - probabilities) >= RELEVANCE_CONFIDENCE
+        confident_accuracy = float(np.mean((probabilities[confident] >= 0.5) == (labels[confident] > 0))) if confident.any() else 0.0
+        logger.info(
+            f"购物相关性分类器: {len(labels)} 条标注, 交叉验证准确率 {accuracy:.3f}, "
+            f"置信度 >= {RELEVANCE_CONFIDENCE} 的比例 {confident.mean():.2f} (其中准确率 {confident_accuracy:.3f})"
+        )
+
+        weights, bias = _train_logistic(features, labels)
+        return cls(weights, bias, scale, offset)
+
+    @classmethod
+    def from_labels_file(cls, path: str) -> "RelevanceClassifier":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        texts = [str(item["text"]) for item in data]
+        labels = [bool(item["shopping"]) for item in data]
+        if len(set(labels)) < 2:
+            raise ValueError(f"标注集 {path} 需要同时包含购物相关与无关的样本")
+        return cls.train(texts, labels)
+
+    def predict(self, text: str) -> float:
+        columns, values = extract_features(text)
+        logit = float(values @ self.weights[columns]) + self.bias
+        return float(_sigmoid(self.scale * logit + self.offset))
+
+
+class RelevanceGate:
+    """
+    先用本地分类器判断，置信度不足时返回 None 由调用方交给 LLM。
+    分类器不可用（关闭或标注集加载失败）时总是返回 None。
+    """
+
+    def __init__(self, classifier: Optional[RelevanceClassifier], confidence: float = RELEVANCE_CONFIDENCE):
+        self.classifier = classifier
+        self.confidence = confidence
+        self._counters = {"local_shopping": 0, "local_other": 0, "llm_fallbacks": 0}
+
+    def decide(self, text: str) -> Tuple[Optional[bool], Optional[float]]:
+        """返回 (是否与购物相关 或 None, 与购物相关的概率)"""
+        if self.classifier is None:
+            return None, None
+        probability = self.classifier.predict(text)
+        if probability >= self.confidence:
+            self._counters["local_shopping"] += 1
+            return True, probability
+        if probability <= 1 - self.confidence:
+            self._counters["local_other"] += 1
+            return False, probability
+        self._counters["llm_fallbacks"] += 1
+        return None, probability
+
+    def stats(self) -> dict:
+        decided = self._counters["local_shopping"] + self._counters["local_other"]
+        total = decided + self._counters["llm_fallbacks"]
+        return {
+            "enabled": self.classifier is not None,
+            "confidence": self.confidence,
+            **self._counters,
+            "local_rate": decided / total if total else 0.0,
+        }
+
+
+def load_relevance_gate() -> RelevanceGate:
+    if RELEVANCE_CLASSIFIER == "off":
+        return RelevanceGate(None)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), RELEVANCE_LABELS_PATH)
+    try:
+        return RelevanceGate(RelevanceClassifier.from_labels_file(path))
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"加载购物相关性标注集 {path} 失败，相关性判断将全部使用 LLM: {e}")
+        return RelevanceGate(None)
@@ -0,0 +1,342 @@
+# risk_classifier.py
+# 离线风险分类：以知识库条目的 riskType 为训练集，对整批文本向量做 kNN 投票或类中心打分，不调用 LLM
+#
+# 两种方法:
+#   knn        与最相似的 k 条知识按 softmax(相似度 / 温度) 加权投票，能区分同一类型下差异很大的话术
+#   centroid   与各风险类型的类中心（按近重复计数加权的均值向量）比较，只需 (批大小, 类型数) 的打分
+# 每批查询的打分都是一次矩阵乘法；risk_score 为“不属于无风险类”的概率。
+#
+# 命令行用法（夜间批量筛查）:
+#   python risk_classifier.py --input listings.jsonl --output screened.jsonl
+#   python risk_classifier.py --input chats.jsonl --output risky.jsonl --text-field content --min-risk-score 0.5
+#   # 输入行中带有 "embedding" 字段时直接使用，不调用 Embedding API
+#   python risk_classifier.py --input vectors.jsonl --output screened.jsonl --method centroid
+#
+# 输入为 JSONL，每行一个 JSON 对象（或一个 JSON 字符串）；输出为原对象加上 "risk" 字段:
+#   {"riskType": 预测类型, "confidence": 该类型的概率, "risk_score": 非无风险的概率,
+#    "scores": {前三个类型: 概率}, "nearest": {"riskType", "similarity"[, "text"]}}
+# 需要与服务端相同的 VIVO_APP_ID / VIVO_APP_KEY / RAG_API_DOMAIN / RAG_API_URI 环境变量（全部输入自带向量时除外）。
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from rag import KnowledgeBase, VivoEmbeddingClient, load_knowledge_base
+from vector_index import normalize_rows
+from knowledge_segments import DeltaStore
+from knowledge_manager import KNOWLEDGE_DELTA_DIR
+from build_knowledge_base import embed_batch
+from concurrency import gather_limited
+from http_client import close_async_client
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger("risk_classifier")
+
+RISK_METHODS = ("knn", "centroid")
+SAFE_RISK_TYPE = "无风险"
+DEFAULT_K = 10
+DEFAULT_TEMPERATURE = 0.05
+# 每次矩阵乘法的查询数：打分矩阵为 (QUERY_BLOCK, N) float32
+QUERY_BLOCK = 256
+SCORE_TOP_TYPES = 3
+NEAREST_TEXT_CHARS = 200
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=1, keepdims=True)
+    np.exp(logits, out=logits)
+    logits /= logits.sum(axis=1, keepdims=True)
+    return logits
+
+
+class RiskClassifier:
+    """
+    基于知识库的风险类型分类器。vectors 为按行归一化的知识向量，label_ids 为每行的风险类型下标。
+    知识库没有增量段与删除时直接引用基础段的（内存映射）矩阵，不复制。
+    """
+
+    def __init__(self, vectors: np.ndarray, label_ids: np.ndarray, names: List[str],
+                 weights: Optional[np.ndarray] = None, texts: Optional[Sequence[str]] = None,
+                 k: int = DEFAULT_K, temperature: float = DEFAULT_TEMPERATURE):
+        if len(vectors) == 0:
+            raise ValueError("知识库为空，无法构建风险分类器")
+        self.vectors = vectors
+        self.label_ids = label_ids
+        self.names = names
+        self.texts = texts
+        self.k = max(1, min(k, len(vectors)))
+        self.temperature = temperature
+        self.safe_id = names.index(SAFE_RISK_TYPE) if SAFE_RISK_TYPE in names else None
+        if weights is None:
+            weights = np.ones(len(vectors), dtype=np.float32)
+        self.centroids = self._centroids(weights)
+
+    def _centroids(self, weights: np.ndarray) -> np.ndarray:
+        """各风险类型按近重复计数加权的均值向量（归一化），等价于在去重前的语料上求均值"""
+        centroids = np.zeros((len(self.names), self.vectors.shape[1]), dtype=np.float32)
+        for label_id in range(len(self.names)):
+            rows = np.flatnonzero(self.label_ids == label_id)
+            if len(rows):
+                centroids[label_id] = weights[rows] @ np.asarray(self.vectors[rows], dtype=np.float32)
+        return normalize_rows(centroids)
+
+    @classmethod
+    def from_knowledge_base(cls, knowledge_base: KnowledgeBase, **kwargs) -> "RiskClassifier":
+        """
+        收集知识库基础段与增量段中未删除的条目。基础段需要 float32 向量
+        （RAG_VECTOR_STORAGE 为量化格式且关闭了 float32 重排时不可用）。
+        """
+        names = knowledge_base.risk_type_names()
+        name_ids = {name: i for i, name in enumerate(names)}
+        sources = []
+        if knowledge_base.index is not None:
+            if knowledge_base.embeddings_matrix is None:
+                raise ValueError("知识库未保留 float32 向量，请以 vector_storage='float32' 加载")
+            sources.append((
+                knowledge_base.embeddings_matrix, knowledge_base.partitions, knowledge_base.duplicate_counts,
+                knowledge_base.texts, knowledge_base.base_deleted,
+            ))
+        for segment in knowledge_base.deltas:
+            sources.append((segment.index.vectors, segment.partitions, segment.duplicate_counts,
+                            segment.texts, segment.deleted))
+
+        parts, label_parts, weight_parts, text_parts = [], [], [], []
+        for vectors, partitions, duplicate_counts, texts, deleted in sources:
+            label_ids = np.empty(len(vectors), dtype=np.int32)
+            for name, rows in partitions.rows.items():
+                label_ids[rows] = name_ids[name]
+            weights = np.ones(len(vectors), dtype=np.float32) if duplicate_counts is None \
+                else np.asarray(duplicate_counts, dtype=np.float32)
+            live = slice(None) if deleted is None else np.flatnonzero(~deleted)
+            parts.append(vectors if deleted is None else vectors[live])
+            label_parts.append(label_ids[live])
+            weight_parts.append(weights[live])
+            text_parts.append((texts, np.arange(len(vectors))[live]))
+
+        vectors = parts[0] if len(parts) == 1 else np.concatenate([np.asarray(p, dtype=np.float32) for p in parts])
+        texts = _ConcatenatedTexts(text_parts)
+        return cls(vectors, np.concatenate(label_parts), names, np.concatenate(weight_parts), texts, **kwargs)
+
+    def _knn_probabilities(self, scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """返回 (类型概率, 最近邻行号, 最近邻相似度)"""
+        count = scores.shape[0]
+        if self.k < scores.shape[1]:
+            neighbors = np.argpartition(scores, scores.shape[1] - self.k, axis=1)[:, -self.k:]
+        else:
+            neighbors = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        similarities = np.take_along_axis(scores, neighbors, axis=1)
+        votes = _softmax(similarities / self.temperature)
+        probabilities = np.zeros((count, len(self.names)), dtype=np.float32)
+        neighbor_labels = self.label_ids[neighbors]
+        for column in range(neighbors.shape[1]):
+            np.add.at(probabilities, (np.arange(count), neighbor_labels[:, column]), votes[:, column])
+        best = similarities.argmax(axis=1)
+        nearest = neighbors[np.arange(count), best]
+        return probabilities, nearest, similarities[np.arange(count), best]
+
+    def predict_proba(self, queries: np.ndarray, method: str = "knn") -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        对 (m, d) 查询向量打分，返回 (m, 类型数) 的概率矩阵、最近的知识条目行号与其相似度。
+        按 QUERY_BLOCK 分块，每块一次 (块大小, d) x (d, N) 的矩阵乘法。
+        """
+        if method not in RISK_METHODS:
+            raise ValueError(f"未知的分类方法: {method}，可选: {', '.join(RISK_METHODS)}")
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.vectors.shape[1]:
+            raise ValueError(f"查询向量维度 {queries.shape} 与知识库维度 {self.vectors.shape[1]} 不符")
+        queries = normalize_rows(queries)
+        count = queries.shape[0]
+        probabilities = np.zeros((count, len(self.names)), dtype=np.float32)
+        nearest = np.zeros(count, dtype=np.int64)
+        nearest_similarity = np.zeros(count, dtype=np.float32)
+        for start in range(0, count, QUERY_BLOCK):
+            block = slice(start, start + QUERY_BLOCK)
+            scores = queries[block] @ self.vectors.T
+            if method == "knn":
+                probabilities[block], nearest[block], nearest_similarity[block] = self._knn_probabilities(scores)
+            else:
+                probabilities[block] = _softmax(queries[block] @ self.centroids.T / self.temperature)
+                nearest[block] = scores.argmax(axis=1)
+                nearest_similarity[block] = scores[np.arange(scores.shape[0]), nearest[block]]
+        return probabilities, nearest, nearest_similarity
+
+    def classify_batch(self, queries: np.ndarray, method: str = "knn", with_text: bool = False) -> List[dict]:
+        probabilities, nearest, nearest_similarity = self.predict_proba(queries, method)
+        safe = probabilities[:, self.safe_id] if self.safe_id is not None else np.zeros(len(probabilities))
+        results = []
+        for row, neighbor, similarity, safe_probability in zip(probabilities, nearest, nearest_similarity, safe):
+            ranked = np.argsort(row)[::-1][:SCORE_TOP_TYPES]
+            nearest_info = {
+                "riskType": self.names[int(self.label_ids[neighbor])],
+                "similarity": round(float(similarity), 4),
+            }
+            if with_text and self.texts is not None:
+                nearest_info["text"] = self.texts[int(neighbor)][:NEAREST_TEXT_CHARS]
+            results.append({
+                "riskType": self.names[int(ranked[0])],
+                "confidence": round(float(row[ranked[0]]), 4),
+                "risk_score": round(float(1.0 - safe_probability), 4),
+                "scores": {self.names[int(i)]: round(float(row[i]), 4) for i in ranked if row[i] > 0},
+                "nearest": nearest_info,
+            })
+        return results
+
+
+class _ConcatenatedTexts:
+    """按拼接后的行号访问各来源（基础段、增量段）中未删除条目的文本，不复制文本表"""
+
+    def __init__(self, parts: List[Tuple[Sequence[str], np.ndarray]]):
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(rows) for _, rows in parts])
+
+    def __getitem__(self, i: int) -> str:
+        part = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        texts, rows = self.parts[part]
+        return texts[int(rows[i - self.offsets[part]])]
+
+
+def load_risk_classifier(**kwargs) -> RiskClassifier:
+    """加载当前知识库（基础段 + 增量段）并构建分类器，与服务端读取的是同一份数据"""
+    delta_store = DeltaStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), KNOWLEDGE_DELTA_DIR))
+    with delta_store.locked(exclusive=False):
+        base = load_knowledge_base(vector_storage="float32", lexical=False)
+        deltas, tombstones = delta_store.read_segments()
+    return RiskClassifier.from_knowledge_base(base.with_deltas(deltas, tombstones), **kwargs)
+
+
+def iter_jsonl_chunks(path: str, text_field: str, chunk_size: int) -> Iterator[Tuple[List[dict], List[str], List[Optional[list]], int]]:
+    """按块读取 JSONL，产出 (记录, 文本, 自带的向量或 None, 本块跳过的无效行数)"""
+    records, texts, embeddings, invalid = [], [], [], 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"第 {line_number} 行不是有效的 JSON，已跳过")
+                invalid += 1
+                continue
+            if isinstance(record, str):
+                record = {text_field: record}
+            text = str(record.get(text_field, "")).strip() if isinstance(record, dict) else ""
+            embedding = record.get("embedding") if isinstance(record, dict) else None
+            if not text and not isinstance(embedding, list):
+                logger.warning(f"第 {line_number} 行缺少 '{text_field}' 字段，已跳过")
+                invalid += 1
+                continue
+            records.append(record)
+            texts.append(text)
+            embeddings.append(embedding if isinstance(embedding, list) else None)
+            if len(records) >= chunk_size:
+                yield records, texts, embeddings, invalid
+                records, texts, embeddings, invalid = [], [], [], 0
+    if records or invalid:
+        yield records, texts, embeddings, invalid
+
+
+async def embed_texts(client: Optional[VivoEmbeddingClient], texts: List[str], embeddings: List[Optional[list]],
+                      batch_size: int, concurrency: int, retries: int, timeout: float) -> np.ndarray:
+    """输入自带向量的行直接使用，其余按批并发调用 Embedding API"""
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing and client is None:
+        raise ValueError("输入中有不带向量的行，但缺少 VIVO_APP_ID / VIVO_APP_KEY / RAG_API_DOMAIN / RAG_API_URI 环境变量")
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    fetched = await gather_limited(
+        [lambda rows=rows: embed_batch(client, [texts[i] for i in rows], retries, timeout) for rows in batches],
+        concurrency,
+    )
+    vectors = list(embeddings)
+    for rows, batch_vectors in zip(batches, fetched):
+        for i, vector in zip(rows, batch_vectors):
+            vectors[i] = vector
+    try:
+        return np.asarray(vectors, dtype=np.float32)
+    except ValueError as e:
+        raise ValueError(f"输入行中的向量维度不一致: {e}")
+
+
+async def screen(args) -> dict:
+    classifier = load_risk_classifier(k=args.k, temperature=args.temperature)
+    app_id, app_key = os.getenv("VIVO_APP_ID"), os.getenv("VIVO_APP_KEY")
+    domain, uri = os.getenv("RAG_API_DOMAIN"), os.getenv("RAG_API_URI")
+    client = VivoEmbeddingClient(app_id=app_id, app_key=app_key, domain=domain, uri=uri) \
+        if all([app_id, app_key, domain, uri]) else None
+    logger.info(
+        f"风险分类器: {len(classifier.vectors)} 条知识, {len(classifier.names)} 种风险类型, "
+        f"方法 {args.method}" + (f", k={classifier.k}" if args.method == "knn" else "")
+    )
+
+    stats = {"screened": 0, "written": 0, "invalid": 0, "risky": 0}
+    start_time = time.time()
+    try:
+        with open(args.output, "w", encoding="utf-8") as out:
+            for records, texts, embeddings, invalid in iter_jsonl_chunks(args.input, args.text_field, args.chunk_size):
+                stats["invalid"] += invalid
+                if not records:
+                    continue
+                queries = await embed_texts(
+                    client, texts, embeddings, args.batch_size, args.concurrency, args.retries, args.timeout
+                )
+                for record, risk in zip(records, classifier.classify_batch(queries, args.method, args.explain)):
+                    stats["screened"] += 1
+                    if risk["riskType"] != SAFE_RISK_TYPE:
+                        stats["risky"] += 1
+                    if risk["risk_score"] < args.min_risk_score:
+                        continue
+                    record.pop("embedding", None)
+                    record["risk"] = risk
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    stats["written"] += 1
+                elapsed = time.time() - start_time
+                logger.info(f"筛查进度: {stats['screened']} 条, {stats['screened'] / max(elapsed, 1e-6):.0f} 条/秒")
+    finally:
+        await close_async_client()
+    stats["seconds"] = round(time.time() - start_time, 2)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="用知识库的风险类型标签对 JSONL 中的文本做批量风险分类（不调用 LLM）")
+    parser.add_argument("--input", required=True, help="输入 JSONL 文件")
+    parser.add_argument("--output", required=True, help="输出 JSONL 文件")
+    parser.add_argument("--text-field", default="text", help="文本所在的字段 (默认: text)")
+    parser.add_argument("--method", choices=RISK_METHODS, default="knn", help="分类方法 (默认: knn)")
+    parser.add_argument("--k", type=int, default=DEFAULT_K, help=f"kNN 的近邻数 (默认: {DEFAULT_K})")
+    parser.add_argument("--temperature", type=float, default=DEFAULT_TEMPERATURE,
+                        help=f"相似度 softmax 的温度，越小越接近多数投票给最近邻 (默认: {DEFAULT_TEMPERATURE})")
+    parser.add_argument("--min-risk-score", type=float, default=0.0,
+                        help="只输出 risk_score 不低于该值的行，0 表示全部输出 (默认: 0)")
+    parser.add_argument("--explain", action="store_true", help="输出中附带最相似知识条目的文本片段")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="每次读入并打分的行数 (默认: 4096)")
+    parser.add_argument("--batch-size", type=int, default=64, help="每次 Embedding API 调用的句子数 (默认: 64)")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的 API 调用数 (默认: 8)")
+    parser.add_argument("--retries", type=int, default=5, help="单个批次的最大重试次数 (默认: 5)")
+    parser.add_argument("--timeout", type=float, default=60, help="单次 API 调用超时秒数 (默认: 60)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    try:
+        stats = asyncio.run(screen(args))
+    except (OSError, ValueError, RuntimeError) as e:
+        logger.error(f"筛查失败: {e}")
+        return 1
+    print(
+        f"已筛查 {stats['screened']} 条 (无效 {stats['invalid']} 条), 预测为有风险 {stats['risky']} 条, "
+        f"写入 {stats['written']} 条 -> {args.output}, 用时 {stats['seconds']} 秒"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -53,6 +53,9 @@ class ChatCompletionRequest(BaseModel):
     # 新增RAG控制参数
     enable_rag: Optional[bool] = True  # 默认开启RAG
     rag_top_k: Optional[int] = 1       # RAG检索数量
+    rag_risk_types: Optional[List[str]] = None          # 只检索这些风险类型
+    rag_exclude_risk_types: Optional[List[str]] = None  # 排除这些风险类型，如 ["无风险"]
+    rag_per_risk_type: Optional[bool] = False           # 每个风险类型各取 rag_top_k 条最相似的知识
 
 class ChatCompletionResponseChoice(BaseModel):
     index: int
@@ -65,4 +68,16 @@ class ChatCompletionResponse(BaseModel):
     created: int
     model: str
     choices: List[ChatCompletionResponseChoice]
-    usage: UsageInfo
\ No newline at end of file
+    usage: UsageInfo
+
+# --- Knowledge Base Admin Schemas ---
+
+class KnowledgeEntry(BaseModel):
+    text: str = Field(..., min_length=1)
+    riskType: Optional[str] = None
+
+class KnowledgeAppendRequest(BaseModel):
+    entries: List[KnowledgeEntry] = Field(..., min_length=1)
+
+class KnowledgeDeleteRequest(BaseModel):
+    texts: List[str] = Field(..., min_length=1)
@@ -0,0 +1,309 @@
+# search_cache.py
+# 联网搜索结果缓存：按内存字节数限制的进程内 LRU + 可选的 SQLite 持久层，每条结果按 search_recency_filter 设定过期时间
+#
+# 缓存键为归一化的搜索词与影响结果的参数（搜索引擎、意图、条数、域名过滤、时间范围、内容长度），
+# request_id / user_id 不参与。调用失败的结果也会缓存较短的时间（负缓存），避免故障期间反复请求同一个搜索；
+# 同一个键的并发未命中只发起一次请求，其余等待者共享结果。
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from embedding_cache import normalize_text
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 搜索结果缓存: on / off
+SEARCH_CACHE = os.getenv("SEARCH_CACHE", "on").strip().lower()
+# 进程内 LRU 的内存上限（MB，按结果 JSON 的字节数计），0 表示关闭内存层
+SEARCH_CACHE_MEMORY_MB = float(os.getenv("SEARCH_CACHE_MEMORY_MB", "32"))
+# SQLite 持久层路径，留空表示不启用
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "")
+# 持久层最多保留的结果条数，超过后删除最早写入的条目
+SEARCH_CACHE_DISK_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_DISK_MAX_ENTRIES", "100000"))
+# 调用失败的结果缓存的秒数，0 表示不缓存失败结果
+SEARCH_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_NEGATIVE_TTL_SECONDS", "30"))
+
+# 各时间范围的结果缓存的秒数：范围越短，结果越依赖时效
+SEARCH_CACHE_TTLS = {
+    "oneDay": 15 * 60,
+    "oneWeek": 60 * 60,
+    "oneMonth": 6 * 60 * 60,
+    "oneYear": 24 * 60 * 60,
+    "noLimit": 24 * 60 * 60,
+}
+DEFAULT_SEARCH_CACHE_TTL = SEARCH_CACHE_TTLS["noLimit"]
+
+# 参与缓存键的搜索参数
+SEARCH_KEY_PARAMS = (
+    "search_engine", "search_intent", "count", "search_domain_filter", "search_recency_filter", "content_size",
+)
+
+# 每写入多少条检查一次持久层容量
+_PRUNE_EVERY = 1000
+# 持久层等待其他 worker 写锁的秒数；读写都在线程池中执行，超时按未命中 / 写入失败处理
+_BUSY_TIMEOUT_SECONDS = 5
+
+# 搜索词首尾的标点与问号不影响搜索结果
+_QUERY_EDGE_RE = re.compile(r"^[\s\W_]+|[\s\W_]+$")
+
+
+def normalize_query(query: str) -> str:
+    """NFKC 归一化、转小写、合并空白并去掉首尾标点，“iPhone 15 价格？”与“iphone  15 价格”命中同一项"""
+    return _QUERY_EDGE_RE.sub("", normalize_text(str(query)).lower())
+
+
+def search_cache_key(search_query: str, params: dict) -> str:
+    key_params = {name: params.get(name) for name in SEARCH_KEY_PARAMS}
+    raw = json.dumps([normalize_query(search_query), key_params], ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def is_error_result(result: dict) -> bool:
+    return not isinstance(result, dict) or "error" in result
+
+
+class SearchCache:
+    """
+    按 (归一化搜索词, 搜索参数) 缓存 web_search 的返回结果。
+    先查进程内 LRU，未命中再查 SQLite 持久层，命中后回填内存层；过期的条目视为未命中。
+    get_or_fetch 中持久层的查询、写入与定期清理都在线程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(
+        self,
+        memory_bytes: int = int(SEARCH_CACHE_MEMORY_MB * 1024 * 1024),
+        path: str = SEARCH_CACHE_PATH,
+        disk_max_entries: int = SEARCH_CACHE_DISK_MAX_ENTRIES,
+        negative_ttl: float = SEARCH_CACHE_NEGATIVE_TTL_SECONDS,
+    ):
+        self.memory_budget = memory_bytes
+        self.path = path
+        self.disk_max_entries = disk_max_entries
+        self.negative_ttl = negative_ttl
+        # 键 -> (结果 JSON, 过期时间, UTF-8 字节数)
+        self._memory: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._memory_bytes = 0
+        # 内存层与持久层分别加锁，持久层的读写不会让内存层的查询等待
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._pending_writes = set()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._inserts_since_prune = 0
+        self._counters = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0, "negative_hits": 0, "coalesced": 0, "expired": 0,
+        }
+
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(
+                path, timeout=_BUSY_TIMEOUT_SECONDS, check_same_thread=False, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS search_results (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_search_results_created ON search_results(created_at)")
+            logger.info(f"搜索结果缓存持久层已打开: {path}")
+
+    def ttl_for(self, params: dict, result: dict) -> float:
+        if is_error_result(result):
+            return self.negative_ttl
+        return SEARCH_CACHE_TTLS.get(params.get("search_recency_filter") or "noLimit", DEFAULT_SEARCH_CACHE_TTL)
+
+    def _memory_pop(self, key: str):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= entry[2]
+
+    def _memory_put(self, key: str, payload: str, expires_at: float):
+        size = len(payload.encode("utf-8"))
+        if size > self.memory_budget:
+            return
+        self._memory_pop(key)
+        self._memory[key] = (payload, expires_at, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_budget:
+            _, (_, _, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+
+    def _memory_get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                self._memory_pop(key)
+                self._counters["expired"] += 1
+                return None
+            self._memory.move_to_end(key)
+            self._counters["memory_hits"] += 1
+            payload = entry[0]
+        return self._decode(payload)
+
+    def _disk_get(self, key: str) -> Optional[dict]:
+        """查持久层并回填内存层（阻塞调用）；持久层出错时按未命中处理"""
+        try:
+            with self._disk_lock:
+                row = self._conn.execute(
+                    "SELECT result, expires_at FROM search_results WHERE key = ? AND expires_at > ?", (key, time.time())
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"读取搜索结果缓存持久层失败: {e}")
+            return None
+        if row is None:
+            return None
+        payload, expires_at = row
+        with self._lock:
+            self._memory_put(key, payload, expires_at)
+            self._counters["disk_hits"] += 1
+        return self._decode(payload)
+
+    def get(self, key: str) -> Optional[dict]:
+        """同步查询（内存层 + 持久层）；异步代码请使用 get_or_fetch，持久层查询不阻塞事件循环"""
+        result = self._memory_get(key)
+        if result is None and self._conn is not None:
+            result = self._disk_get(key)
+        if result is None:
+            self._counters["misses"] += 1
+        return result
+
+    def _decode(self, payload: str) -> dict:
+        result = json.loads(payload)
+        if is_error_result(result):
+            self._counters["negative_hits"] += 1
+        return result
+
+    def _disk_put(self, key: str, payload: str, expires_at: float, now: float):
+        try:
+            with self._disk_lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO search_results (key, result, expires_at, created_at) VALUES (?, ?, ?, ?)",
+                    (key, payload, expires_at, now),
+                )
+                self._inserts_since_prune += 1
+                if self._inserts_since_prune >= _PRUNE_EVERY:
+                    self._inserts_since_prune = 0
+                    self._prune(now)
+        except sqlite3.Error as e:
+            logger.warning(f"写入搜索结果缓存持久层失败: {e}")
+
+    def put(self, key: str, result: dict, ttl: float, background: bool = False):
+        """
+        写入内存层与持久层。background 为 True 时（需在事件循环中调用）持久层的写入与定期清理
+        在线程池中后台执行，调用方不等待。
+        """
+        if ttl <= 0:
+            return
+        payload = json.dumps(result, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._memory_put(key, payload, now + ttl)
+        if self._conn is None:
+            return
+        if not background:
+            self._disk_put(key, payload, now + ttl, now)
+            return
+        task = asyncio.get_running_loop().create_task(asyncio.to_thread(self._disk_put, key, payload, now + ttl, now))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._pending_writes.discard)
+
+    async def flush(self):
+        """等待进行中的后台写入完成"""
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+
+    def _prune(self, now: float):
+        self._conn.execute("DELETE FROM search_results WHERE expires_at <= ?", (now,))
+        count = self._conn.execute("SELECT COUNT(*) FROM search_results").fetchone()[0]
+        excess = count - self.disk_max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM search_results WHERE key IN "
+                "(SELECT key FROM search_results ORDER BY created_at LIMIT ?)",
+                (excess,),
+            )
+            logger.info(f"搜索结果缓存持久层超过上限，已删除最早的 {excess} 条")
+
+    async def get_or_fetch(self, search_query: str, params: dict, fetch: Callable[[], Awaitable[dict]]) -> dict:
+        """
+        命中时直接返回缓存结果；未命中时调用 fetch()，同一个键的并发请求共享这一次调用（含持久层查询）。
+        内存层在事件循环中查询，持久层的查询与写入都在线程池中执行。
+        """
+        key = search_cache_key(search_query, params)
+        result = self._memory_get(key)
+        if result is not None:
+            return result
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._counters["coalesced"] += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # 发起请求的一方被取消时自行请求；自身被取消时照常向上抛出
+                if not inflight.cancelled():
+                    raise
+            except Exception:
+                pass
+            return await fetch()
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = None
+            if self._conn is not None:
+                result = await asyncio.to_thread(self._disk_get, key)
+            if result is None:
+                self._counters["misses"] += 1
+                result = await fetch()
+                self.put(key, result, self.ttl_for(params, result), background=True)
+            future.set_result(result)
+            return result
+        except BaseException:
+            # 等待者看到取消后各自重新请求
+            future.cancel()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self._counters["memory_hits"] + self._counters["disk_hits"] + self._counters["misses"]
+        hits = self._counters["memory_hits"] + self._counters["disk_hits"]
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_budget_bytes": self.memory_budget,
+            "persistent": self._conn is not None,
+            "pending_disk_writes": len(self._pending_writes),
+            **self._counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def create_search_cache() -> Optional[SearchCache]:
+    """按环境变量创建搜索结果缓存；关闭或内存层与持久层都未启用时返回 None"""
+    if SEARCH_CACHE == "off" or (SEARCH_CACHE_MEMORY_MB <= 0 and not SEARCH_CACHE_PATH):
+        return None
+    return SearchCache()
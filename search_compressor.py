@@ -0,0 +1,169 @@
+# search_compressor.py
+# 联网搜索结果的本地抽取式压缩：把各条结果的正文切分为句子，按与搜索词的 BM25 相关度和购物关键词（价格、平台、可信度）打分，
+# 在 token 预算内选出得分最高且互不重复的句子，按原顺序拼回各条结果。不调用 LLM，耗时为毫秒级。
+#
+# SEARCH_SUMMARY_MODE:
+#   extractive   本地抽取式压缩（默认）
+#   llm          调用 LLM 生成摘要（多一次串行 LLM 调用，失败时回退为抽取式压缩）
+#   off          不压缩，直接使用原始搜索结果
+import os
+import re
+import math
+import unicodedata
+import logging
+from collections import Counter
+from typing import List
+
+from dotenv import load_dotenv
+
+from embedding_cache import normalize_text
+from lexical_index import tokenize, BM25_K1, BM25_B
+from token_counter import count_tokens
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SEARCH_SUMMARY_MODES = ("extractive", "llm", "off")
+SEARCH_SUMMARY_MODE = os.getenv("SEARCH_SUMMARY_MODE", "extractive").strip().lower()
+# 搜索结果 JSON 超过该字符数时才压缩
+SEARCH_SUMMARY_THRESHOLD_CHARS = int(os.getenv("SEARCH_SUMMARY_THRESHOLD_CHARS", "1500"))
+# 抽取式压缩保留的正文 token 数
+SEARCH_SUMMARY_TOKEN_BUDGET = int(os.getenv("SEARCH_SUMMARY_TOKEN_BUDGET", "600"))
+# LLM 摘要模式的输出 token 上限（不再沿用用户请求的 max_tokens）
+SEARCH_SUMMARY_MAX_TOKENS = int(os.getenv("SEARCH_SUMMARY_MAX_TOKENS", "512"))
+
+# 购物相关的关键词：命中的句子额外加分（每类最多计一次）
+SHOPPING_KEYWORDS = {
+    "price": ("价格", "售价", "报价", "多少钱", "元", "¥", "优惠", "补贴", "折扣", "降价", "券后", "到手价", "官方价"),
+    "platform": ("京东", "淘宝", "天猫", "拼多多", "抖音", "闲鱼", "官网", "官方", "旗舰店", "自营", "授权", "专卖店"),
+    "trust": ("正品", "假货", "假冒", "山寨", "翻新", "投诉", "诈骗", "骗局", "维权", "退款", "售后", "保修",
+              "评价", "口碑", "黑猫", "鉴定", "质量", "虚假"),
+}
+SHOPPING_KEYWORD_WEIGHT = 0.5
+# 含数字（价格、型号、日期）的句子额外加分
+NUMBER_WEIGHT = 0.2
+# 每条结果中越靠前的句子略微加分
+POSITION_WEIGHT = 0.3
+# 与已选句子的二元组 Jaccard 相似度超过该值时视为重复
+REDUNDANCY_THRESHOLD = 0.6
+MIN_SENTENCE_CHARS = 6
+MAX_SENTENCE_CHARS = 300
+
+# 结果条目中保留的元数据字段（正文字段之外）
+_META_FIELDS = ("query", "title", "link", "media", "publish_date")
+_CONTENT_FIELDS = ("content", "snippet", "summary")
+
+_SENTENCE_RE = re.compile(r"[^。！？!?；;\n]+[。！？!?；;]?")
+_NUMBER_RE = re.compile(r"\d")
+
+
+def split_sentences(text: str) -> List[str]:
+    sentences = []
+    for match in _SENTENCE_RE.finditer(unicodedata.normalize("NFKC", str(text))):
+        sentence = normalize_text(match.group())
+        if len(sentence) < MIN_SENTENCE_CHARS:
+            continue
+        # 没有标点的超长片段按长度截断，避免一句占满预算
+        sentences.extend(sentence[i:i + MAX_SENTENCE_CHARS] for i in range(0, len(sentence), MAX_SENTENCE_CHARS))
+    return sentences
+
+
+def _bigrams(text: str) -> set:
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _result_items(core_result) -> List[dict]:
+    """把搜索结果统一为条目列表；无法识别的结构整体当作一条正文"""
+    if isinstance(core_result, dict):
+        core_result = [core_result]
+    if not isinstance(core_result, list):
+        return [{"content": str(core_result)}]
+    items = []
+    for item in core_result:
+        items.append(item if isinstance(item, dict) else {"content": str(item)})
+    return items
+
+
+def _item_content(item: dict) -> str:
+    for field in _CONTENT_FIELDS:
+        if item.get(field):
+            return str(item[field])
+    return ""
+
+
+def compress_search_results(core_result, search_query: str, shopping: bool = True,
+                            token_budget: int = SEARCH_SUMMARY_TOKEN_BUDGET) -> List[dict]:
+    """
+    返回压缩后的结果条目列表：保留各条目的标题、链接、来源，正文只保留入选的句子。
+    没有句子入选的条目整体省略，全部结果都没有相关句子时返回空列表。打分为句子与搜索词的 BM25（idf 在本次的全部句子上计算），
+    shopping 为 True 时加上购物关键词、数字与位置的加分。
+    """
+    items = _result_items(core_result)
+    candidates = []  # (条目下标, 句内位置, 句子)
+    seen = set()
+    for item_id, item in enumerate(items):
+        for position, sentence in enumerate(split_sentences(_item_content(item))):
+            key = normalize_text(sentence).lower()
+            if key in seen:
+                continue
+            seen.add(key)
+            candidates.append((item_id, position, sentence))
+    if not candidates:
+        return []
+
+    sentence_tokens = [Counter(tokenize(sentence)) for _, _, sentence in candidates]
+    query_terms = set(tokenize(search_query))
+    document_frequency = Counter(term for tokens in sentence_tokens for term in tokens if term in query_terms)
+    n = len(candidates)
+    lengths = [sum(tokens.values()) for tokens in sentence_tokens]
+    average_length = max(sum(lengths) / n, 1.0)
+
+    scores = []
+    for (item_id, position, sentence), tokens, length in zip(candidates, sentence_tokens, lengths):
+        score = 0.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+        for term in query_terms:
+            tf = tokens.get(term, 0)
+            if tf:
+                idf = math.log(1.0 + (n - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+                score += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        if shopping:
+            score += SHOPPING_KEYWORD_WEIGHT * sum(
+                any(keyword in sentence for keyword in keywords) for keywords in SHOPPING_KEYWORDS.values()
+            )
+            if _NUMBER_RE.search(sentence):
+                score += NUMBER_WEIGHT
+        # 既不含搜索词也不含购物关键词的句子不入选，位置加分只用于区分相关的句子
+        scores.append(score + POSITION_WEIGHT / (1 + position) if score > 0 else 0.0)
+
+    # 按得分从高到低贪心选取，跳过与已选句子重复的句子，直到预算用完
+    selected, selected_bigrams = [], []
+    remaining = token_budget
+    for index in sorted(range(n), key=lambda i: scores[i], reverse=True):
+        if scores[index] <= 0:
+            break
+        sentence = candidates[index][2]
+        cost = count_tokens(sentence)
+        if cost > remaining:
+            continue
+        grams = _bigrams(sentence)
+        if any(len(grams & other) > REDUNDANCY_THRESHOLD * len(grams | other) for other in selected_bigrams):
+            continue
+        selected.append(index)
+        selected_bigrams.append(grams)
+        remaining -= cost
+        if remaining <= 0:
+            break
+
+    by_item = {}
+    for index in sorted(selected):
+        item_id, _, sentence = candidates[index]
+        by_item.setdefault(item_id, []).append(sentence)
+    compressed = []
+    for item_id, sentences in by_item.items():
+        entry = {field: items[item_id][field] for field in _META_FIELDS if items[item_id].get(field)}
+        entry["content"] = "".join(sentences)
+        compressed.append(entry)
+    return compressed
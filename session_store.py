@@ -0,0 +1,643 @@
+# session_store.py
+# 会话历史存储：统一接口 + 内存 / SQLite / Redis 三种后端
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+try:
+    import redis
+except ImportError:  # 仅在使用 Redis 后端时需要
+    redis = None
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+SESSION_IDLE_TTL_SECONDS = float(os.getenv("SESSION_IDLE_TTL_SECONDS", "3600"))
+SESSION_MEMORY_BUDGET_MB = float(os.getenv("SESSION_MEMORY_BUDGET_MB", "256"))
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "200"))
+SESSION_SWEEP_INTERVAL_SECONDS = float(os.getenv("SESSION_SWEEP_INTERVAL_SECONDS", "60"))
+
+# 后端选择: memory（单进程）/ sqlite（同机多 worker 共享）/ redis（跨机器共享）
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory").strip().lower()
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.sqlite")
+SESSION_SQLITE_CACHE_SIZE = int(os.getenv("SESSION_SQLITE_CACHE_SIZE", "1024"))
+# 等待其他 worker 释放写锁的秒数，超时后本次读写失败而不是长时间占用线程
+SESSION_SQLITE_BUSY_TIMEOUT_SECONDS = float(os.getenv("SESSION_SQLITE_BUSY_TIMEOUT_SECONDS", "1"))
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_REDIS_PREFIX = os.getenv("SESSION_REDIS_PREFIX", "shopguard:session")
+# Redis 连接与单次命令的超时秒数，Redis 卡住时请求失败而不是无限等待
+SESSION_REDIS_CONNECT_TIMEOUT_SECONDS = float(os.getenv("SESSION_REDIS_CONNECT_TIMEOUT_SECONDS", "1"))
+SESSION_REDIS_SOCKET_TIMEOUT_SECONDS = float(os.getenv("SESSION_REDIS_SOCKET_TIMEOUT_SECONDS", "2"))
+
+# 每条消息除内容外的固定开销估计（dict、键、字符串对象头等）
+MESSAGE_OVERHEAD_BYTES = 256
+
+
+def estimate_message_bytes(message: dict) -> int:
+    """估算单条消息占用的内存字节数"""
+    content = message.get("content", "")
+    if not isinstance(content, str):
+        content = str(content)
+    return len(content.encode("utf-8")) + MESSAGE_OVERHEAD_BYTES
+
+
+class BaseSessionStore(ABC):
+    """
+    会话历史存储接口。create_chat_completion 与 generate_openai_stream 只通过该接口读写历史，
+    因此可以在不同后端之间切换，使多个 uvicorn worker / 多台机器共享同一用户的会话。
+
+    异步代码应调用 *_async 方法：blocking 为 True 的后端（SQLite / Redis）会在线程池中执行，
+    等待写锁或网络时不阻塞事件循环；内存后端直接在事件循环中执行。
+    """
+
+    blocking = True
+
+    def __init__(self, idle_ttl_seconds: float, max_messages: int, sweep_interval_seconds: float):
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_messages = max_messages
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self._sweeper_task: Optional[asyncio.Task] = None
+        self._counters: Dict[str, int] = {
+            "evicted_lru": 0,
+            "evicted_ttl": 0,
+            "evicted_memory": 0,
+            "trimmed_messages": 0,
+        }
+
+    @abstractmethod
+    def get_history(self, user_id: str) -> List[dict]:
+        """返回会话历史的副本；会话不存在时返回空列表"""
+
+    @abstractmethod
+    def append_message(self, user_id: str, message: dict):
+        """向会话追加一条消息，超出 max_messages 时裁剪最旧的消息"""
+
+    @abstractmethod
+    def compact_history(self, user_id: str, head: List[dict], replacement: dict) -> bool:
+        """
+        若会话开头仍是 head 中的消息，则将其原子地替换为 replacement 一条消息。
+        供后台摘要任务使用；期间会话开头被裁剪或修改时返回 False，不做任何变更。
+        """
+
+    @abstractmethod
+    def delete_session(self, user_id: str) -> bool:
+        """删除会话，返回会话此前是否存在"""
+
+    @abstractmethod
+    def message_count(self, user_id: str) -> int:
+        """返回会话中的消息条数"""
+
+    @abstractmethod
+    def session_count(self) -> int:
+        """返回当前会话数"""
+
+    @abstractmethod
+    def total_messages(self) -> int:
+        """返回所有会话的消息总数"""
+
+    @abstractmethod
+    def sweep(self) -> int:
+        """清理空闲超时或超出容量的会话，返回清理数量"""
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.message_count(user_id) > 0
+
+    def __len__(self) -> int:
+        return self.session_count()
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend_name,
+            "sessions": self.session_count(),
+            "messages": self.total_messages(),
+            **self._counters,
+        }
+
+    # --- 异步接口 ---
+
+    async def _call(self, func, *args):
+        if not self.blocking:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    async def get_history_async(self, user_id: str) -> List[dict]:
+        return await self._call(self.get_history, user_id)
+
+    async def append_message_async(self, user_id: str, message: dict):
+        return await self._call(self.append_message, user_id, message)
+
+    async def compact_history_async(self, user_id: str, head: List[dict], replacement: dict) -> bool:
+        return await self._call(self.compact_history, user_id, head, replacement)
+
+    async def message_count_async(self, user_id: str) -> int:
+        return await self._call(self.message_count, user_id)
+
+    async def stats_async(self) -> dict:
+        return await self._call(self.stats)
+
+    # --- 后台清理任务 ---
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval_seconds)
+            try:
+                await self._call(self.sweep)
+            except Exception as e:
+                logger.error(f"会话清理任务出错: {e}", exc_info=True)
+
+    def start_sweeper(self):
+        if self._sweeper_task is None or self._sweeper_task.done():
+            self._sweeper_task = asyncio.get_running_loop().create_task(self._sweep_loop())
+
+    async def stop_sweeper(self):
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+            try:
+                await self._sweeper_task
+            except asyncio.CancelledError:
+                pass
+            self._sweeper_task = None
+
+
+class _Session:
+    __slots__ = ("messages", "size_bytes", "last_access")
+
+    def __init__(self):
+        self.messages: List[dict] = []
+        self.size_bytes = 0
+        self.last_access = time.monotonic()
+
+
+class MemorySessionStore(BaseSessionStore):
+    """
+    进程内会话历史存储（单 worker）。
+    - 按最近访问顺序维护会话（LRU），超过 max_sessions 或内存预算时淘汰最久未访问的会话
+    - 空闲超过 idle_ttl_seconds 的会话由后台任务定期清理
+    - 单个会话最多保留 max_messages 条消息
+    """
+
+    backend_name = "memory"
+    blocking = False
+
+    def __init__(
+        self,
+        max_sessions: int = SESSION_MAX_SESSIONS,
+        idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS,
+        memory_budget_bytes: int = int(SESSION_MEMORY_BUDGET_MB * 1024 * 1024),
+        max_messages: int = SESSION_MAX_MESSAGES,
+        sweep_interval_seconds: float = SESSION_SWEEP_INTERVAL_SECONDS,
+    ):
+        super().__init__(idle_ttl_seconds, max_messages, sweep_interval_seconds)
+        self.max_sessions = max_sessions
+        self.memory_budget_bytes = memory_budget_bytes
+
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._total_bytes = 0
+        self._total_messages = 0
+
+    # --- 基本访问 ---
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._sessions
+
+    def session_count(self) -> int:
+        return len(self._sessions)
+
+    def get_history(self, user_id: str) -> List[dict]:
+        """返回会话历史的副本，并刷新该会话的访问时间"""
+        session = self._touch(user_id, create=False)
+        return list(session.messages) if session else []
+
+    def message_count(self, user_id: str) -> int:
+        session = self._sessions.get(user_id)
+        return len(session.messages) if session else 0
+
+    def append_message(self, user_id: str, message: dict):
+        """追加消息，必要时裁剪旧消息并按预算淘汰其他会话"""
+        session = self._touch(user_id, create=True)
+        size = estimate_message_bytes(message)
+        session.messages.append(message)
+        session.size_bytes += size
+        self._total_bytes += size
+        self._total_messages += 1
+
+        while len(session.messages) > self.max_messages:
+            self._drop_oldest_message(session)
+
+        self._enforce_limits(keep=user_id)
+
+    def compact_history(self, user_id: str, head: List[dict], replacement: dict) -> bool:
+        session = self._sessions.get(user_id)
+        if session is None or not head or session.messages[:len(head)] != head:
+            return False
+        removed = sum(estimate_message_bytes(m) for m in head)
+        added = estimate_message_bytes(replacement)
+        session.messages[:len(head)] = [replacement]
+        session.size_bytes += added - removed
+        self._total_bytes += added - removed
+        self._total_messages += 1 - len(head)
+        return True
+
+    def delete_session(self, user_id: str) -> bool:
+        session = self._sessions.pop(user_id, None)
+        if session is None:
+            return False
+        self._total_bytes -= session.size_bytes
+        self._total_messages -= len(session.messages)
+        return True
+
+    def total_messages(self) -> int:
+        return self._total_messages
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["memory_bytes"] = self._total_bytes
+        stats["memory_budget_bytes"] = self.memory_budget_bytes
+        return stats
+
+    # --- 淘汰逻辑 ---
+
+    def _touch(self, user_id: str, create: bool) -> Optional[_Session]:
+        session = self._sessions.get(user_id)
+        if session is None:
+            if not create:
+                return None
+            session = _Session()
+            self._sessions[user_id] = session
+        else:
+            self._sessions.move_to_end(user_id)
+        session.last_access = time.monotonic()
+        return session
+
+    def _drop_oldest_message(self, session: _Session):
+        dropped = session.messages.pop(0)
+        size = estimate_message_bytes(dropped)
+        session.size_bytes -= size
+        self._total_bytes -= size
+        self._total_messages -= 1
+        self._counters["trimmed_messages"] += 1
+
+    def _evict_oldest(self, counter: str) -> bool:
+        """淘汰最久未访问的会话"""
+        if not self._sessions:
+            return False
+        user_id = next(iter(self._sessions))
+        self.delete_session(user_id)
+        self._counters[counter] += 1
+        logger.info(f"会话存储: 淘汰会话 {user_id} ({counter})")
+        return True
+
+    def _enforce_limits(self, keep: Optional[str] = None):
+        while len(self._sessions) > self.max_sessions:
+            self._evict_oldest("evicted_lru")
+
+        while self._total_bytes > self.memory_budget_bytes and len(self._sessions) > 1:
+            if next(iter(self._sessions)) == keep:
+                break
+            self._evict_oldest("evicted_memory")
+
+        # 只剩当前会话且仍超出预算时，裁剪其最旧的消息（至少保留最新一条）
+        if keep in self._sessions and self._total_bytes > self.memory_budget_bytes:
+            session = self._sessions[keep]
+            while self._total_bytes > self.memory_budget_bytes and len(session.messages) > 1:
+                self._drop_oldest_message(session)
+
+    def sweep(self) -> int:
+        """清理空闲超时的会话，返回清理数量"""
+        deadline = time.monotonic() - self.idle_ttl_seconds
+        evicted = 0
+        # OrderedDict 按访问时间有序，遇到未过期的会话即可停止
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.last_access > deadline:
+                break
+            self.delete_session(user_id)
+            self._counters["evicted_ttl"] += 1
+            evicted += 1
+        if evicted:
+            logger.info(f"会话存储: 清理 {evicted} 个空闲会话")
+        return evicted
+
+
+class SQLiteSessionStore(BaseSessionStore):
+    """
+    基于 SQLite (WAL 模式) 的会话存储，同一台机器上的多个 worker 共享一个数据库文件。
+    每个会话带有版本号，读取时先比对版本号，未变化则直接使用进程内读缓存，避免重复反序列化。
+    """
+
+    backend_name = "sqlite"
+
+    def __init__(
+        self,
+        path: str = SESSION_SQLITE_PATH,
+        max_sessions: int = SESSION_MAX_SESSIONS,
+        idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS,
+        max_messages: int = SESSION_MAX_MESSAGES,
+        sweep_interval_seconds: float = SESSION_SWEEP_INTERVAL_SECONDS,
+        cache_size: int = SESSION_SQLITE_CACHE_SIZE,
+        busy_timeout_seconds: float = SESSION_SQLITE_BUSY_TIMEOUT_SECONDS,
+    ):
+        super().__init__(idle_ttl_seconds, max_messages, sweep_interval_seconds)
+        self.path = path
+        self.max_sessions = max_sessions
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()  # user_id -> (version, messages)
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(
+            path, timeout=busy_timeout_seconds, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id TEXT PRIMARY KEY,
+                last_access REAL NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions(last_access);
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                message TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id, id);
+            """
+        )
+        logger.info(f"SQLite 会话存储已打开: {path}")
+
+    def _cache_put(self, user_id: str, version: int, messages: List[dict]):
+        self._cache[user_id] = (version, messages)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get_history(self, user_id: str) -> List[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                self._cache.pop(user_id, None)
+                return []
+            version = row[0]
+            cached = self._cache.get(user_id)
+            if cached is not None and cached[0] == version:
+                self._cache.move_to_end(user_id)
+                return list(cached[1])
+            rows = self._conn.execute(
+                "SELECT message FROM messages WHERE user_id = ? ORDER BY id", (user_id,)
+            ).fetchall()
+            messages = [json.loads(r[0]) for r in rows]
+            self._cache_put(user_id, version, messages)
+            return list(messages)
+
+    def append_message(self, user_id: str, message: dict):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO sessions (user_id, last_access, version) VALUES (?, ?, 1) "
+                    "ON CONFLICT(user_id) DO UPDATE SET last_access = excluded.last_access, version = version + 1",
+                    (user_id, time.time()),
+                )
+                self._conn.execute(
+                    "INSERT INTO messages (user_id, message) VALUES (?, ?)",
+                    (user_id, json.dumps(message, ensure_ascii=False)),
+                )
+                cur = self._conn.execute(
+                    "DELETE FROM messages WHERE user_id = ? AND id NOT IN "
+                    "(SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                    (user_id, user_id, self.max_messages),
+                )
+                self._counters["trimmed_messages"] += max(cur.rowcount, 0)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def compact_history(self, user_id: str, head: List[dict], replacement: dict) -> bool:
+        if not head:
+            return False
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, message FROM messages WHERE user_id = ? ORDER BY id LIMIT ?", (user_id, len(head))
+                ).fetchall()
+                if [json.loads(r[1]) for r in rows] != head:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                ids = [r[0] for r in rows]
+                self._conn.execute(f"DELETE FROM messages WHERE id IN ({','.join('?' * len(ids))})", ids)
+                # 复用被删除的最小 id，保证摘要排在剩余消息之前
+                self._conn.execute(
+                    "INSERT INTO messages (id, user_id, message) VALUES (?, ?, ?)",
+                    (ids[0], user_id, json.dumps(replacement, ensure_ascii=False)),
+                )
+                self._conn.execute("UPDATE sessions SET version = version + 1 WHERE user_id = ?", (user_id,))
+                self._conn.execute("COMMIT")
+                return True
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete_session(self, user_id: str) -> bool:
+        with self._lock:
+            return self._delete_locked([user_id]) > 0
+
+    def _delete_locked(self, user_ids: List[str]) -> int:
+        if not user_ids:
+            return 0
+        placeholders = ",".join("?" * len(user_ids))
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(f"DELETE FROM messages WHERE user_id IN ({placeholders})", user_ids)
+            cur = self._conn.execute(f"DELETE FROM sessions WHERE user_id IN ({placeholders})", user_ids)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        for user_id in user_ids:
+            self._cache.pop(user_id, None)
+        return cur.rowcount
+
+    def message_count(self, user_id: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    def session_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def total_messages(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def sweep(self) -> int:
+        with self._lock:
+            deadline = time.time() - self.idle_ttl_seconds
+            expired = [r[0] for r in self._conn.execute(
+                "SELECT user_id FROM sessions WHERE last_access < ?", (deadline,)
+            ).fetchall()]
+            evicted_ttl = self._delete_locked(expired)
+
+            excess = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+            evicted_lru = 0
+            if excess > 0:
+                oldest = [r[0] for r in self._conn.execute(
+                    "SELECT user_id FROM sessions ORDER BY last_access LIMIT ?", (excess,)
+                ).fetchall()]
+                evicted_lru = self._delete_locked(oldest)
+
+        self._counters["evicted_ttl"] += evicted_ttl
+        self._counters["evicted_lru"] += evicted_lru
+        if evicted_ttl or evicted_lru:
+            logger.info(f"会话存储: 清理 {evicted_ttl} 个空闲会话, {evicted_lru} 个超量会话")
+        return evicted_ttl + evicted_lru
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["read_cache_entries"] = len(self._cache)
+        return stats
+
+
+class RedisSessionStore(BaseSessionStore):
+    """
+    基于 Redis 协议的会话存储，多台机器共享同一份会话。
+    每个会话是一个 list，写入时 RPUSH + LTRIM 限制长度并刷新 EXPIRE，空闲过期由 Redis 自行完成；
+    另用一个 sorted set 记录会话最近访问时间，用于统计与容量淘汰。
+    可传入任意兼容 redis-py 接口的 client（例如本地替身），否则按 url 创建连接。
+    """
+
+    backend_name = "redis"
+
+    def __init__(
+        self,
+        client=None,
+        url: str = SESSION_REDIS_URL,
+        prefix: str = SESSION_REDIS_PREFIX,
+        max_sessions: int = SESSION_MAX_SESSIONS,
+        idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS,
+        max_messages: int = SESSION_MAX_MESSAGES,
+        sweep_interval_seconds: float = SESSION_SWEEP_INTERVAL_SECONDS,
+    ):
+        super().__init__(idle_ttl_seconds, max_messages, sweep_interval_seconds)
+        if client is None:
+            if redis is None:
+                raise ImportError("使用 Redis 会话存储需要安装 redis 包: pip install redis")
+            client = redis.Redis.from_url(
+                url,
+                socket_connect_timeout=SESSION_REDIS_CONNECT_TIMEOUT_SECONDS,
+                socket_timeout=SESSION_REDIS_SOCKET_TIMEOUT_SECONDS,
+            )
+        self.client = client
+        self.prefix = prefix
+        self.max_sessions = max_sessions
+        self._index_key = f"{prefix}:index"
+
+    def _key(self, user_id: str) -> str:
+        return f"{self.prefix}:history:{user_id}"
+
+    @staticmethod
+    def _decode(value) -> str:
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def get_history(self, user_id: str) -> List[dict]:
+        return [json.loads(self._decode(item)) for item in self.client.lrange(self._key(user_id), 0, -1)]
+
+    def append_message(self, user_id: str, message: dict):
+        key = self._key(user_id)
+        pipe = self.client.pipeline()
+        pipe.rpush(key, json.dumps(message, ensure_ascii=False))
+        pipe.llen(key)
+        pipe.ltrim(key, -self.max_messages, -1)
+        pipe.expire(key, max(1, int(self.idle_ttl_seconds)))
+        pipe.zadd(self._index_key, {user_id: time.time()})
+        results = pipe.execute()
+        length = results[1]
+        if length > self.max_messages:
+            self._counters["trimmed_messages"] += length - self.max_messages
+
+    def compact_history(self, user_id: str, head: List[dict], replacement: dict) -> bool:
+        if not head:
+            return False
+        key = self._key(user_id)
+        with self.client.pipeline() as pipe:
+            try:
+                # WATCH 保证比较与替换之间会话未被其他 worker 修改
+                pipe.watch(key)
+                current = [json.loads(self._decode(item)) for item in pipe.lrange(key, 0, len(head) - 1)]
+                if current != head:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.ltrim(key, len(head), -1)
+                pipe.lpush(key, json.dumps(replacement, ensure_ascii=False))
+                pipe.execute()
+                return True
+            except Exception as e:
+                if redis is not None and isinstance(e, redis.WatchError):
+                    return False
+                raise
+
+    def delete_session(self, user_id: str) -> bool:
+        pipe = self.client.pipeline()
+        pipe.delete(self._key(user_id))
+        pipe.zrem(self._index_key, user_id)
+        deleted, _ = pipe.execute()
+        return bool(deleted)
+
+    def message_count(self, user_id: str) -> int:
+        return self.client.llen(self._key(user_id))
+
+    def session_count(self) -> int:
+        return self.client.zcount(self._index_key, time.time() - self.idle_ttl_seconds, "+inf")
+
+    def total_messages(self) -> int:
+        members = self.client.zrangebyscore(self._index_key, time.time() - self.idle_ttl_seconds, "+inf")
+        if not members:
+            return 0
+        pipe = self.client.pipeline()
+        for member in members:
+            pipe.llen(self._key(self._decode(member)))
+        return sum(pipe.execute())
+
+    def sweep(self) -> int:
+        # 会话 key 本身由 EXPIRE 过期，这里只清理索引并执行容量淘汰
+        evicted_ttl = self.client.zremrangebyscore(self._index_key, "-inf", time.time() - self.idle_ttl_seconds)
+        evicted_lru = 0
+        excess = self.client.zcard(self._index_key) - self.max_sessions
+        if excess > 0:
+            oldest = [self._decode(m) for m in self.client.zrange(self._index_key, 0, excess - 1)]
+            for user_id in oldest:
+                self.delete_session(user_id)
+            evicted_lru = len(oldest)
+
+        self._counters["evicted_ttl"] += evicted_ttl
+        self._counters["evicted_lru"] += evicted_lru
+        if evicted_ttl or evicted_lru:
+            logger.info(f"会话存储: 清理 {evicted_ttl} 个空闲会话索引, {evicted_lru} 个超量会话")
+        return evicted_ttl + evicted_lru
+
+
+def create_session_store(backend: str = SESSION_BACKEND) -> BaseSessionStore:
+    """根据配置创建会话存储后端"""
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    if backend == "redis":
+        return RedisSessionStore()
+    if backend != "memory":
+        logger.warning(f"未知的 SESSION_BACKEND 配置: {backend}，回退为 memory")
+    return MemorySessionStore()
@@ -0,0 +1,51 @@
+# 编译知识库的写入与打开：整体替换期间打开方不会看到目录不存在
+import time
+import threading
+
+import numpy as np
+
+import compiled_index
+from compiled_index import write_compiled_index, open_compiled_index
+
+
+def write_index(path, count: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    texts = [f"条目 {seed}-{i}" for i in range(count)]
+    risk_types = ["无风险" if i % 2 else "虚假购物、服务类" for i in range(count)]
+    return write_compiled_index(str(path), texts, risk_types, rng.normal(size=(count, 8)).astype(np.float32))
+
+
+def test_write_and_open_round_trip(tmp_path):
+    path = tmp_path / "index"
+    write_index(path, 6)
+    compiled = open_compiled_index(str(path))
+    assert compiled is not None
+    assert len(compiled) == 6
+    assert np.allclose(np.linalg.norm(compiled.vectors, axis=1), 1.0, atol=1e-5)
+    # 按风险类型分组，组内保持输入顺序
+    assert list(compiled.risk_types) == ["虚假购物、服务类"] * 3 + ["无风险"] * 3
+    assert list(compiled.texts)[:3] == ["条目 0-0", "条目 0-2", "条目 0-4"]
+
+
+def test_open_waits_for_directory_swap(tmp_path, monkeypatch):
+    path = tmp_path / "index"
+    write_index(path, 4)
+    opened = []
+    readers = []
+    rename = compiled_index.os.rename
+
+    def slow_rename(src, dst):
+        rename(src, dst)
+        if src == str(path):
+            # 旧目录已移走、新目录尚未就位：此时打开的一方应等待替换完成
+            reader = threading.Thread(target=lambda: opened.append(open_compiled_index(str(path))))
+            reader.start()
+            readers.append(reader)
+            time.sleep(0.2)
+
+    monkeypatch.setattr(compiled_index.os, "rename", slow_rename)
+    write_index(path, 5, seed=1)
+    for reader in readers:
+        reader.join()
+    assert readers and opened[0] is not None
+    assert len(opened[0]) == 5
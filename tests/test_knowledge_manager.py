@@ -0,0 +1,80 @@
+# 多个 worker 共享同一增量目录：其他 worker 合并后，本 worker 的增量重建与合并都要换用新的基础段
+import asyncio
+
+import numpy as np
+import pytest
+
+import rag
+import knowledge_manager
+from compiled_index import write_compiled_index
+from knowledge_manager import KnowledgeBaseManager
+
+DIM = 16
+BASE_TEXTS = [f"基础条目 {i}" for i in range(4)]
+VECTOR_IDS = {**{text: i for i, text in enumerate(BASE_TEXTS)}, "新条目 A": 10, "新条目 B": 11}
+
+
+def vector(text: str) -> np.ndarray:
+    v = np.full(DIM, 0.01, dtype=np.float32)
+    v[VECTOR_IDS[text]] = 1.0
+    return v
+
+
+class FakeEmbeddingClient:
+    async def get_embeddings_async(self, sentences):
+        return [vector(text).tolist() for text in sentences]
+
+
+@pytest.fixture
+def make_manager(tmp_path, monkeypatch):
+    compiled_dir = str(tmp_path / "compiled")
+    paths = lambda: (compiled_dir, str(tmp_path / "missing.json"))
+    monkeypatch.setattr(rag, "knowledge_source_paths", paths)
+    monkeypatch.setattr(knowledge_manager, "knowledge_source_paths", paths)
+    write_compiled_index(compiled_dir, BASE_TEXTS, ["无风险"] * 4, np.vstack([vector(text) for text in BASE_TEXTS]))
+
+    def make():
+        manager = KnowledgeBaseManager(FakeEmbeddingClient(), drain_timeout_seconds=1, delta_dir=str(tmp_path / "delta"))
+        manager.load_initial()
+        return manager
+
+    return make
+
+
+def live_texts(manager) -> set:
+    hits = manager.knowledge_base.find_similar_texts(np.ones(DIM, dtype=np.float32), top_n=10)
+    return {hit["text"] for hit in hits}
+
+
+def test_skipped_compaction_reloads_base_compacted_elsewhere(make_manager):
+    async def run():
+        first, second = make_manager(), make_manager()
+        await first.append_entries([("新条目 A", "无风险")])
+        await first.delete_entries(["基础条目 0"])
+        assert (await first.compact())["status"] == "ok"
+
+        # 第二个 worker 的合并被跳过，但应整体重建而不是保留旧的基础段
+        result = await second.compact()
+        assert result["status"] == "ok"
+        assert live_texts(second) == {"基础条目 1", "基础条目 2", "基础条目 3", "新条目 A"}
+        assert not second.needs_compaction()
+        assert not second.base_changed()
+
+    asyncio.run(run())
+
+
+def test_append_after_compaction_elsewhere_rebuilds_base(make_manager):
+    async def run():
+        first, second = make_manager(), make_manager()
+        await first.append_entries([("新条目 A", "无风险")])
+        await second.reload(deltas_only=True)
+        await first.delete_entries(["基础条目 0"])
+        await first.compact()
+
+        # 只重建增量部分会用旧基础段配清空后的 manifest：新条目 A 丢失、基础条目 0 复活
+        result = await second.append_entries([("新条目 B", "无风险")])
+        assert result["added"] == 1
+        assert live_texts(second) == {"基础条目 1", "基础条目 2", "基础条目 3", "新条目 A", "新条目 B"}
+        assert len(second.knowledge_base) == 5
+
+    asyncio.run(run())
@@ -0,0 +1,131 @@
+# 增量知识库：条目键、删除标记、增量段的追加 / 删除 / 合并，以及 KnowledgeBase.with_deltas 的检索结果
+import os
+
+import numpy as np
+
+from compiled_index import open_compiled_index
+from knowledge_segments import DeltaStore, deleted_mask, entry_key, entry_keys
+from rag import KnowledgeBase
+
+DIM = 16
+
+
+def vector(i: int) -> np.ndarray:
+    """第 i 个基向量加少量噪声，每条文本的最近邻只有它自己"""
+    v = np.full(DIM, 0.01, dtype=np.float32)
+    v[i % DIM] = 1.0
+    return v
+
+
+def vectors(ids) -> np.ndarray:
+    return np.vstack([vector(i) for i in ids])
+
+
+def make_base(count: int = 6) -> KnowledgeBase:
+    knowledge_base = KnowledgeBase(vector_storage="float32", lexical=True)
+    knowledge_base.load_knowledge_from_list([
+        {"text": f"基础条目 {i}", "embedding": vector(i).tolist(), "riskType": "无风险" if i % 2 else "虚假购物、服务类"}
+        for i in range(count)
+    ])
+    return knowledge_base
+
+
+def test_entry_key_ignores_format_differences():
+    assert entry_key("退款  链接") == entry_key(" 退款 链接 ")
+    assert entry_key("ＡＢＣ１２３") == entry_key("ABC123")
+    assert entry_key("退款链接") != entry_key("退款连接")
+    assert entry_keys(["a", "b"]).dtype == np.uint64
+
+
+def test_deleted_mask_only_applies_to_older_segments():
+    keys = np.array([1, 2, 3], dtype=np.uint64)
+    assert deleted_mask(keys, 2, {2: 1}) is None
+    assert deleted_mask(keys, 1, {2: 1}).tolist() == [False, True, False]
+    assert deleted_mask(keys, 0, {9: 5}) is None
+
+
+def test_append_skips_existing_and_relabels(tmp_path):
+    store = DeltaStore(str(tmp_path / "delta"))
+    name, rows, relabeled = store.append(["新条目 A", "新条目 B"], ["无风险", "无风险"], vectors([10, 11]))
+    assert (name, rows, relabeled) == ("segment_000001", [0, 1], 0)
+
+    # 文本与风险类型都相同：不写入新段
+    assert store.append(["新条目 A"], ["无风险"], vectors([10])) == (None, [], 0)
+
+    # 风险类型不同：旧条目写入删除标记，只作用于已有的段
+    name, rows, relabeled = store.append(["新条目 A"], ["虚假购物、服务类"], vectors([10]))
+    assert (name, rows, relabeled) == ("segment_000002", [0], 1)
+    assert store.read_manifest()["tombstones"] == {f"{entry_key('新条目 A'):016x}": 1}
+
+    with store.locked(exclusive=False):
+        segments, _ = store.read_segments()
+    assert [segment.live_count for segment in segments] == [1, 1]
+    assert segments[0].deleted.tolist() == [True, False]
+    assert segments[1].deleted is None
+    assert segments[1].risk_types[0] == "虚假购物、服务类"
+
+
+def test_delete_then_append_again(tmp_path):
+    store = DeltaStore(str(tmp_path / "delta"))
+    store.append(["新条目 A"], ["无风险"], vectors([10]))
+    assert store.delete([entry_key("新条目 A")]) == 1
+    with store.locked(exclusive=False):
+        segments, _ = store.read_segments()
+    assert segments[0].live_count == 0
+
+    # 删除后重新追加的同一文本不受之前的删除标记影响
+    name, rows, _ = store.append(["新条目 A"], ["无风险"], vectors([10]))
+    assert name == "segment_000002" and rows == [0]
+    with store.locked(exclusive=False):
+        segments, _ = store.read_segments()
+    assert [segment.live_count for segment in segments] == [0, 1]
+
+
+def test_compact_round_trip(tmp_path):
+    base = make_base(4)
+    store = DeltaStore(str(tmp_path / "delta"))
+    store.append(["新条目 A", "新条目 B"], ["无风险", "无风险"], vectors([10, 11]))
+    store.delete([entry_key("基础条目 1"), entry_key("新条目 B")])
+
+    out_dir = str(tmp_path / "compiled")
+    meta = store.compact(
+        out_dir, lambda: (base.texts, base.risk_types, base.embeddings_matrix, base.duplicate_counts)
+    )
+    assert meta["count"] == 4
+    compiled = open_compiled_index(out_dir)
+    assert sorted(compiled.texts) == ["基础条目 0", "基础条目 2", "基础条目 3", "新条目 A"]
+    assert store.read_manifest()["segments"] == [] and store.read_manifest()["tombstones"] == {}
+    assert not os.path.exists(os.path.join(store.path, "segment_000001"))
+
+    # 没有增量时不再合并
+    assert store.compact(out_dir, lambda: (base.texts, base.risk_types, base.embeddings_matrix, None)) is None
+
+
+def test_with_deltas_hides_tombstoned_rows(tmp_path):
+    base = make_base(6)
+    store = DeltaStore(str(tmp_path / "delta"))
+    store.append(["新条目 A"], ["无风险"], vectors([10]))
+    store.delete([entry_key("基础条目 2")])
+    with store.locked(exclusive=False):
+        segments, tombstones = store.read_segments()
+    knowledge_base = base.with_deltas(segments, tombstones)
+
+    assert len(base) == 6
+    assert len(knowledge_base) == 6
+    assert knowledge_base.segment_stats()["base_deleted"] == 1
+
+    # 被删除的基础条目不再出现，其余条目按相似度排在后面
+    hits = knowledge_base.find_similar_texts(vector(2), top_n=6)
+    assert "基础条目 2" not in [hit["text"] for hit in hits]
+    assert len(hits) == 6
+    assert base.find_similar_texts(vector(2), top_n=1)[0]["text"] == "基础条目 2"
+
+    # 增量段的条目与基础段一起参与检索
+    hits = knowledge_base.find_similar_texts(vector(10), top_n=1)
+    assert hits[0]["text"] == "新条目 A"
+    assert hits[0]["similarity"] > 0.99
+
+    count, matched = knowledge_base.find_live_entries(entry_keys(["基础条目 2", "基础条目 3", "新条目 A"]))
+    assert count == 2
+    assert sorted(matched.tolist()) == sorted([entry_key("基础条目 3"), entry_key("新条目 A")])
+    assert knowledge_base.find_live_risk_types(entry_keys(["新条目 A"])) == {entry_key("新条目 A"): "无风险"}
@@ -0,0 +1,108 @@
+# BM25 词法检索与混合检索：常见词项跳过、精确匹配排序、倒数排名融合与分数类型标注
+import numpy as np
+
+from lexical_index import LexicalIndex, tokenize
+from rag import KnowledgeBase, RAGSystem
+
+COMMON = "您好这里是官方客服"
+
+
+def common_corpus(count: int = 3000) -> list:
+    """每条都含常见话术，只有少数条目带有“退款链接”“保证金”等少见词项"""
+    texts = [f"{COMMON} 订单 {i}" for i in range(count)]
+    texts[10] = f"{COMMON} 请点击退款链接填写银行卡"
+    texts[20] = f"{COMMON} 退款需要先缴纳保证金"
+    texts[30] = "点击退款链接并缴纳保证金才能退款"
+    return texts
+
+
+def test_tokenize_bigrams_and_words():
+    assert tokenize("退款链接 ABC 123") == ["退款", "款链", "链接", "abc", "123"]
+    assert tokenize("钱") == ["钱"]
+
+
+def test_exact_match_ranks_first():
+    texts = ["快递丢件理赔", "点击退款链接并缴纳保证金才能退款", "保证金可以退还", "银行卡退款"]
+    index = LexicalIndex.build(texts)
+    ids, scores = index.search("退款链接缴纳保证金", 4)
+    assert ids[0] == 1
+    assert np.all(np.diff(scores) <= 0)
+    assert 0 < scores[0] <= 1
+    assert len(index.search("完全无关的查询", 4)[0]) == 0
+
+
+def test_common_terms_are_skipped():
+    texts = common_corpus()
+    index = LexicalIndex.build(texts)
+    ids, _ = index.search(f"{COMMON}，要我点退款链接交保证金", 10)
+    # 常见话术不参与打分：只有带少见词项的条目有分数，两个少见词项都命中的条目排第一
+    assert ids[0] == 30
+    assert sorted(ids.tolist()) == [10, 20, 30]
+
+
+def test_only_common_terms_still_returns_results():
+    index = LexicalIndex.build(common_corpus())
+    ids, scores = index.search(COMMON, 5)
+    assert len(ids) == 5
+    assert np.all(scores > 0)
+
+
+def test_search_within_rows_and_round_trip(tmp_path):
+    texts = common_corpus(1200)
+    index = LexicalIndex.build(texts)
+    ids, _ = index.search("退款链接", 5, rows=slice(0, 15))
+    assert ids.tolist() == [10]
+
+    index.save(str(tmp_path))
+    loaded = LexicalIndex.load(str(tmp_path))
+    for query in ("退款链接保证金", COMMON):
+        expected, expected_scores = index.search(query, 5)
+        actual, actual_scores = loaded.search(query, 5)
+        assert actual.tolist() == expected.tolist()
+        assert np.allclose(actual_scores, expected_scores)
+
+
+def embedding(i: int) -> np.ndarray:
+    """各条目的向量有共同分量，余弦相似度都为正，与真实 embedding 一致"""
+    return np.eye(4, dtype=np.float32)[i] + 0.2
+
+
+def make_hybrid_knowledge_base() -> KnowledgeBase:
+    texts = ["退款链接要先交保证金", "快递丢件理赔", "银行卡冻结解冻", "高额返利刷单"]
+    knowledge_base = KnowledgeBase(vector_storage="float32", lexical=True)
+    knowledge_base.load_knowledge_from_list([
+        {"text": text, "embedding": embedding(i).tolist(), "riskType": "虚假购物、服务类"}
+        for i, text in enumerate(texts)
+    ])
+    return knowledge_base
+
+
+def test_fuse_ranks_entries_found_by_both_first():
+    knowledge_base = make_hybrid_knowledge_base()
+    source = knowledge_base
+    dense = [(0.9, source, 1, "dense"), (0.8, source, 0, "dense")]
+    lexical = [(0.7, source, 0, "lexical"), (0.3, source, 3, "lexical")]
+    fused = KnowledgeBase._fuse(dense, lexical, 3)
+    assert [hit[2] for hit in fused] == [0, 1, 3]
+    # 两种检索都命中的条目展示向量相似度，只被 BM25 命中的保留 BM25 分数类型
+    assert fused[0][3] == "dense" and fused[0][0] == 0.8
+    assert fused[2][3] == "lexical"
+
+
+def test_hybrid_results_label_lexical_scores():
+    knowledge_base = make_hybrid_knowledge_base()
+    # 查询向量指向“高额返利刷单”，查询文本字面匹配“退款链接要先交保证金”
+    hits = knowledge_base.find_similar_texts(
+        embedding(3), top_n=2, query_text="退款链接保证金", retrieval_mode="hybrid"
+    )
+    assert {hit["text"] for hit in hits} == {"高额返利刷单", "退款链接要先交保证金"}
+    score_types = {hit["text"]: hit["score_type"] for hit in hits}
+    assert score_types["高额返利刷单"] == "dense"
+
+    rag_system = RAGSystem(None, knowledge_base, retrieval_mode="hybrid", batch_window_ms=0)
+    formatted = rag_system._format_docs([
+        {"text": "退款链接要先交保证金", "riskType": "虚假购物、服务类", "similarity": 0.42, "score_type": "lexical"},
+        {"text": "高额返利刷单", "riskType": "虚假购物、服务类", "similarity": 0.91, "score_type": "dense"},
+    ])
+    assert "关键词匹配度: 0.42" in formatted
+    assert "相似度: 0.91" in formatted
@@ -0,0 +1,112 @@
+# 使用 fakeredis 作为本地替身测试 RedisSessionStore：追加、裁剪、比较并替换式折叠与清理
+import asyncio
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from session_store import RedisSessionStore
+
+
+def make_store(**kwargs) -> RedisSessionStore:
+    kwargs.setdefault("max_messages", 5)
+    kwargs.setdefault("max_sessions", 100)
+    kwargs.setdefault("idle_ttl_seconds", 3600)
+    return RedisSessionStore(client=fakeredis.FakeRedis(), prefix="test:session", **kwargs)
+
+
+def message(i: int) -> dict:
+    return {"role": "user" if i % 2 == 0 else "assistant", "content": f"消息 {i}"}
+
+
+def test_append_and_get_history():
+    store = make_store()
+    for i in range(3):
+        store.append_message("u1", message(i))
+    assert store.get_history("u1") == [message(i) for i in range(3)]
+    assert store.message_count("u1") == 3
+    assert "u1" in store
+    assert store.get_history("missing") == []
+    assert store.session_count() == 1
+    assert store.total_messages() == 3
+
+
+def test_append_trims_oldest_messages():
+    store = make_store(max_messages=5)
+    for i in range(8):
+        store.append_message("u1", message(i))
+    assert store.get_history("u1") == [message(i) for i in range(3, 8)]
+    assert store.stats()["trimmed_messages"] == 3
+
+
+def test_append_refreshes_expiry():
+    store = make_store(idle_ttl_seconds=120)
+    store.append_message("u1", message(0))
+    ttl = store.client.ttl(store._key("u1"))
+    assert 0 < ttl <= 120
+
+
+def test_compact_history_replaces_matching_head():
+    store = make_store(max_messages=10)
+    for i in range(6):
+        store.append_message("u1", message(i))
+    head = store.get_history("u1")[:4]
+    summary = {"role": "system", "content": "摘要"}
+    assert store.compact_history("u1", head, summary)
+    assert store.get_history("u1") == [summary, message(4), message(5)]
+
+
+def test_compact_history_rejects_changed_head():
+    store = make_store(max_messages=4)
+    for i in range(4):
+        store.append_message("u1", message(i))
+    head = store.get_history("u1")[:2]
+    # 摘要期间追加消息导致开头被裁剪，比较失败时不做任何修改
+    store.append_message("u1", message(4))
+    before = store.get_history("u1")
+    assert not store.compact_history("u1", head, {"role": "system", "content": "摘要"})
+    assert store.get_history("u1") == before
+    assert not store.compact_history("u1", [], {"role": "system", "content": "摘要"})
+
+
+def test_sweep_removes_idle_and_excess_sessions():
+    store = make_store(max_sessions=2, idle_ttl_seconds=60)
+    for user_id in ("u1", "u2", "u3", "u4"):
+        store.append_message(user_id, message(0))
+    # u1 在空闲期限之前访问过，只从索引中清理（会话 key 由 EXPIRE 过期）
+    store.client.zadd(store._index_key, {"u1": time.time() - 120})
+
+    assert store.sweep() == 2
+    assert store.session_count() == 2
+    # 超出 max_sessions 时删除最久未访问的会话
+    assert store.get_history("u2") == []
+    assert store.get_history("u3") == [message(0)]
+    assert store.get_history("u4") == [message(0)]
+    stats = store.stats()
+    assert stats["evicted_ttl"] == 1
+    assert stats["evicted_lru"] == 1
+
+
+def test_delete_session():
+    store = make_store()
+    store.append_message("u1", message(0))
+    assert store.delete_session("u1")
+    assert not store.delete_session("u1")
+    assert store.session_count() == 0
+
+
+def test_async_methods_run_off_the_event_loop():
+    store = make_store()
+
+    async def run():
+        await store.append_message_async("u1", message(0))
+        await store.append_message_async("u1", message(1))
+        history = await store.get_history_async("u1")
+        assert await store.compact_history_async("u1", history[:1], {"role": "system", "content": "摘要"})
+        return await store.get_history_async("u1"), await store.message_count_async("u1"), await store.stats_async()
+
+    history, count, stats = asyncio.run(run())
+    assert history == [{"role": "system", "content": "摘要"}, message(1)]
+    assert count == 2
+    assert stats["backend"] == "redis"
@@ -0,0 +1,94 @@
+# 向量检索：量化存储（int8 / float16）的打分与 float32 重排、IVF 近似检索的召回率
+import numpy as np
+import pytest
+
+from compiled_index import write_compiled_index, open_compiled_index
+from rag import KnowledgeBase
+from vector_index import DenseVectorIndex, IVFIndex, QuantizedVectorIndex, measure_recall, normalize_rows
+
+
+def clustered_vectors(count: int = 2000, dim: int = 64, clusters: int = 16, seed: int = 0) -> np.ndarray:
+    """围绕若干中心的合成向量，近似真实知识库中同类话术聚在一起的分布"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(0, clusters, count)] + 0.3 * rng.normal(size=(count, dim))
+    return normalize_rows(vectors.astype(np.float32))
+
+
+def perturbed_queries(vectors: np.ndarray, count: int = 50, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), count, replace=False)
+    return normalize_rows(vectors[rows] + 0.05 * rng.normal(size=(count, vectors.shape[1])).astype(np.float32))
+
+
+@pytest.mark.parametrize("storage", ["int8", "float16"])
+def test_quantized_scores_close_to_float32(storage):
+    vectors = clustered_vectors()
+    queries = perturbed_queries(vectors)
+    exact = DenseVectorIndex(vectors, normalized=True)
+    quantized = QuantizedVectorIndex.from_normalized(vectors, storage)
+
+    assert measure_recall(exact, quantized, queries, 10) >= 0.9
+    for (exact_ids, exact_scores), (ids, scores) in zip(exact.search_batch(queries, 1), quantized.search_batch(queries, 1)):
+        assert abs(float(scores[0]) - float(exact_scores[0])) < 0.02
+
+
+def test_int8_top_k_matches_float32_after_rerank():
+    vectors = clustered_vectors()
+    queries = perturbed_queries(vectors)
+    exact = DenseVectorIndex(vectors, normalized=True)
+    quantized = QuantizedVectorIndex.from_normalized(vectors, "int8", rerank_vectors=vectors, rerank_factor=4)
+
+    for (exact_ids, exact_scores), (ids, scores) in zip(exact.search_batch(queries, 5), quantized.search_batch(queries, 5)):
+        assert ids.tolist() == exact_ids.tolist()
+        # 重排后的分数是 float32 精确分数
+        assert np.allclose(scores, exact_scores, atol=1e-5)
+
+
+def test_quantized_search_within_rows():
+    vectors = clustered_vectors(count=300)
+    quantized = QuantizedVectorIndex.from_normalized(vectors, "int8", rerank_vectors=vectors)
+    rows = np.arange(100, 200)
+    ids, _ = quantized.search_batch(vectors[150:151], 3, rows=rows)[0]
+    assert ids[0] == 150
+    assert all(100 <= i < 200 for i in ids)
+
+
+def test_json_load_drops_float32_matrix_when_quantized():
+    vectors = clustered_vectors(count=50, dim=16)
+    knowledge_base = KnowledgeBase(vector_storage="int8", rerank_factor=4, lexical=False)
+    knowledge_base.load_knowledge_from_list([
+        {"text": f"条目 {i}", "embedding": vector.tolist(), "riskType": "无风险"} for i, vector in enumerate(vectors)
+    ])
+    assert knowledge_base.embeddings_matrix is None
+    assert knowledge_base.index.rerank_vectors is None
+    assert knowledge_base.find_similar_texts(vectors[7], top_n=1)[0]["text"] == "条目 7"
+
+
+def test_compiled_load_keeps_memory_mapped_rerank(tmp_path):
+    vectors = clustered_vectors(count=50, dim=16)
+    path = str(tmp_path / "compiled")
+    write_compiled_index(
+        path, [f"条目 {i}" for i in range(50)], ["无风险"] * 50, vectors,
+        extra_writer=lambda out_dir, normalized: QuantizedVectorIndex.from_normalized(normalized, "int8").save(out_dir),
+    )
+    knowledge_base = KnowledgeBase(vector_storage="int8", rerank_factor=4, lexical=False)
+    knowledge_base.load_compiled(open_compiled_index(path))
+    assert knowledge_base.index.rerank_vectors is not None
+    assert knowledge_base.index.rerank_factor == 4
+    hit = knowledge_base.find_similar_texts(vectors[7], top_n=1)[0]
+    assert hit["text"] == "条目 7"
+    assert hit["similarity"] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_ivf_recall_and_full_probe_is_exact():
+    vectors = clustered_vectors()
+    queries = perturbed_queries(vectors)
+    exact = DenseVectorIndex(vectors, normalized=True)
+    ivf = IVFIndex.build(vectors, nlist=16, nprobe=4, seed=0)
+
+    assert measure_recall(exact, ivf, queries, 10) >= 0.9
+    assert measure_recall(exact, ivf, queries, 10, nprobe=ivf.nlist) == 1.0
+    # 每个查询的最近邻（查询由该行扰动得到）总能找到
+    for (exact_ids, _), (ids, _) in zip(exact.search_batch(queries, 1), ivf.search_batch(queries, 1)):
+        assert ids[0] == exact_ids[0]
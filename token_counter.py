@@ -0,0 +1,123 @@
+# token_counter.py
+# token 计数：优先使用本地 tokenizer 文件，否则使用按字符类别校准的估算器；并按阶段统计 token 用量
+import os
+import re
+import math
+import logging
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from dotenv import load_dotenv
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:  # 仅在配置 TOKENIZER_PATH 时需要
+    Tokenizer = None
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 可选：BlueLM 的 tokenizer.json（HuggingFace tokenizers 格式）
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH", "")
+# 估算器校准参数：中文平均每个 token 对应的字符数、英文单词平均每个 token 对应的字母数
+TOKEN_CJK_CHARS_PER_TOKEN = float(os.getenv("TOKEN_CJK_CHARS_PER_TOKEN", "1.4"))
+TOKEN_LATIN_CHARS_PER_TOKEN = float(os.getenv("TOKEN_LATIN_CHARS_PER_TOKEN", "4"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "8192"))
+# 每条消息的角色/分隔符开销
+MESSAGE_TOKEN_OVERHEAD = 4
+
+_RUN_RE = re.compile(
+    r"(?P<cjk>[㐀-䶿一-鿿豈-﫿]+)"
+    r"|(?P<latin>[A-Za-z]+)"
+    r"|(?P<digit>[0-9]+)"
+    r"|(?P<space>\s+)"
+    r"|(?P<wide>[\U00010000-\U0010ffff])"
+    r"|(?P<other>.)",
+    re.S,
+)
+
+_tokenizer = None
+if TOKENIZER_PATH:
+    if Tokenizer is None:
+        logger.warning("配置了 TOKENIZER_PATH 但未安装 tokenizers 包，将使用估算器计数")
+    else:
+        try:
+            _tokenizer = Tokenizer.from_file(TOKENIZER_PATH)
+            logger.info(f"已加载 tokenizer: {TOKENIZER_PATH}")
+        except Exception as e:
+            logger.warning(f"加载 tokenizer {TOKENIZER_PATH} 失败: {e}，将使用估算器计数")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    按字符类别估算 token 数：
+    中文按 TOKEN_CJK_CHARS_PER_TOKEN 个字一个 token，英文单词按 TOKEN_LATIN_CHARS_PER_TOKEN 个字母一个 token，
+    数字每 3 位一个 token，emoji 等补充平面字符各 2 个 token，其他标点符号各 1 个 token，空白忽略。
+    """
+    tokens = 0.0
+    for match in _RUN_RE.finditer(text):
+        kind = match.lastgroup
+        length = match.end() - match.start()
+        if kind == "cjk":
+            tokens += length / TOKEN_CJK_CHARS_PER_TOKEN
+        elif kind == "latin":
+            tokens += max(1.0, length / TOKEN_LATIN_CHARS_PER_TOKEN)
+        elif kind == "digit":
+            tokens += math.ceil(length / 3)
+        elif kind == "wide":
+            tokens += 2
+        elif kind == "other":
+            tokens += 1
+    return int(math.ceil(tokens))
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _count_tokens_cached(text: str) -> int:
+    if _tokenizer is not None:
+        return len(_tokenizer.encode(text, add_special_tokens=False).ids)
+    return estimate_tokens(text)
+
+
+def count_tokens(text) -> int:
+    """返回文本的 token 数（结果按文本缓存）"""
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = str(text)
+    return _count_tokens_cached(text)
+
+
+def count_message_tokens(messages: List[dict]) -> int:
+    """返回消息列表的 token 数（含每条消息的固定开销）"""
+    return sum(count_tokens(msg.get("content", "")) + MESSAGE_TOKEN_OVERHEAD for msg in messages)
+
+
+class TokenMeter:
+    """按处理阶段累计上游调用的 token 用量，供 /v1/stats 展示"""
+
+    def __init__(self):
+        self._stages: Dict[str, Dict[str, int]] = {}
+
+    def record(self, stage: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+        entry = self._stages.setdefault(stage, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        entry["calls"] += 1
+        entry["prompt_tokens"] += prompt_tokens
+        entry["completion_tokens"] += completion_tokens
+
+    def record_call(self, stage: str, messages: List[dict], completion: str = "") -> Tuple[int, int]:
+        """统计一次上游调用的 prompt/completion token 数并累计，返回 (prompt_tokens, completion_tokens)"""
+        prompt_tokens = count_message_tokens(messages)
+        completion_tokens = count_tokens(completion)
+        self.record(stage, prompt_tokens, completion_tokens)
+        return prompt_tokens, completion_tokens
+
+    def stats(self) -> dict:
+        return {
+            "counter": "tokenizer" if _tokenizer is not None else "estimator",
+            "stages": {stage: dict(entry) for stage, entry in self._stages.items()},
+        }
+
+
+token_meter = TokenMeter()
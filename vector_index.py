@@ -0,0 +1,429 @@
+# vector_index.py
+# 稠密向量索引：加载时一次性归一化为连续的 float32 矩阵，查询只需一次矩阵-向量乘法 + argpartition
+import os
+import json
+import logging
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """按行 L2 归一化为连续的 float32 矩阵；范数接近 0 的行保持为全 0（与任何查询的相似度为 0）"""
+    matrix = np.array(matrix, dtype=np.float32, order="C")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 1e-8)
+    matrix[(norms <= 1e-8).ravel()] = 0.0
+    return matrix
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """返回 scores 中最大的 k 个元素的下标与分数（按分数降序），只对候选部分排序"""
+    n = scores.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if k < n:
+        candidates = np.argpartition(scores, n - k)[n - k:]
+    else:
+        candidates = np.arange(n)
+    order = np.argsort(scores[candidates])[::-1]
+    indices = candidates[order]
+    return indices, scores[indices]
+
+
+# 行子集：连续区间（slice，视图，不复制）或升序的行下标数组
+Rows = Union[slice, np.ndarray]
+
+
+def row_count(rows: Rows) -> int:
+    return rows.stop - rows.start if isinstance(rows, slice) else len(rows)
+
+
+def sub_rows(rows: Rows, start: int, end: int) -> Rows:
+    """行子集中第 [start, end) 个位置对应的行"""
+    if isinstance(rows, slice):
+        return slice(rows.start + start, min(rows.start + end, rows.stop))
+    return rows[start:end]
+
+
+def map_rows(rows: Optional[Rows], positions: np.ndarray) -> np.ndarray:
+    """把行子集内的位置转换为原矩阵中的行号"""
+    if rows is None:
+        return positions
+    if isinstance(rows, slice):
+        return positions + rows.start
+    return rows[positions]
+
+
+class RowPartitions:
+    """
+    按标签（风险类型）划分的行集合。编译知识库按风险类型分组存储，每个分区都是连续的行区间，
+    检索分区只需对矩阵的一个视图打分；旧的编译目录中分区为行下标数组，检索时按下标读取。
+    """
+
+    def __init__(self, rows: Dict[str, Rows]):
+        self.rows = rows
+
+    @classmethod
+    def from_labels(cls, labels: Sequence[str]) -> "RowPartitions":
+        ids = {}
+        label_ids = np.fromiter((ids.setdefault(label, len(ids)) for label in labels), dtype=np.int64, count=len(labels))
+        names = list(ids)
+        return cls.from_ids(label_ids, names)
+
+    @classmethod
+    def from_ids(cls, label_ids: np.ndarray, names: Sequence[str]) -> "RowPartitions":
+        """label_ids[i] 为第 i 行的标签在 names 中的下标"""
+        label_ids = np.asarray(label_ids, dtype=np.int64)
+        order = np.argsort(label_ids, kind="stable")
+        bounds = np.searchsorted(label_ids[order], np.arange(len(names) + 1))
+        rows = {}
+        for i, name in enumerate(names):
+            members = order[bounds[i]:bounds[i + 1]]
+            if len(members) == 0:
+                continue
+            contiguous = members[-1] - members[0] + 1 == len(members)
+            rows[name] = slice(int(members[0]), int(members[-1]) + 1) if contiguous else members
+        return cls(rows)
+
+    @classmethod
+    def from_ranges(cls, ranges: Dict[str, Sequence[int]]) -> "RowPartitions":
+        return cls({name: slice(int(start), int(end)) for name, (start, end) in ranges.items()})
+
+    @property
+    def labels(self) -> List[str]:
+        return list(self.rows)
+
+    @property
+    def contiguous(self) -> bool:
+        return all(isinstance(rows, slice) for rows in self.rows.values())
+
+    def sizes(self) -> Dict[str, int]:
+        return {name: row_count(rows) for name, rows in self.rows.items()}
+
+    def select(self, labels: Iterable[str]) -> List[Rows]:
+        return [self.rows[label] for label in labels if label in self.rows]
+
+
+class DenseVectorIndex:
+    """
+    余弦相似度检索索引。
+    文档向量在构造时归一化一次并保存为 C 连续的 float32 矩阵，
+    单次查询的开销为一次 (N, d) x (d,) 乘法，不再复制文档矩阵。
+    """
+
+    def __init__(self, vectors: np.ndarray, normalized: bool = False):
+        if vectors.ndim != 2:
+            raise ValueError(f"向量矩阵必须是二维的，实际维度: {vectors.ndim}")
+        if normalized:
+            self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        else:
+            self.vectors = normalize_rows(vectors)
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def _normalize_queries(self, queries: np.ndarray) -> np.ndarray:
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dim:
+            raise ValueError(f"查询向量维度 {queries.shape} 与索引维度 {self.dim} 不符")
+        return normalize_rows(queries)
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """返回与 query 最相似的 k 个文档的 (下标, 余弦相似度)，按相似度降序"""
+        query = self._normalize_queries(np.asarray(query).reshape(1, -1))[0]
+        return top_k(self.vectors @ query, k)
+
+    def search_batch(self, queries: np.ndarray, k: int, rows: Optional[Rows] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """批量检索：所有查询在一次 (m, d) x (d, N) 矩阵乘法中完成打分；给定 rows 时只对这些行打分"""
+        queries = self._normalize_queries(queries)
+        if queries.shape[0] == 0:
+            return []
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        scores = queries @ vectors.T
+        results = [top_k(row, k) for row in scores]
+        if rows is None:
+            return results
+        return [(map_rows(rows, indices), row_scores) for indices, row_scores in results]
+
+
+# 量化存储在编译知识库目录中的文件
+QUANTIZED_FILES = {"int8": "vectors_int8.npy", "float16": "vectors_f16.npy"}
+QUANTIZED_SCALES_FILE = "vector_scales.npy"
+
+
+def quantize_rows(normalized: np.ndarray, storage: str, chunk_size: int = 65536) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    量化已归一化的向量矩阵，返回 (codes, scales)。
+    int8: 每行按自身最大绝对值缩放到 [-127, 127]，scales 为每行的缩放系数；float16: 直接转换，scales 为 None。
+    """
+    if storage == "float16":
+        return np.asarray(normalized, dtype=np.float16), None
+    if storage != "int8":
+        raise ValueError(f"不支持的量化格式: {storage}")
+
+    codes = np.empty(normalized.shape, dtype=np.int8)
+    scales = np.empty(normalized.shape[0], dtype=np.float32)
+    for start in range(0, normalized.shape[0], chunk_size):
+        block = np.asarray(normalized[start:start + chunk_size], dtype=np.float32)
+        block_scales = np.abs(block).max(axis=1) / 127.0
+        safe = np.where(block_scales > 0, block_scales, 1.0)
+        codes[start:start + chunk_size] = np.rint(block / safe[:, None])
+        scales[start:start + chunk_size] = block_scales
+    return codes, scales
+
+
+class QuantizedVectorIndex:
+    """
+    量化存储（int8 + 每行缩放系数，或 float16）的余弦相似度检索索引。
+    打分直接在量化数据上分块进行：每块临时转换为 float32 后做矩阵乘法，块足够小可以留在 CPU 缓存中，
+    额外内存只有一个块的大小；
+    提供 rerank_vectors（通常为内存映射的 float32 矩阵）时，对前 k * rerank_factor 个候选按 float32 精确重排。
+    """
+
+    def __init__(self, codes: np.ndarray, scales: Optional[np.ndarray] = None,
+                 rerank_vectors: Optional[np.ndarray] = None, rerank_factor: int = 4,
+                 block_rows: int = 256):
+        self.codes = codes
+        self.scales = scales
+        self.rerank_vectors = rerank_vectors
+        self.rerank_factor = rerank_factor
+        self.block_rows = block_rows
+
+    @classmethod
+    def from_normalized(cls, normalized: np.ndarray, storage: str, **kwargs) -> "QuantizedVectorIndex":
+        codes, scales = quantize_rows(normalized, storage)
+        return cls(codes, scales, **kwargs)
+
+    @classmethod
+    def load(cls, path: str, storage: str, **kwargs) -> Optional["QuantizedVectorIndex"]:
+        """以内存映射方式加载量化向量；文件不存在时返回 None"""
+        codes_path = os.path.join(path, QUANTIZED_FILES[storage])
+        if not os.path.exists(codes_path):
+            return None
+        scales = None
+        if storage == "int8":
+            scales = np.load(os.path.join(path, QUANTIZED_SCALES_FILE))
+        return cls(np.load(codes_path, mmap_mode="r"), scales, **kwargs)
+
+    def save(self, path: str):
+        storage = "int8" if self.codes.dtype == np.int8 else "float16"
+        np.save(os.path.join(path, QUANTIZED_FILES[storage]), self.codes)
+        if self.scales is not None:
+            np.save(os.path.join(path, QUANTIZED_SCALES_FILE), self.scales)
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.codes.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def _score(self, queries: np.ndarray, rows: Rows) -> np.ndarray:
+        count = row_count(rows)
+        scores = np.empty((queries.shape[0], count), dtype=np.float32)
+        for start in range(0, count, self.block_rows):
+            block_rows = sub_rows(rows, start, start + self.block_rows)
+            block = np.asarray(self.codes[block_rows], dtype=np.float32)
+            block_scores = queries @ block.T
+            if self.scales is not None:
+                block_scores *= self.scales[block_rows]
+            scores[:, start:start + block.shape[0]] = block_scores
+        return scores
+
+    def search(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self.search_batch(np.asarray(query).reshape(1, -1), k)[0]
+
+    def search_batch(self, queries: np.ndarray, k: int, rows: Optional[Rows] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dim:
+            raise ValueError(f"查询向量维度 {queries.shape} 与索引维度 {self.dim} 不符")
+        if queries.shape[0] == 0:
+            return []
+        queries = normalize_rows(queries)
+        scores = self._score(queries, slice(0, len(self)) if rows is None else rows)
+
+        rerank = self.rerank_vectors is not None and self.rerank_factor > 1
+        results = []
+        for query, row in zip(queries, scores):
+            indices, approx_scores = top_k(row, k * self.rerank_factor if rerank else k)
+            indices = map_rows(rows, indices)
+            if rerank and len(indices):
+                # 只读取候选行的 float32 向量，按原始下标顺序读取以利于内存映射的顺序访问
+                order = np.argsort(indices)
+                exact_scores = np.empty(len(indices), dtype=np.float32)
+                exact_scores[order] = np.asarray(self.rerank_vectors[indices[order]], dtype=np.float32) @ query
+                positions, top_scores = top_k(exact_scores, k)
+                results.append((indices[positions], top_scores))
+            else:
+                results.append((indices, approx_scores))
+        return results
+
+# IVF 索引在编译知识库目录中的文件
+IVF_META_FILE = "ivf_meta.json"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_VECTORS_FILE = "ivf_vectors.npy"
+IVF_IDS_FILE = "ivf_ids.npy"
+IVF_OFFSETS_FILE = "ivf_offsets.npy"
+
+
+def _assign_lists(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """分块计算每个向量所属的簇（内积最大的中心），避免一次性分配 (N, nlist) 的打分矩阵"""
+    assignments = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], chunk_size):
+        block = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        assignments[start:start + chunk_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, iterations: int = 10,
+                    sample_size: int = 0, seed: int = 0) -> np.ndarray:
+    """
+    球面 k-means：在（可抽样的）归一化向量上训练 nlist 个单位长度的簇中心。
+    sample_size 为 0 时按每个簇 256 个样本抽样。
+    """
+    rng = np.random.default_rng(seed)
+    n = vectors.shape[0]
+    nlist = max(1, min(nlist, n))
+    sample_size = sample_size or nlist * 256
+    if n > sample_size:
+        sample = np.asarray(vectors[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+    else:
+        sample = np.asarray(vectors, dtype=np.float32)
+
+    centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # 空簇重新以随机样本初始化
+            sums[empty] = sample[rng.choice(sample.shape[0], int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    倒排文件（IVF）近似检索索引。
+    向量按所属簇重新排列为连续的分段，查询时只对与查询最接近的 nprobe 个簇打分，
+    nprobe 越大召回越高、耗时越长；nprobe = nlist 时等价于精确检索。
+    """
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, ids: np.ndarray,
+                 offsets: np.ndarray, nprobe: int = 8):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, nlist: int, nprobe: int = 8, iterations: int = 10,
+              sample_size: int = 0, seed: int = 0) -> "IVFIndex":
+        """从已归一化的向量矩阵训练并构建索引（离线执行）"""
+        centroids = train_centroids(vectors, nlist, iterations, sample_size, seed)
+        assignments = _assign_lists(vectors, centroids)
+        ids = np.argsort(assignments, kind="stable").astype(np.int64)
+        counts = np.bincount(assignments, minlength=centroids.shape[0])
+        offsets = np.zeros(centroids.shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        ivf_vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32)[ids])
+        logger.info(f"IVF 索引构建完成: {len(ids)} 条, {centroids.shape[0]} 个簇, 最大簇 {int(counts.max())} 条")
+        return cls(centroids, ivf_vectors, ids, offsets, nprobe)
+
+    def save(self, path: str):
+        np.save(os.path.join(path, IVF_CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(path, IVF_VECTORS_FILE), self.vectors)
+        np.save(os.path.join(path, IVF_IDS_FILE), self.ids)
+        np.save(os.path.join(path, IVF_OFFSETS_FILE), self.offsets)
+        with open(os.path.join(path, IVF_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"nlist": self.nlist, "nprobe": self.nprobe, "count": len(self)}, f)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["IVFIndex"]:
+        """以内存映射方式加载 IVF 索引；文件不存在时返回 None"""
+        meta_path = os.path.join(path, IVF_META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        return cls(
+            centroids=np.load(os.path.join(path, IVF_CENTROIDS_FILE)),
+            vectors=np.load(os.path.join(path, IVF_VECTORS_FILE), mmap_mode="r"),
+            ids=np.load(os.path.join(path, IVF_IDS_FILE), mmap_mode="r"),
+            offsets=np.load(os.path.join(path, IVF_OFFSETS_FILE)),
+            nprobe=meta.get("nprobe", 8),
+        )
+
+    def _search_normalized(self, query: np.ndarray, centroid_scores: np.ndarray, k: int,
+                           nprobe: int) -> Tuple[np.ndarray, np.ndarray]:
+        probe, _ = top_k(centroid_scores, nprobe)
+        candidate_ids = []
+        candidate_scores = []
+        for list_id in probe:
+            start, end = self.offsets[list_id], self.offsets[list_id + 1]
+            if end > start:
+                candidate_ids.append(self.ids[start:end])
+                candidate_scores.append(self.vectors[start:end] @ query)
+        if not candidate_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = np.concatenate(candidate_scores)
+        positions, top_scores = top_k(scores, k)
+        return np.concatenate(candidate_ids)[positions], top_scores
+
+    def search(self, query: np.ndarray, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """返回近似的 top-k (下标, 余弦相似度)，下标为原始知识库中的位置"""
+        return self.search_batch(np.asarray(query).reshape(1, -1), k, nprobe)[0]
+
+    def search_batch(self, queries: np.ndarray, k: int,
+                     nprobe: Optional[int] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """批量近似检索：簇中心打分在一次矩阵乘法中完成，各查询再分别扫描自己的候选簇"""
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dim:
+            raise ValueError(f"查询向量维度 {queries.shape} 与索引维度 {self.dim} 不符")
+        if queries.shape[0] == 0:
+            return []
+        queries = normalize_rows(queries)
+        nprobe = nprobe or self.nprobe
+        centroid_scores = queries @ self.centroids.T
+        return [
+            self._search_normalized(query, scores, k, nprobe)
+            for query, scores in zip(queries, centroid_scores)
+        ]
+
+
+def measure_recall(exact, approx, queries: np.ndarray, k: int, **search_kwargs) -> float:
+    """以精确索引的结果为基准，计算近似索引在 queries 上的 recall@k"""
+    exact_results = exact.search_batch(queries, k)
+    approx_results = approx.search_batch(queries, k, **search_kwargs)
+    hits = 0
+    total = 0
+    for (exact_ids, _), (approx_ids, _) in zip(exact_results, approx_results):
+        hits += len(np.intersect1d(exact_ids, approx_ids))
+        total += len(exact_ids)
+    return hits / total if total else 1.0
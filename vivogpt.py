@@ -1,10 +1,13 @@
 # vivogpt.py
 import uuid
 import time
+import json
 import requests
+import httpx
 import os
 from dotenv import load_dotenv
 from auth_util import gen_sign_headers
+from http_client import get_async_client, request_timeout
 
 # 加载环境变量
 load_dotenv()
@@ -16,10 +19,9 @@ STREAM_URI = os.getenv("VIVOGPT_API_STREAM_URI")
 DOMAIN = os.getenv("VIVOGPT_API_DOMAIN")  
 METHOD = 'POST'
 
-def ask_vivogpt(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=None):
+def _build_request(messages, extra, model, session_id, uri):
     """
-    向大模型发起同步请求并返回 (content, time_cost)。
-    出错时返回 (None, 错误信息)。
+    构造请求所需的 (url, params, headers, payload)，同步与异步调用共用。
     """
     system_messages = [msg for msg in messages if msg.get("role") == "system"]
     filtered_messages = [msg for msg in messages if msg.get("role") != "system"]
@@ -48,22 +50,17 @@ def ask_vivogpt(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=None):
     if system_prompt:
         payload['systemPrompt'] = system_prompt
 
-    headers = gen_sign_headers(APP_ID, APP_KEY, METHOD, URI, params)
+    headers = gen_sign_headers(APP_ID, APP_KEY, METHOD, uri, params)
     headers['Content-Type'] = 'application/json'
-    url = f'https://{DOMAIN}{URI}'
-
-    start_time = time.time()
-    try:
-        resp = requests.post(url, json=payload, headers=headers, params=params, timeout=100)
-    except requests.RequestException as e:
-        # 错误类型: RequestException (网络或请求构建问题)
-        # 错误码: N/A (来自异常对象本身)
-        return None, f'RequestException: {str(e)}'
+    url = f'https://{DOMAIN}{uri}'
+    return url, params, headers, payload
 
-    time_cost = time.time() - start_time
 
+def _parse_response(status_code, response_body_text, time_cost):
+    """
+    解析同步接口的响应，返回 (content, time_cost)；出错时返回 (None, 错误信息)。
+    """
     # 尝试将响应体解析为JSON，因为API错误通常在JSON体中包含 'code' 和 'msg'
-    response_body_text = resp.text # 存储响应文本，以备非JSON或JSON解析失败时使用
     """
     示例响应体:
     {
@@ -79,11 +76,11 @@ def ask_vivogpt(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=None):
     }
     """
     try:
-        res_obj = resp.json()
+        res_obj = json.loads(response_body_text)
     except ValueError: # 响应体不是有效的JSON
         res_obj = None
 
-    if resp.status_code == 200:
+    if status_code == 200:
         if res_obj is None:
             # 错误类型: API契约错误 (HTTP 200 但非JSON)
             # 错误码: HTTP 200 (但格式无效)
@@ -115,8 +112,8 @@ def ask_vivogpt(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=None):
     else:
         # HTTP状态码指示错误 (例如 4xx, 5xx)
         # 错误类型: HTTP错误
-        # 错误码: resp.status_code
-        error_message = f'HTTP Error {resp.status_code}.'
+        # 错误码: status_code
+        error_message = f'HTTP Error {status_code}.'
         if res_obj: # 如果响应体是JSON
             api_code_from_json = res_obj.get('code') # 尝试从JSON中获取API特定的错误码
             api_msg_from_json = res_obj.get('msg')
@@ -131,44 +128,54 @@ def ask_vivogpt(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=None):
             error_message += f' Details: {response_body_text}'
         # 如果res_obj为None且response_body_text为空，则只返回HTTP错误状态码信息
         return None, error_message
+
+
+def ask_vivogpt(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=None):
+    """
+    向大模型发起同步请求并返回 (content, time_cost)。
+    出错时返回 (None, 错误信息)。
+    """
+    url, params, headers, payload = _build_request(messages, extra, model, session_id, URI)
+
+    start_time = time.time()
+    try:
+        resp = requests.post(url, json=payload, headers=headers, params=params, timeout=100)
+    except requests.RequestException as e:
+        # 错误类型: RequestException (网络或请求构建问题)
+        # 错误码: N/A (来自异常对象本身)
+        return None, f'RequestException: {str(e)}'
+
+    time_cost = time.time() - start_time
+    return _parse_response(resp.status_code, resp.text, time_cost)
+
+
+async def ask_vivogpt_async(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=None, timeout=100):
+    """
+    ask_vivogpt 的异步版本，使用共享连接池，不阻塞事件循环。
+    返回值约定与 ask_vivogpt 相同。
+    """
+    url, params, headers, payload = _build_request(messages, extra, model, session_id, URI)
+
+    start_time = time.time()
+    try:
+        resp = await get_async_client().post(
+            url, json=payload, headers=headers, params=params, timeout=request_timeout(timeout)
+        )
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        # 与同步版本的 RequestException 一致：网络错误与无效 URL 都返回 (None, 错误信息)
+        return None, f'RequestException: {str(e)}'
+
+    time_cost = time.time() - start_time
+    return _parse_response(resp.status_code, resp.text, time_cost)
     
 def ask_vivogpt_stream(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=None):
     """
     向大模型发起流式请求并生成响应。
     """
-    system_messages = [msg for msg in messages if msg.get("role") == "system"]
-    filtered_messages = [msg for msg in messages if msg.get("role") != "system"]
-    
-    # 合并所有system消息内容作为systemPrompt
-    system_prompt = "\n".join([msg.get("content", "") for msg in system_messages]) if system_messages else None
-    
-    # 确保每个消息都有contentType字段
-    for msg in filtered_messages:
-        if "contentType" not in msg:
-            msg["contentType"] = "text"
-            
-    if not session_id:
-        session_id = str(uuid.uuid4())
-
-    request_id = str(uuid.uuid4())
-    params = {'requestId': request_id}
-    payload = {
-        'messages': filtered_messages,
-        'model': model,
-        'sessionId': session_id,
-        'extra': extra if extra is not None else {}
-    }
-    
-    # 如果有system消息，添加systemPrompt字段
-    if system_prompt:
-        payload['systemPrompt'] = system_prompt
-
     stream_uri = STREAM_URI if STREAM_URI else URI  # 使用流式URI或默认URI
     
     # 使用流式URI
-    headers = gen_sign_headers(APP_ID, APP_KEY, METHOD, stream_uri, params)
-    headers['Content-Type'] = 'application/json'
-    url = f'https://{DOMAIN}{stream_uri}'
+    url, params, headers, payload = _build_request(messages, extra, model, session_id, stream_uri)
 
     try:
         resp = requests.post(url, json=payload, headers=headers, params=params, stream=True, timeout=100)
@@ -176,3 +183,21 @@ def ask_vivogpt_stream(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=N
     except requests.RequestException as e:
         return None
 
+
+async def ask_vivogpt_stream_async(messages, extra, model='vivo-BlueLM-TB-Pro', session_id=None, timeout=100):
+    """
+    ask_vivogpt_stream 的异步版本，返回尚未读取响应体的 httpx.Response。
+    调用方负责在读取完毕后执行 await resp.aclose()；失败时返回 None。
+    """
+    stream_uri = STREAM_URI if STREAM_URI else URI  # 使用流式URI或默认URI
+
+    url, params, headers, payload = _build_request(messages, extra, model, session_id, stream_uri)
+
+    client = get_async_client()
+    try:
+        req = client.build_request(
+            'POST', url, json=payload, headers=headers, params=params, timeout=request_timeout(timeout)
+        )
+        return await client.send(req, stream=True)
+    except (httpx.HTTPError, httpx.InvalidURL):
+        return None